@@ -0,0 +1,82 @@
+"""Benchmark of the JSON encoder backends on realistic documents
+
+Encodes PDF documents with many highlights (including a base64 image per
+highlight) and Reference documents with every available backend of
+dashpool_components.encoding.
+
+Usage:
+    python benchmarks/bench_encoders.py
+"""
+import base64
+import os
+import random
+import timeit
+
+from dashpool_components import chatutils
+from dashpool_components import encoding
+
+
+def make_pdf(highlights=200, rects=20, image_bytes=20000, seed=1):
+    rng = random.Random(seed)
+    image = "data:image/png;base64," + base64.b64encode(os.urandom(image_bytes)).decode()
+
+    def rect(page):
+        x1, y1 = rng.uniform(0, 500), rng.uniform(0, 800)
+        return chatutils.PdfHighlightPositionRect(x1, y1, x1 + 50, y1 + 12, 600, 850, page)
+
+    return chatutils.PDF(
+        url="file_id",
+        name="document.pdf",
+        highlights=[
+            chatutils.PdfHighlight(
+                content=chatutils.PdfHighlightContent(text="lorem ipsum " * 20, image=image),
+                position=chatutils.PdfHighlightPosition(
+                    boundingRect=rect(i % 10),
+                    rects=[rect(i % 10) for _ in range(rects)],
+                    pageNumber=i % 10,
+                ),
+                comment=chatutils.PdfHighlightComment("comment", None),
+                id=str(i),
+                file_id="file_id",
+            )
+            for i in range(highlights)
+        ],
+    )
+
+
+def make_references(count=200):
+    return [
+        chatutils.Reference(url=f"https://example.com/{i}", markdown="# Title\n\n" + "text " * 200, ref=f"ref{i}")
+        for i in range(count)
+    ]
+
+
+def main():
+    pdf = make_pdf()
+    references = make_references()
+    backends = [name for name in encoding.BACKENDS if name != "orjson" or encoding.orjson is not None]
+
+    print(f"{'backend':<10}{'payload':<12}{'MB':>8}{'ms':>10}{'MB/s':>10}")
+    for name in backends:
+        encoding.set_backend(name)
+
+        def encode_pdf():
+            pdf.invalidate()
+            return pdf.to_json_bytes()
+
+        def encode_references():
+            for reference in references:
+                reference.invalidate()
+            return [reference.to_json_bytes() for reference in references]
+
+        for payload, function in [("pdf", encode_pdf), ("references", encode_references)]:
+            result = function()
+            size = (len(result) if isinstance(result, bytes) else sum(map(len, result))) / 1e6
+            seconds = min(timeit.repeat(function, number=1, repeat=5))
+            print(f"{name:<10}{payload:<12}{size:>8.2f}{seconds * 1000:>10.1f}{size / seconds:>10.1f}")
+
+    encoding.set_backend()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Microbenchmark for chatutils.Response.sanitize_string
+
+Compares the throughput of the single-pass escaper with the previous
+regex fixpoint implementation, which is kept as reference. The tests in
+tests/test_sanitize.py check that both produce the same output.
+
+Usage:
+    python benchmarks/bench_sanitize.py
+"""
+import json
+import re
+import timeit
+
+from dashpool_components import chatutils
+
+
+def legacy_sanitize_string(input: str) -> str:
+    """The original regex fixpoint implementation, kept as reference"""
+
+    input = json.dumps(input)[1:-1]
+
+    def inner_sanitize_string(item: str) -> str:
+        found = False
+
+        while re.search(r'\\([^nurtbf\"\\/])', item):
+            item = re.sub(r'\\([^nrtbf\"\\/])', r'\1', item)
+            found = True
+
+        while re.search(r'\\[0-9]', item):
+            item = re.sub(r'\\([0-9])', r'\1', item)
+            found = True
+
+        return item, found
+
+    found = True
+    while found:
+        input, found = inner_sanitize_string(input)
+
+    return input
+
+
+CORPUS = [
+    "",
+    "a",
+    "Hello World",
+    "line\nbreak\ttab\rreturn",
+    'quotes " and \' inside',
+    "back\\slash",
+    "\\",
+    "\\\\",
+    "\\d \\y \\g \\4 \\5",
+    "C:\\Users\\name\\file.txt",
+    "\\n \\t \\u1234 \\/ \\\"",
+    "1234567890",
+    "\\1\\2\\3",
+    "umlauts äöü ß",
+    "emoji 😀 and € sign",
+    "é\\d",
+    "\\é\\\\x",
+    "\\\\\\u",
+    "control \x00 \x1f chars",
+    "lone surrogate \ud800",
+    "$$\\frac{a}{b} \\cdot \\sqrt{x}$$",
+    "| table | [ref1] |\n|---|---|",
+]
+
+
+def main():
+    sanitize = chatutils.Response.__new__(chatutils.Response).sanitize_string
+    text = "".join(CORPUS) * 20
+    workloads = {
+        "char tokens": list(text),
+        "word tokens": text.split(" "),
+        "escaped tokens": [t for t in CORPUS if "\\" in t] * 50,
+    }
+
+    print(f"{'workload':<16}{'legacy MB/s':>14}{'new MB/s':>12}{'speedup':>10}")
+    for name, tokens in workloads.items():
+        size = sum(len(t.encode("utf-8", "surrogatepass")) for t in tokens) / 1e6
+
+        def run(function):
+            return min(timeit.repeat(lambda: [function(t) for t in tokens], number=1, repeat=5))
+
+        legacy, new = run(legacy_sanitize_string), run(sanitize)
+        print(f"{name:<16}{size / legacy:>14.2f}{size / new:>12.2f}{legacy / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
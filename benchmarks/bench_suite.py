@@ -0,0 +1,286 @@
+"""Offline benchmark suite of the chat streaming path and the document serialization
+
+Runs without network or database:
+- streams Response.generate_response through a Flask test client, with
+  char-level, word-level and burst generators
+- sanitize_string on char and word tokens
+- PDF.to_dict, PDF.from_dicts and PDF.to_json_bytes on large highlight sets
+- log inserts through the LogSink into an in-memory collection
+
+The results are written as JSON, so runs of different releases can be compared.
+
+Usage:
+    python benchmarks/bench_suite.py [--quick] [--output results.json]
+    python benchmarks/bench_suite.py --compare baseline.json [--tolerance 0.2]
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+import flask
+
+from dashpool_components import chatutils
+from dashpool_components import encoding
+
+from bench_encoders import make_pdf
+from bench_sanitize import CORPUS
+
+
+TEXT = (
+    "Hello, this is a *markdown* answer with a table [ref1]\n\n"
+    "| Header 1 | Header 2 |\n| -------- | -------- |\n| Cell 1 | Cell 2 [ref2] |\n"
+    'Quotes " and backslashes \\d, umlauts äöü and emoji 😀.\n'
+)
+
+
+# the workloads return the callable to add to the response and its number of tokens
+
+def char_generator(size):
+    text = (TEXT * (size // len(TEXT) + 1))[:size]
+    return lambda: iter(text), len(text)
+
+
+def word_generator(size):
+    words = (TEXT * (size // len(TEXT) + 1))[:size].split(" ")
+    return lambda: (word + " " for word in words), len(words)
+
+
+def burst_generator(size, burst=64, pause=0.002):
+    """Tokens arrive in bursts, like an upstream that flushes its network buffer"""
+    text = (TEXT * (size // len(TEXT) + 1))[:size]
+
+    def generator():
+        for start in range(0, len(text), burst):
+            time.sleep(pause)
+            yield from text[start:start + burst]
+    return generator, len(text)
+
+
+STREAM_WORKLOADS = {
+    "char": char_generator,
+    "word": word_generator,
+    "burst": burst_generator,
+}
+
+
+def make_app(producer, flush_policy):
+    app = flask.Flask(__name__)
+
+    @app.route("/chat", methods=["POST"])
+    def chat():
+        resp = chatutils.Response(app, flush_policy=flush_policy, compression_policy=False)
+        resp.add({"role": "reference", "ref": "ref1", "content": "reference"})
+        resp.add(producer)
+        return resp.generate_response()
+
+    return app
+
+
+def run_stream(app):
+    client = app.test_client()
+    start = time.perf_counter()
+    response = client.post("/chat", json=[], buffered=False)
+    first = None
+    size = 0
+    pieces = 0
+    for piece in response.response:
+        if first is None:
+            first = time.perf_counter()
+        size += len(piece)
+        pieces += 1
+    response.close()
+    return time.perf_counter() - start, first - start, size, pieces
+
+
+def bench_streaming(quick):
+    size = 20000 if quick else 200000
+    results = {}
+    for workload, make_producer in STREAM_WORKLOADS.items():
+        producer, tokens = make_producer(size)
+        for flush_name, flush_policy in [("unbuffered", None), ("coalesced", chatutils.FlushPolicy())]:
+            app = make_app(producer, flush_policy)
+            runs = [run_stream(app) for _ in range(3)]
+            seconds, ttfb, output, pieces = min(runs)
+
+            tracemalloc.start()
+            run_stream(app)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[f"stream.{workload}.{flush_name}"] = {
+                "seconds": seconds,
+                "ttfb_seconds": ttfb,
+                "tokens_per_second": tokens / seconds,
+                "output_bytes": output,
+                "pieces": pieces,
+                "peak_memory_bytes": peak,
+            }
+    return results
+
+
+def bench_sanitize(quick):
+    sanitize = chatutils.Response.__new__(chatutils.Response).sanitize_string
+    text = "".join(CORPUS) * (20 if quick else 200)
+    results = {}
+    for name, tokens in [("char", list(text)), ("word", text.split(" "))]:
+        size = sum(len(t.encode("utf-8", "surrogatepass")) for t in tokens)
+        seconds = min(timeit.repeat(lambda: [sanitize(t) for t in tokens], number=1, repeat=5))
+        results[f"sanitize.{name}"] = {
+            "seconds": seconds,
+            "tokens_per_second": len(tokens) / seconds,
+            "mb_per_second": size / 1e6 / seconds,
+        }
+    return results
+
+
+def bench_pdf(quick):
+    highlights = 500 if quick else 5000
+
+    tracemalloc.start()
+    pdf = make_pdf(highlights=highlights, rects=20, image_bytes=64)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    hits = [dict(h, file_id=f"file{i % 10}") for i, h in enumerate(pdf.highlights_to_dict())]
+
+    def encode():
+        pdf.invalidate()
+        return pdf.to_json_bytes()
+
+    results = {}
+    for name, function in [
+        ("to_dict", pdf.to_dict),
+        ("from_dicts", lambda: chatutils.PDF.from_dicts(hits)),
+        ("to_json_bytes", encode),
+    ]:
+        seconds = min(timeit.repeat(function, number=1, repeat=5))
+        results[f"pdf.{name}"] = {
+            "seconds": seconds,
+            "highlights_per_second": highlights / seconds,
+        }
+    results["pdf.memory"] = {"highlights": highlights, "bytes": memory}
+    return results
+
+
+class MemoryCollection:
+    """ Stands in for a MongoCollection, keeps the inserted documents in a list """
+    full_name = "benchmark.log"
+
+    def __init__(self):
+        self.documents = []
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+
+
+def bench_log(quick):
+    count = 2000 if quick else 20000
+    collection = MemoryCollection()
+    sink = chatutils.LogSink(flush_interval=0.01, max_queue_size=count)
+    document = {
+        "start_timestamp": datetime.datetime.now(),
+        "end_timestamp": datetime.datetime.now(),
+        "input": "question",
+        "output": TEXT * 10,
+        "documents": [],
+    }
+
+    start = time.perf_counter()
+    for _ in range(count):
+        sink.submit(collection, dict(document))
+    submitted = time.perf_counter() - start
+    sink.flush()
+    seconds = time.perf_counter() - start
+    sink.close()
+
+    return {
+        "log.insert": {
+            "seconds": seconds,
+            "documents_per_second": count / seconds,
+            "submit_seconds": submitted / count,
+            "written": len(collection.documents),
+        }
+    }
+
+
+BENCHMARKS = {
+    "streaming": bench_streaming,
+    "sanitize": bench_sanitize,
+    "pdf": bench_pdf,
+    "log": bench_log,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print the changes against a baseline run
+
+    Returns:
+        int -- Number of metrics that got worse by more than the tolerance
+    """
+    regressions = 0
+    print(f"{'benchmark':<34}{'metric':<22}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old or not isinstance(value, float):
+                continue
+            change = value / old - 1
+            # seconds and bytes get worse when they grow, rates when they shrink
+            worse = -change if metric.endswith("per_second") else change
+            flag = ""
+            if worse > tolerance:
+                regressions += 1
+                flag = "  !"
+            print(f"{name:<34}{metric:<22}{old:>12.4g}{value:>12.4g}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="smaller workloads, for CI")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--only", choices=list(BENCHMARKS), action="append", help="run only these benchmarks")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as regression")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results.update(BENCHMARKS[name](args.quick))
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "version": getattr(sys.modules["dashpool_components"], "__version__", None),
+            "json_backend": encoding.get_backend().name,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
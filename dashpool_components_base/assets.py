@@ -0,0 +1,178 @@
+import base64
+import collections
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+# data:image/png;base64,....
+_DATA_URI = re.compile(r"data:(?P<mimetype>[\w.+-]+/[\w.+-]+);base64,(?P<data>[A-Za-z0-9+/=\s]*)\Z")
+
+ASSET_ROUTE = "_dashpool/assets/"
+
+
+class BlobStore:
+    """ A content addressed store for binary assets, like images of chat documents
+
+    Blobs are kept in an in-memory LRU cache and, if a directory is given, also on disk,
+    so they survive the cache and can be shared by several worker processes. Without a
+    directory the store only works for single-process deployments: a blob put by one
+    worker is unknown to the others, so its URL returns 404 there.
+
+    Arguments:
+        max_memory_bytes {int} -- Size of the in-memory LRU cache
+        directory {str} -- Directory of the on-disk backend, None keeps blobs only in memory
+        min_size {int} -- Data URIs shorter than this are left inline
+
+    """
+    def __init__(self, max_memory_bytes=64 * 1024 * 1024, directory=None, min_size=4096):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.min_size = min_size
+        self.url_prefix = "/" + ASSET_ROUTE
+
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def put(self, data, mimetype):
+        """Store a blob
+
+        Arguments:
+            data {bytes} -- The content
+            mimetype {str} -- The mimetype of the content
+
+        Returns:
+            str -- The key, the sha256 of the content with a file extension
+        """
+        extension = mimetypes.guess_extension(mimetype) or ""
+        key = hashlib.sha256(data).hexdigest() + extension
+
+        self._remember(key, data, mimetype)
+
+        if self.directory is not None:
+            path = os.path.join(self.directory, key)
+            if not os.path.exists(path):
+                # write and rename, so readers never see a partial file
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+
+        return key
+
+    def get(self, key):
+        """Load a blob
+
+        Returns:
+            tuple -- (data, mimetype), or None if the key is unknown
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        if self.directory is not None and os.path.basename(key) == key:
+            path = os.path.join(self.directory, key)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    data = f.read()
+                mimetype = mimetypes.guess_type(key)[0] or "application/octet-stream"
+                self._remember(key, data, mimetype)
+                return data, mimetype
+
+        return None
+
+    def _remember(self, key, data, mimetype):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = (data, mimetype)
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, (old_data, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_data)
+
+    def url(self, key):
+        return self.url_prefix + key
+
+    def externalize(self, uri):
+        """Replace a large base64 data URI by the URL of a stored blob
+
+        Arguments:
+            uri {str} -- A URL or data URI
+
+        Returns:
+            str -- The asset URL, or the unchanged uri if it is small or no data URI
+        """
+        if not isinstance(uri, str) or len(uri) < self.min_size or not uri.startswith("data:"):
+            return uri
+
+        match = _DATA_URI.match(uri)
+        if match is None:
+            return uri
+
+        try:
+            data = base64.b64decode(match.group("data"))
+        except ValueError:
+            return uri
+
+        return self.url(self.put(data, match.group("mimetype")))
+
+
+def register_asset_route(app, store=None):
+    """Serve the blobs of a store from the app, call once when the app is set up
+
+    Responses created for this app afterwards replace large data URIs in their
+    documents by URLs of this route. The content is addressed by its hash, so it
+    is served with immutable cache headers.
+
+    Arguments:
+        app {Dash|Flask} -- The app
+        store {BlobStore} -- The store to serve, a new in-memory store if None, which
+            only works for single-process deployments. Pass a BlobStore with a directory
+            shared by all workers, e.g. behind gunicorn with several workers
+
+    Returns:
+        BlobStore -- The store
+    """
+    import dash
+    import flask
+
+    if store is None:
+        store = BlobStore()
+
+    if isinstance(app, dash.Dash):
+        route = app.config.routes_pathname_prefix + ASSET_ROUTE
+        store.url_prefix = app.config.requests_pathname_prefix + ASSET_ROUTE
+        app = app.server
+    else:
+        route = "/" + ASSET_ROUTE
+        store.url_prefix = route
+
+    def serve_asset(key):
+        headers = {
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{key}"',
+        }
+        if flask.request.headers.get("If-None-Match") == headers["ETag"]:
+            return flask.Response(status=304, headers=headers)
+
+        blob = store.get(key)
+        if blob is None:
+            flask.abort(404)
+
+        data, mimetype = blob
+        return flask.Response(data, mimetype=mimetype, headers=headers)
+
+    app.add_url_rule(route + "<key>", "dashpool_asset", serve_asset)
+    app.extensions["dashpool_assets"] = store
+
+    return store
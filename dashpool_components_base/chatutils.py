@@ -1,38 +1,86 @@
 from . document_classes import *
+from .logsink import LogSink, get_log_sink
+from .assets import BlobStore, register_asset_route
+from .compression import CompressionPolicy, StreamCompressor
+from .sessions import SessionStore, Conversation, ConversationMismatch, get_session_store, VERSION_HEADER, document_key
+from .metrics import StreamMetrics, MetricsHook, PrometheusMetrics, set_metrics_hook, get_metrics_hook
+from .profiling import ProfilePolicy
+from .replay import ResponseCache, cache_responses, current_cache, current_handler, get_response_cache
+from .singleflight import SingleFlight, coalesce_requests, current_single_flight, get_single_flight
+from . import encoding
+import asyncio
+import collections
 import datetime
+import functools
+import json
+import logging
+import queue
+import re
+import time
+import types
 
-def get_promtflow_inputs(content):
+logger = logging.getLogger(__name__)
+
+# backslash runs in front of an invalid escape character
+_INVALID_ESCAPE_RUN = re.compile(r'(\\+)[^nurtbf"\\/]')
+# backslash runs that are stripped while invalid escapes are removed
+_STRIPPABLE_ESCAPE_RUN = re.compile(r'(\\+)([^nrtbf"\\/])')
+
+def estimate_tokens(text):
+    """A fast estimate of the number of tokens of a text, about 4 characters per token"""
+    return len(text) // 4 + 1
+
+
+def get_promtflow_inputs(content, max_turns=None, max_tokens=None, token_estimator=estimate_tokens):
     """Extract the query, history and shared data from the content
-    
+
+    Every user message forms a turn with the assistant messages up to the next user message,
+    several assistant messages of a turn are joined. The last user message is the query.
+
     Arguments:
         content {list} -- The content list from the request
-        
+        max_turns {int} -- Keep at most this many of the most recent turns, None keeps all
+        max_tokens {int} -- Keep the most recent turns that fit into this many tokens, None keeps all
+        token_estimator {Callable} -- Estimates the tokens of a text
+
         Returns:
         dict -- The extracted inputs
-        
+
     """
 
     query = ""
-    # get the user query
+    userData = None
+    turns = []
+    replies = None
+
     for el in content:
-        if "role" in el and el["role"] == "user" and "content" in el:
-            query = el["content"]
-
-    # get the history
-    history_user = [
-        el for el in content if "role" in el and el["role"] == "user"]
-    history_assistant = [
-        el for el in content if "role" in el and el["role"] == "assistant"]
-    # skip the last user message
-    history_user = history_user[:-1]
-    # combine the user and assistant messages
-    history = [
-        {"inputs": {"query": el_user["content"]},
-         "outputs": {"reply": el_assistant["content"]}}
-        for el_user, el_assistant in zip(history_user, history_assistant)]
-
-    # get the shared data
-    userData = [el for el in content if "role" in el and el["role"] == "sharedData"][0]
+        role = el.get("role")
+        if role == "user":
+            replies = []
+            turns.append((el.get("content", ""), replies))
+        elif role == "assistant":
+            # assistant messages before the first user message have no turn
+            if replies is not None and "content" in el:
+                replies.append(el["content"])
+        elif role == "sharedData" and userData is None:
+            userData = el
+
+    # the last user message is the query
+    if turns:
+        query = turns.pop()[0]
+
+    history = []
+    tokens = 0
+    for user, replies in reversed(turns):
+        if max_turns is not None and len(history) >= max_turns:
+            break
+        reply = "\n\n".join(replies)
+        if max_tokens is not None:
+            tokens += token_estimator(user) + token_estimator(reply)
+            if tokens > max_tokens:
+                break
+        history.append({"inputs": {"query": user}, "outputs": {"reply": reply}})
+    history.reverse()
 
     return  {
         "query": query,
@@ -41,31 +89,366 @@ def get_promtflow_inputs(content):
     }
 
 
+class FlushPolicy:
+    """ Policy for coalescing streamed tokens into larger chunks
+
+    The first token of every assistant message is always sent right away,
+    later tokens are buffered until one of the limits is reached.
+
+    Arguments:
+        max_bytes {int} -- Flush once the buffered output reaches this size
+        max_delay {float} -- Flush once the oldest buffered token waited this many seconds,
+            None to only flush by size
+
+    """
+    def __init__(self, max_bytes=512, max_delay=0.02):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+
+class CapturePolicy:
+    """ Policy for capturing the streamed output for the log document
+
+    Arguments:
+        max_size {int} -- Characters of output kept for the log document, None keeps everything
+        overflow {str} -- "truncate" drops the output past max_size, "spill" additionally writes
+            the complete output to a temporary file that is referenced in the log document
+        spill_dir {str} -- Directory for the spill files, defaults to the system temp directory
+        checkpoint_interval {float} -- Seconds between partial log documents of a running stream,
+            None only writes the final log document
+        spill_retention {float} -- Seconds a spill file is kept, older ones in spill_dir are deleted
+            when a new one is written. The default matches the expiry of the LogSink TTL index,
+            None keeps them
+
+    """
+    def __init__(self, max_size=1000000, overflow="truncate", spill_dir=None, checkpoint_interval=None,
+                 spill_retention=86400 * 5):
+        if overflow not in ("truncate", "spill"):
+            raise ValueError(f"Unknown overflow {overflow}, use truncate or spill")
+        self.max_size = max_size
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.spill_retention = spill_retention
+        self.checkpoint_interval = checkpoint_interval
+
+
+def _remove_old_spill_files(directory, retention):
+    """Delete the spill files in a directory that were last written more than retention seconds ago"""
+    import glob
+    import os
+    import tempfile
+
+    cutoff = time.time() - retention
+    for path in glob.glob(os.path.join(directory or tempfile.gettempdir(), "dashpool-output-*.txt")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # removed by another process or not ours to remove
+            pass
+
+
+class _OutputCapture:
+    """Collects chunks in a list instead of concatenating strings, bounded by the capture policy
+
+    The output since the last checkpoint is only collected if segments is True, i.e. if
+    checkpoints are written.
+    """
+
+    def __init__(self, policy, segments=False):
+        self.policy = policy
+        self.segments = segments
+        self.size = 0
+        self.truncated = False
+        self.path = None
+        self.checkpoints = 0
+        self.next_checkpoint = None
+
+        self._head = []
+        self._head_size = 0
+        self._segment = []
+        self._segment_size = 0
+        self._file = None
+
+    def write(self, chunk):
+        policy = self.policy
+        self.size += len(chunk)
+
+        if policy.max_size is None or self._head_size + len(chunk) <= policy.max_size:
+            self._head.append(chunk)
+            self._head_size += len(chunk)
+        else:
+            if not self.truncated:
+                self.truncated = True
+                remaining = policy.max_size - self._head_size
+                self._head.append(chunk[:remaining])
+                self._head_size += remaining
+                if policy.overflow == "spill":
+                    self._spill()
+            if self._file is not None:
+                self._file.write(chunk)
+
+        if self.segments:
+            self._segment.append(chunk)
+            self._segment_size += len(chunk)
+
+    def _spill(self):
+        import tempfile
+
+        if self.policy.spill_retention is not None:
+            _remove_old_spill_files(self.policy.spill_dir, self.policy.spill_retention)
+        self._file = tempfile.NamedTemporaryFile(
+            mode="w", encoding="utf-8", prefix="dashpool-output-", suffix=".txt",
+            dir=self.policy.spill_dir, delete=False)
+        self.path = self._file.name
+        # the last head chunk was cut, so the file gets everything written so far
+        self._file.write("".join(self._head[:-1]))
+
+    def segment_full(self):
+        return self.policy.max_size is not None and self._segment_size >= self.policy.max_size
+
+    def take_segment(self):
+        """Return the output since the last checkpoint and release it"""
+        segment = "".join(self._segment)
+        self._segment = []
+        self._segment_size = 0
+        self.checkpoints += 1
+        return segment
+
+    def getvalue(self):
+        if len(self._head) > 1:
+            self._head = ["".join(self._head)]
+        return self._head[0] if self._head else ""
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# mimetypes of the supported wire formats
+WIRE_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+# marks the end of a producer drained by a reader thread
+_DONE = object()
+
+# wakes up the stream that waits for a reader, to write the emitted items
+_WAKE = object()
+
+# marks the end of a coalesced chunk in a compressed stream, the compressor flushes there
+_FLUSH = object()
+
+# a [ref] citation in the text of an assistant message
+_CITATION = re.compile(r"\[([^\[\]\n]{1,100})\]")
+
+
+def _utf16_len(text):
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+class _CitationIndex:
+    """ Finds the [ref] citations in the streamed text of an assistant message
+
+    Offsets and lengths count UTF-16 code units, like the indices of a JavaScript string.
+    A citation followed by "(" is the text of a markdown link and is skipped.
+    """
+    def __init__(self):
+        # the offset of the pending text, which may still become a citation
+        self.offset = 0
+        self.pending = ""
+        self.spans = []
+
+    def feed(self, chunk):
+        """Add a sanitized chunk of the message
+
+        Returns:
+            list -- The new spans [offset, length, ref]
+        """
+        if "\\" in chunk:
+            chunk = json.loads('"' + chunk + '"')
+        if not self.pending and "[" not in chunk:
+            self.offset += _utf16_len(chunk)
+            return []
+        return self._scan(self.pending + chunk, False)
+
+    def finish(self):
+        """The spans of a citation at the end of the message"""
+        return self._scan(self.pending, True) if self.pending else []
+
+    def _scan(self, text, final):
+        # hold back an open "[" or a citation at the end, the next chunk may continue it
+        cut = len(text)
+        start = text.rfind("[")
+        if not final and start != -1 and cut - start <= 102:
+            close = text.find("]", start)
+            if close == -1 or close == cut - 1:
+                cut = start
+
+        spans = []
+        position = 0
+        offset = self.offset
+        for match in _CITATION.finditer(text, 0, cut):
+            if text.startswith("(", match.end()):
+                continue
+            offset += _utf16_len(text[position:match.start()])
+            length = _utf16_len(match.group(0))
+            spans.append([offset, length, match.group(1)])
+            offset += length
+            position = match.end()
+
+        self.offset = offset + _utf16_len(text[position:cut])
+        self.pending = text[cut:]
+        self.spans.extend(spans)
+        return spans
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class _ReaderQueue(queue.Queue):
+    """ The queue of a reader thread, stop() ends the reader after its current item """
+    def __init__(self):
+        super().__init__()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class _AsyncReaderQueue(asyncio.Queue):
+    """ The queue of a reader task, stop() cancels the task """
+    task = None
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
 
 class Response:
     """ A context manager for creating a streaming response object
 
     Arguments:
-        app {Flask} -- The Flask app object
+        app {Flask} -- The Flask app object, can be None if only agenerate_response is used
         logger_collection {MongoCollection} -- The collection to log the response
+        log_sink {LogSink} -- Writes the log documents in the background, defaults to the process wide sink
+        capture_policy {CapturePolicy} -- How much of the output is kept for the log document
+        asset_store {BlobStore} -- Replaces large data URIs of documents by asset URLs, defaults to the
+            store of register_asset_route for the app
         inputs {dict} -- The inputs to the flow
+        flush_policy {FlushPolicy} -- Coalesce tokens into chunks, None sends every token on its own
+        max_concurrency {int} -- Run up to this many callables/generators concurrently, the output
+            keeps the registration order. None runs them one after another
+        producer_timeout {float} -- Seconds a callable/generator may go without producing a token,
+            a stalled one is abandoned and the stream continues with the next. None waits forever
+        metrics_hook {MetricsHook} -- Receives the metrics of the stream, defaults to the process
+            wide hook of set_metrics_hook. The metrics are logged as well
+        profile_policy {ProfilePolicy} -- Profile a sampled fraction of the streams, the summary is
+            added to the log document. None disables profiling
+        response_cache {ResponseCache} -- Replays the recorded stream for the same inputs instead of
+            running the callables/generators, defaults to the cache of cache_responses
+        single_flight {SingleFlight} -- Shares the callables/generators with a running response
+            of the same inputs, defaults to the single flight of coalesce_requests
+        reference_spans {bool} -- Index the [ref] citations of the assistant messages while they
+            are streamed, the client renders the reference popovers from the index. The spans
+            [offset, length, ref] are sent as {"type": "spans", "id": str, "spans": list} frames,
+            the json wire format adds {"role": "spans", ...} elements after each message, so
+            it is off by default, clients that read the array must skip the elements
+        wire_format {str} -- "json" streams one JSON array, "ndjson" and "sse" stream complete
+            frames ({"type": "document" | "event" | "delta" | "done", ...}) one per line or event
+        compression_policy {CompressionPolicy} -- Negotiated gzip/brotli compression of the stream,
+            flushed once per chunk, best combined with a flush_policy, as flushing single tokens
+            makes the stream larger. None or False send the response uncompressed
+        conversation {Conversation} -- The conversation of the request, the assistant messages
+            are added to its session when the stream is complete. Documents without ref get refs
+            that are stable in the conversation, documents sent in an earlier turn are only
+            sent as pointer to the ref the client holds them under
 
     """
-    def __init__(self, app, logger_collection=None, inputs=None):
+
+    def __init__(self, app=None, logger_collection=None, inputs=None, flush_policy=None, max_concurrency=None,
+                 wire_format="json", log_sink=None, capture_policy=None, asset_store=None,
+                 compression_policy=None, conversation=None, producer_timeout=None, metrics_hook=None,
+                 profile_policy=None, response_cache=None, single_flight=None, reference_spans=False):
         import dash
 
         if isinstance(app, dash.Dash):
             app = app.server
 
         self.app = app
+        if asset_store is None and app is not None:
+            asset_store = app.extensions.get("dashpool_assets")
+        self.asset_store = asset_store
         self.callables = []
         self.generators = []
         self.responses = []
         self.logger_collection = logger_collection
+        self.flush_policy = flush_policy
+        self.max_concurrency = max_concurrency
+        self.producer_timeout = producer_timeout
+        self.cleanup_hooks = []
+        self.metrics_hook = metrics_hook if metrics_hook is not None else get_metrics_hook()
+        self.profile_policy = profile_policy
+
+        self.inputs = inputs
+        # part of the keys of the cache and the single flight
+        self._handler = current_handler()
+        self.response_cache = response_cache if response_cache is not None else current_cache()
+        # set if the stream is recorded for the cache
+        self._cache_key = None
+        self._recorded_documents = None
+        self._generated_refs = None
+        self.single_flight = single_flight if single_flight is not None else current_single_flight()
 
-        if logger_collection is not None:
-            # TODO 
-            self.logger_collection.create_index("end_timestamp", expireAfterSeconds=86400 * 5)
+        # the items of emit that are not written yet
+        self._emitted = collections.deque()
+        # the flight the producers of the response run in, emit publishes into it
+        self._flight = None
+        # wakes up the stream while it waits for the next token, set while a reader is read
+        self._wake = None
+        self._doc_counter = 0
+        # the assistant message that is streamed, None between the messages
+        self._message_id = None
+        # a comma is needed before the next element of the json wire format
+        self._separator = False
+        self.reference_spans = reference_spans
+        # the citations of the open assistant message
+        self._citations = None
+        # created when the response starts streaming
+        self.metrics = None
+        self.profiler = None
+
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f"Unknown wire format {wire_format}, use one of {list(WIRE_FORMATS)}")
+        self.wire_format = wire_format
+        self.mimetype = WIRE_FORMATS[wire_format]
+
+        # streaming counters
+        self.tokens_received = 0
+        self.chunks_emitted = 0
+        self.producer_timeouts = 0
+        # set if the client went away before the end of the stream
+        self.aborted = False
+
+        self.capture_policy = capture_policy if capture_policy is not None else CapturePolicy()
+
+        self.compression_policy = compression_policy or None
+        # set by generate_response/agenerate_response
+        self.content_encoding = None
+
+        self.conversation = conversation
+
+        # the sink creates the TTL index once per collection
+        self.log_sink = log_sink
+        if logger_collection is not None and log_sink is None:
+            self.log_sink = get_log_sink()
 
         self.logger_doc = {
             "start_timestamp": datetime.datetime.now(),
@@ -77,6 +460,10 @@ class Response:
             if "query" in inputs and "input" not in self.logger_doc:
                 self.logger_doc["input"] = inputs["query"]
 
+        if conversation is not None and conversation.id is not None:
+            self.logger_doc["conversation_id"] = conversation.id
+            self.logger_doc["conversation_version"] = conversation.version
+
 
 
     def __ensure_id(self, el):
@@ -91,126 +478,1208 @@ class Response:
         pass
 
     def add(self, response):
-        import types
-
         if callable(response):
             self.callables.append(response)
-        elif isinstance(response, types.GeneratorType):
+        elif isinstance(response, (types.GeneratorType, types.AsyncGeneratorType)):
             self.generators.append(response)
         else:
             self.responses.append(response)
 
-        if self.logger_collection is not None:
-            if isinstance(response, document_classes):
-                el = response.to_dict()
-                self.logger_doc["documents"].append(el)
-
     def log(self, ref, data):
         self.logger_doc[ref] = data
 
+    def add_cleanup(self, hook):
+        """Register a function that is called without arguments when the stream ends,
+        also if the client went away or a callable/generator failed
+
+        Arguments:
+            hook {Callable} -- The cleanup function, e.g. closing an LLM client session
+        """
+        self.cleanup_hooks.append(hook)
+
+    def _run_cleanup(self):
+        for hook in self.cleanup_hooks:
+            try:
+                hook()
+            except Exception:
+                logger.exception("Cleanup hook of the chat response failed")
+
 
     def sanitize_string(self, input: str) -> str:
         """Sanitize a string by removing invalid escape sequences, non-printable characters,
-        and ensuring valid Unicode encoding."""
-        import re
-        import string
-        import json
+        and ensuring valid Unicode encoding.
+
+        Equivalent to repeatedly stripping the backslash of invalid escapes (like \\y, \\4)
+        until none are left, but done in one pass over the JSON escaped string: every pass
+        shortens each backslash run in front of an invalid escape by one, so all of these
+        runs vanish and runs in front of a "u" lose as many backslashes as the longest
+        invalid run had."""
+
+        # plain printable ascii tokens are the common case and need no escaping
+        if input.isascii() and input.isprintable() and '"' not in input and "\\" not in input:
+            return input
 
         # Convert input to JSON string, to escape special characters
-        input = json.dumps(input)[1:-1]
+        input = json.encoder.encode_basestring_ascii(input)[1:-1]
 
-        def inner_sanitize_string(item: str) -> str:
-            found = False
+        if "\\" not in input:
+            return input
 
-            # Iteratively remove invalid escape sequences (like \y, \g, etc.)
-            while re.search(r'\\([^nurtbf\"\\/])', item):
-                item = re.sub(r'\\([^nrtbf\"\\/])', r'\1', item)
-                found = True
+        depth = max(map(len, _INVALID_ESCAPE_RUN.findall(input)), default=0)
+        if depth == 0:
+            return input
 
-            # Iteratively remove backslash escapes for numbers (\4, \5)
-            while re.search(r'\\[0-9]', item):
-                item = re.sub(r'\\([0-9])', r'\1', item)
-                found = True
-            
-            return item, found
-        
+        def strip(match):
+            run, char = match.groups()
+            return run[depth:] + char if char == "u" else char
 
-        # Iteratively remove invalid escape sequences
-        found = True
-        while found:
-            input, found = inner_sanitize_string(input)
+        return _STRIPPABLE_ESCAPE_RUN.sub(strip, input)
 
-        return input
+    def _sanitize(self, item):
+        start = time.perf_counter()
+        item = self.sanitize_string(item)
+        self.metrics.sanitize_seconds += time.perf_counter() - start
+        return item
 
-    def generate_response(self):
-        import json
-        import uuid
-        import time
-        import string
+    def has_async_producers(self):
+        """Check if any registered callable or generator is asynchronous
 
-        def generator():
+        Returns:
+            bool -- True if the response has to be streamed with agenerate_response
+        """
+        import inspect
+
+        for g in self.callables:
+            if inspect.iscoroutinefunction(g) or inspect.isasyncgenfunction(g):
+                return True
+        for g in self.generators:
+            if isinstance(g, types.AsyncGeneratorType):
+                return True
+        return False
 
-            doc_counter = 0
+    def _frame(self, frame):
+        """Wrap a JSON encoded frame (str or bytes) for the ndjson or sse wire format"""
+        if isinstance(frame, bytes):
+            if self.wire_format == "sse":
+                return b"data: " + frame + b"\n\n"
+            return frame + b"\n"
+        if self.wire_format == "sse":
+            return "data: " + frame + "\n\n"
+        return frame + "\n"
 
+    def _generate_documents(self):
+        """Yield the stream prefix and the documents, the documents as utf-8 bytes"""
+        if self.wire_format == "json":
             yield "[\n"
-            for response in self.responses:
+        for response in self.responses:
+            encoded = self._encode_document(response)
+            if self.wire_format == "json":
+                yield encoded + b"\n,\n"
+            else:
+                yield self._document_frame(response, encoded)
+
+    def _register_reference(self, response):
+        """Register a document with the conversation session, documents without ref get
+        one that is stable across the turns of the conversation
+
+        Returns:
+            str -- The ref under which the client already holds the same document, None
+                if the document has to be sent
+        """
+        if not self._sessions_enabled() or isinstance(response, (DashpoolEvent, NodeChangeEvent)):
+            return None
+
+        is_document = isinstance(response, document_classes)
+        if not is_document and ("ref" not in response or response.get("role") in ("dashpoolEvent", "nodeChangeEvent")):
+            return None
+
+        # documents hash their cached encoding, which is kept when the ref is set
+        key = response.content_key() if is_document else document_key(response)
+        target = self.conversation.reference(key)
+
+        ref = response.ref if is_document else response.get("ref")
+        if ref is None:
+            ref = target if target is not None else self.conversation.new_ref()
+            if is_document:
+                response.ref = ref
+            else:
+                response["ref"] = ref
+
+        self.conversation.register(key, ref)
+        return target
+
+    def _reference_pointer(self, ref, target):
+        """The item that tells the client to show the document it holds as target under ref"""
+        import uuid
+
+        return encoding.dumpb({"role": "refPointer", "ref": ref, "target": target, "id": str(uuid.uuid4())})
+
+    def _encode_document(self, response):
+        """Serialize a document, event or dict, sets its ref and id if they are missing
+
+        With a conversation session, documents the client already received are sent as
+        {"role": "refPointer", "ref": str, "target": str, "id": str} instead.
+
+        Returns:
+            bytes -- The JSON encoding
+        """
+        import uuid
+
+        if isinstance(response, document_classes):
+            if self.asset_store is not None:
+                response.externalize_assets(self.asset_store)
 
-                # check if reference of doc class is set
-                if isinstance(response, document_classes):
-                    if response.ref is None:
-                        response.ref = "doc" + str(doc_counter)
-                        doc_counter = doc_counter + 1
-                
+            generated = response.ref is None
+            target = self._register_reference(response)
 
-                # first make a dict
-                response_dict = response.to_dict() if isinstance(response, document_classes) else response
+            # check if reference of doc class is set
+            if response.ref is None:
+                response.ref = "doc" + str(self._doc_counter)
+                self._doc_counter = self._doc_counter + 1
 
+            if self._recorded_documents is not None:
+                self._record_document(response.cached_dict(), generated)
+
+            start = time.perf_counter()
+
+            # the document is serialized once, the log shares the cached dict
+            if self.logger_collection is not None:
+                self.logger_doc["documents"].append(response.cached_dict())
+
+            if target is not None:
+                encoded = self._reference_pointer(response.ref, target)
+            else:
+                encoded = response.to_json_bytes()
+
+                # add the id without changing the cached encoding, events bring their own
+                if not hasattr(response, "id"):
+                    encoded = encoded[:-1] + f', "id": "{uuid.uuid4()}"}}'.encode("utf-8")
+        else:
+            generated = "ref" in response and response["ref"] is None
+            target = self._register_reference(response)
+
+            if self._recorded_documents is not None:
+                self._record_document(response, generated)
+
+            start = time.perf_counter()
+            if target is not None:
+                encoded = self._reference_pointer(response["ref"], target)
+            else:
                 # add the id
-                self.__ensure_id(response_dict)
+                self.__ensure_id(response)
+                encoded = encoding.dumpb(response)
 
-                # then dump it to json
-                yield json.dumps(response_dict) + "\n,\n"
+        self.metrics.serialize_seconds += time.perf_counter() - start
+        return encoded
 
-            output_str = ""
+    def _document_frame(self, response, encoded):
+        kind = b"event" if isinstance(response, (DashpoolEvent, NodeChangeEvent)) else b"document"
+        return self._frame(b'{"type": "' + kind + b'", "data": ' + encoded + b'}')
 
-            first = True
+    def _open_message(self):
+        """Start a new assistant message, the deltas go into it until it is closed"""
+        import uuid
 
-            for g in self.callables:
-                if not first:
-                    yield ",\n"
-                first = False
-                id = str(uuid.uuid4())
-                yield f'{{"role": "assistant", "id": "{id}" , "content": "'
-                for item in g():
-                    # we need to escape single quotes and newlines
-                    item = self.sanitize_string(item)
-                    output_str += item
-                    yield item
-                yield '"}\n'
+        self._message_id = id = str(uuid.uuid4())
+        if self.reference_spans:
+            self._citations = _CitationIndex()
+        if self.wire_format == "json":
+            return ("" if not self._separator else ",\n") + f'{{"role": "assistant", "id": "{id}" , "content": "'
+        # an empty delta creates the message on the client
+        return self._assistant_delta(id, "")
+
+    def _assistant_delta(self, id, chunk):
+        # chunks are already escaped by sanitize_string
+        if self.wire_format == "json":
+            return chunk
+        return self._frame(f'{{"type": "delta", "id": "{id}", "text": "{chunk}"}}')
+
+    def _index_citations(self, chunk):
+        """Index the citations of a chunk of the open message
+
+        Returns:
+            str -- The frame with the new spans, None if there are none or the wire format
+                sends them after the message
+        """
+        spans = self._citations.feed(chunk)
+        if spans and self.wire_format != "json":
+            return self._spans_frame(self._message_id, spans)
+        return None
+
+    def _spans_frame(self, id, spans):
+        return self._frame(encoding.dumps({"type": "spans", "id": id, "spans": spans}))
+
+    def _close_message(self):
+        """Close the open assistant message
+
+        Returns:
+            str -- The closing piece, empty for the frame wire formats without spans
+        """
+        id, citations = self._message_id, self._citations
+        self._message_id = None
+        self._citations = None
+        self._separator = True
+
+        if self.wire_format != "json":
+            spans = citations.finish() if citations is not None else None
+            return self._spans_frame(id, spans) if spans else ""
+
+        piece = '"}\n'
+        if citations is not None:
+            citations.finish()
+            if citations.spans:
+                piece += ",\n" + encoding.dumps({"role": "spans", "id": id, "spans": citations.spans}) + "\n"
+        return piece
+
+    def emit(self, item):
+        """Write a document, event or dict into the running stream, e.g. from a generator
+        as soon as the retrieval finished, while the text is streamed
+
+        Can be called from any thread. If the tokens are read from a reader thread/task (a
+        flush_policy with max_delay, producer_timeout or max_concurrency), the item is written
+        right away, otherwise before the next chunk of text or when the current
+        callable/generator ends. Hidden items (references with show False
+        and events) are written inside the assistant message that is streamed, for the other
+        ones the message is continued in a new message after the item. The json wire format
+        cannot interrupt the content of the open message, it writes the items after it.
+        Items of callables/generators that are shared by a SingleFlight are written into every
+        response that shares them.
+
+        Arguments:
+            item {Document|DashpoolEvent|NodeChangeEvent|dict} -- The item, like for add
+        """
+        flight = self._flight
+        if flight is not None and flight.emit(item):
+            # comes back through the subscription, see _join_flight
+            return
+        self._push_emitted(item)
+
+    def _push_emitted(self, item):
+        self._emitted.append(item)
+        wake = self._wake
+        if wake is not None:
+            wake()
+
+    def _is_hidden(self, item):
+        data = item.cached_dict() if isinstance(item, document_classes) else item
+        return data.get("show") is False or data.get("role") in ("dashpoolEvent", "nodeChangeEvent")
+
+    def _flush_emitted(self):
+        """The pieces that write the emitted items into the stream"""
+        if self.wire_format == "json" and self._message_id is not None:
+            # held back until the message is closed, one answer stays one message
+            return []
+
+        pieces = []
+        reopen = False
+        while self._emitted:
+            item = self._emitted.popleft()
+            encoded = self._encode_document(item)
+
+            if self._message_id is not None and not self._is_hidden(item):
+                # the rest of the text goes into a new message after the item
+                piece = self._close_message()
+                if piece:
+                    pieces.append(piece)
+                reopen = True
+
+            if self.wire_format == "json":
+                pieces.append((b",\n" if self._separator else b"") + encoded + b"\n")
+                self._separator = True
+            else:
+                pieces.append(self._document_frame(item, encoded))
+
+        if reopen:
+            pieces.append(self._open_message())
+        return pieces
+
+    def _stream_end(self):
+        return "]" if self.wire_format == "json" else self._frame('{"type": "done"}')
+
+    def response_headers(self):
+        """The headers to send with the stream, needed if agenerate_response is used
+
+        Returns:
+            dict -- The headers
+        """
+        headers = {}
+        if self.wire_format == "sse":
+            headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        if self.compression_policy is not None:
+            headers["Vary"] = "Accept-Encoding"
+        if self.content_encoding is not None:
+            headers["Content-Encoding"] = self.content_encoding
+        if self._sessions_enabled():
+            headers[VERSION_HEADER] = str(self.conversation.next_version)
+        return headers
 
+    def _sessions_enabled(self):
+        return self.conversation is not None and self.conversation.id is not None
+
+    def _keeps_replies(self):
+        return self._sessions_enabled() or self._cache_key is not None
+
+    def _decode_reply(self, chunks):
+        # the chunks are escaped JSON string content, decode them like the client does
+        return json.loads('"' + "".join(chunks) + '"')
+
+    def _commit_conversation(self, replies):
+        """Add the assistant messages to the conversation session and record the stream
+        for the response cache
+
+        Arguments:
+            replies {list} -- The sanitized chunks of every callable/generator
+        """
+        if not self._keeps_replies():
+            return
+
+        replies = [self._decode_reply(chunks) for chunks in replies]
+
+        if self._sessions_enabled():
+            self.conversation.commit([{"role": "assistant", "content": reply} for reply in replies])
+
+        if self._cache_key is not None and self.producer_timeouts == 0:
+            self.response_cache.set(self._cache_key, self._recorded_documents, replies, self._generated_refs)
+
+    def _record_document(self, document, generated):
+        # the ids are the ones of the events, the documents get fresh ones when they are sent
+        self._recorded_documents.append(dict(document))
+        if generated:
+            self._generated_refs.append(document["ref"])
+
+    def _replay_refs(self, documents, generated_refs):
+        """Give the documents whose refs were assigned by the recorded response the refs of
+        this conversation, like a live response would
+
+        Returns:
+            dict -- The recorded refs mapped to the new ones
+        """
+        refs = {}
+        if not self._sessions_enabled():
+            return refs
+
+        generated_refs = set(generated_refs)
+        for document in documents:
+            ref = document.get("ref")
+            if ref in generated_refs and ref not in refs:
+                target = self.conversation.reference(document_key(document))
+                refs[ref] = target if target is not None else self.conversation.new_ref()
+            if ref in refs:
+                document["ref"] = refs[ref]
+        return refs
+
+    def _replay_cached(self):
+        """On a cache hit, replace the documents and producers by the recorded stream,
+        on a miss prepare the recording
+
+        Returns:
+            bool -- True on a cache hit
+        """
+        if self.response_cache is None:
+            return
+
+        key = self.response_cache.key(self.inputs, self._handler)
+        if key is None:
+            return
+
+        entry = self.response_cache.get(key)
+        if entry is None:
+            self._cache_key = key
+            self._recorded_documents = []
+            self._generated_refs = []
+            return
+
+        # the registered producers are never started
+        for g in self.generators:
+            if isinstance(g, types.GeneratorType):
+                g.close()
+
+        # copies, the stream adds fresh ids
+        self.responses = [dict(document) for document in entry["documents"]]
+        refs = self._replay_refs(self.responses, entry.get("generated_refs", ()))
+
+        def cite(match):
+            ref = match.group(1)
+            return "[" + refs[ref] + "]" if ref in refs else match.group(0)
+
+        replies = [_CITATION.sub(cite, reply) if refs else reply for reply in entry["replies"]]
+        self.callables = [lambda reply=reply: iter([reply]) for reply in replies]
+        self.generators = []
+        self.logger_doc["cached"] = True
+        return True
+
+    def _join_flight(self):
+        """Replace the producers by the ones of a running response with the same inputs,
+        or share them with the responses that arrive while they run"""
+        if self.single_flight is None or self.has_async_producers():
+            return
+
+        producers = self.callables + self.generators
+        if not producers or (self.max_concurrency is not None and len(producers) > 1):
+            return
+
+        key = self.single_flight.key(self.inputs, self._handler)
+        if key is None:
+            return
+
+        subscription, leader = self.single_flight.join(key, producers, start=False)
+        subscription.on_emit = self._push_emitted
+        if leader:
+            # set before the producers can emit
+            self._flight = subscription.flight
+            self._flight.start()
+        else:
+            # the producers of the running response are streamed instead
             for g in self.generators:
-                if not first:
-                    yield ",\n"
-                first = False
-                id = str(uuid.uuid4())
-                yield f'{{"role": "assistant", "id": "{id}" , "content": "'
-                for item in g:
-                    # we need to escape single quotes and newlines
-                    item = self.sanitize_string(item)
-
-                    output_str += item
-                    yield item
-                yield '"}\n'
+                if isinstance(g, types.GeneratorType):
+                    g.close()
+
+        self.callables = []
+        self.generators = [subscription.producer(i) for i in range(subscription.count)]
+        self.add_cleanup(subscription.close)
+        self.logger_doc["single_flight"] = "leader" if leader else "follower"
+        if self.profiler is not None:
+            # the producers run in the thread of the flight
+            self.profiler.complete = False
+
+    def _negotiate_compression(self, accept_encoding):
+        """Pick the content coding of the response and set content_encoding
+
+        If the client accepts compression, the documents are serialized up front, as
+        responses with only small documents are sent uncompressed. Streams are compressed
+        once min_size bytes were sent.
+
+        Returns:
+            Iterable -- The stream prefix and the documents
+        """
+        self.content_encoding = None
+        documents = self._generate_documents()
+
+        policy = self.compression_policy
+        streaming = bool(self.callables or self.generators)
+        encoding = policy.negotiate(accept_encoding, streaming) if policy is not None else None
+        if encoding is None:
+            return documents
+
+        prefix = b"".join(d if isinstance(d, bytes) else d.encode("utf-8") for d in documents)
+        if streaming or len(prefix) >= policy.min_size:
+            self.content_encoding = encoding
+            return [prefix, _FLUSH]
+        return [prefix]
 
+    def _new_compressor(self):
+        policy = self.compression_policy
+        min_size = policy.min_size if self.callables or self.generators else 0
+        return StreamCompressor(self.content_encoding, policy, min_size)
 
-            yield "]"
+    def _compress(self, stream):
+        compressor = self._new_compressor()
+        try:
+            for piece in stream:
+                piece = compressor.flush() if piece is _FLUSH else compressor.compress(piece)
+                if piece:
+                    yield piece
+            yield compressor.finish()
+        finally:
+            # passes on the close of an aborted response
+            stream.close()
 
+    async def _acompress(self, stream):
+        compressor = self._new_compressor()
+        try:
+            async for piece in stream:
+                piece = compressor.flush() if piece is _FLUSH else compressor.compress(piece)
+                if piece:
+                    yield piece
+            yield compressor.finish()
+        finally:
+            await stream.aclose()
+
+    def _new_capture(self):
+        import uuid
+
+        # checkpoints are only written to a log collection
+        checkpoints = self.logger_collection is not None and self.capture_policy.checkpoint_interval is not None
+        capture = _OutputCapture(self.capture_policy, segments=checkpoints)
+        if checkpoints:
+            self.logger_doc["stream_id"] = str(uuid.uuid4())
+            capture.next_checkpoint = time.monotonic() + self.capture_policy.checkpoint_interval
+        return capture
+
+    def _capture(self, capture, chunk):
+        """Add a chunk to the captured output and write a checkpoint if it is due"""
+        capture.write(chunk)
+
+        if not capture.segments:
+            return
+
+        if capture.segment_full() or time.monotonic() >= capture.next_checkpoint:
+            capture.next_checkpoint = time.monotonic() + self.capture_policy.checkpoint_interval
+            self._checkpoint(capture)
+
+    def _checkpoint(self, capture):
+        """Log the output since the last checkpoint as a partial document of the stream"""
+        self.log_sink.submit(self.logger_collection, {
+            "stream_id": self.logger_doc["stream_id"],
+            "checkpoint": capture.checkpoints,
+            "output": capture.take_segment(),
+            "output_size": capture.size,
+            "start_timestamp": self.logger_doc["start_timestamp"],
+            "end_timestamp": datetime.datetime.now()
+        })
+
+    def _start_profile(self):
+        """Sample if the stream is profiled and start profiling
+
+        Returns:
+            StreamProfiler -- The profiler, None if the stream is not profiled
+        """
+        if self.profile_policy is None:
+            return None
+        self.profiler = self.profile_policy.sample()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self.profiler
+
+    def _write_log(self, capture):
+        import uuid
+
+        capture.close()
+
+        if self.profiler is not None:
+            profile = self.profiler.finish(self.logger_doc.get("stream_id") or str(uuid.uuid4()))
             if self.logger_collection is not None:
-                self.logger_doc["output"] = output_str
-                self.logger_doc["end_timestamp"] = datetime.datetime.now()
-                self.logger_collection.insert_one(self.logger_doc)
+                self.logger_doc.update(profile)
+
+        if self.aborted:
+            status = "aborted"
+        elif "error" in self.logger_doc:
+            status = "error"
+        else:
+            status = "completed"
+        metrics = self.metrics.to_dict(self.tokens_received, self.chunks_emitted, status)
+        log_enqueue_seconds = None
+
+        if self.logger_collection is not None:
+            start = time.perf_counter()
+            if capture.checkpoints:
+                # the rest of the output, so the checkpoints hold the complete stream
+                self._checkpoint(capture)
+            self.logger_doc["output"] = capture.getvalue()
+            if capture.truncated:
+                self.logger_doc["output_truncated"] = True
+                self.logger_doc["output_size"] = capture.size
+            if capture.path is not None:
+                self.logger_doc["output_file"] = capture.path
+            if capture.checkpoints:
+                self.logger_doc["checkpoints"] = capture.checkpoints
+            self.logger_doc["stream"] = {
+                "tokens": self.tokens_received,
+                "chunks": self.chunks_emitted,
+                "timeouts": self.producer_timeouts
+            }
+            if self.aborted:
+                self.logger_doc["aborted"] = True
+            self.logger_doc["metrics"] = metrics
+            self.logger_doc["end_timestamp"] = datetime.datetime.now()
+            self.log_sink.submit(self.logger_collection, self.logger_doc)
+            # the document is written later by the sink, PrometheusMetrics exports its insert latency
+            log_enqueue_seconds = time.perf_counter() - start
+
+        try:
+            self.metrics_hook.observe(dict(metrics, log_enqueue_seconds=log_enqueue_seconds))
+        except Exception:
+            logger.exception("Metrics hook of the chat response failed")
+
+    def _start_reader(self, items, executor=None):
+        """Drain items into a queue, in a new thread or on the given executor
+
+        Returns:
+            _ReaderQueue -- The queue receiving the items
+        """
+        import threading
+
+        q = _ReaderQueue()
+
+        def reader():
+            iterator = None
+            try:
+                if not q.stopped:
+                    iterator = items() if callable(items) else items
+                    for item in iterator:
+                        if q.stopped:
+                            break
+                        q.put(item)
+            except Exception as e:
+                q.put(_ProducerError(e))
+            finally:
+                # the stream was aborted or timed out, close the producer in this thread
+                if q.stopped and hasattr(iterator, "close"):
+                    iterator.close()
+            q.put(_DONE)
+
+        target = reader
+        if self.profiler is not None:
+            target = functools.partial(self.profiler.call, reader)
+
+        if executor is None:
+            threading.Thread(target=target, daemon=True).start()
+        else:
+            executor.submit(target)
+        return q
+
+    def _read_queue(self, q, timeout=None):
+        """Yield the items of a reader queue, or None when nothing arrived within the
+        wait time that is sent into the generator or an emit woke it up
+
+        Arguments:
+            q {queue.Queue} -- The queue
+            timeout {float} -- The wait time for the first item
+        """
+        while True:
+            try:
+                item = q.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _WAKE:
+                item = None
+            if item is _DONE:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.exception
+            timeout = yield item
+
+    def _chunks(self, items):
+        """Sanitize the tokens of a producer and coalesce them according to the flush policy
+
+        Yields None when items were emitted while waiting for a reader.
+
+        Arguments:
+            items {Iterable|queue.Queue} -- The tokens, or the queue of a started reader
+        """
+        policy = self.flush_policy
+        timeout = self.producer_timeout
+
+        reader = None
+        if isinstance(items, queue.Queue):
+            reader = items
+        elif timeout is not None or (policy is not None and policy.max_delay is not None):
+            reader = self._start_reader(items)
+        if reader is not None:
+            items = self._read_queue(reader, timeout)
+            self._wake = lambda: reader.put(_WAKE)
+
+        try:
+            if policy is None and timeout is None:
+                for item in items:
+                    self.tokens_received += 1
+                    self.chunks_emitted += 1
+                    yield self._sanitize(item)
+                return
+
+            max_bytes = policy.max_bytes if policy is not None else 0
+            max_delay = policy.max_delay if policy is not None else None
+
+            if reader is not None:
+                source = items
+                item = next(source, _DONE)
+            else:
+                source = None
+                items = iter(items)
+                item = next(items, _DONE)
+
+            buffer = []
+            size = 0
+            deadline = None
+            first = True
+            last_item = time.monotonic()
+
+            while item is not _DONE:
+                if item is not None:
+                    last_item = time.monotonic()
+                    item = self._sanitize(item)
+                    self.tokens_received += 1
+
+                    if first:
+                        # keep the time to first token
+                        first = False
+                        self.chunks_emitted += 1
+                        yield item
+                    else:
+                        buffer.append(item)
+                        size += len(item)
+                        if deadline is None and max_delay is not None:
+                            deadline = time.monotonic() + max_delay
+                elif timeout is not None and time.monotonic() - last_item >= timeout:
+                    # the producer stalled, the reader is stopped in the finally block
+                    self.producer_timeouts += 1
+                    break
+                elif self._emitted:
+                    yield None
+
+                if buffer and (size >= max_bytes or (deadline is not None and time.monotonic() >= deadline)):
+                    self.chunks_emitted += 1
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+                    deadline = None
+
+                if source is None:
+                    item = next(items, _DONE)
+                else:
+                    wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    if timeout is not None:
+                        stall = max(last_item + timeout - time.monotonic(), 0)
+                        wait = stall if wait is None else min(wait, stall)
+                    try:
+                        item = source.send(wait)
+                    except StopIteration:
+                        item = _DONE
+
+            if buffer:
+                self.chunks_emitted += 1
+                yield "".join(buffer)
+        finally:
+            self._wake = None
+            # no-op if the producer is exhausted, stops it if the stream was aborted
+            if reader is not None:
+                reader.stop()
+            elif hasattr(items, "close"):
+                items.close()
+
+    def _stop_producers(self, producers, chunks=None):
+        """Stop the producer that is streamed and the ones that did not start yet"""
+        if chunks is not None:
+            chunks.close()
+        for producer in producers:
+            if isinstance(producer, _ReaderQueue):
+                producer.stop()
+            elif isinstance(producer, types.GeneratorType):
+                try:
+                    producer.close()
+                except ValueError:
+                    # it is running in a reader thread, which closes it
+                    pass
+
+    def generate_response(self):
+        """Create the streaming Flask response
+
+        If the client goes away, the WSGI server closes the response. The running
+        callable/generator is then closed, the remaining ones are not started, and the
+        stream is logged as aborted. The cleanup hooks run at the end of every stream.
+
+        Returns:
+            flask.Response -- The streaming response
+        """
+        if self.has_async_producers():
+            raise TypeError(
+                "Response contains async generators or callables, use agenerate_response() instead")
+
+        import flask
+
+        self.metrics = metrics = StreamMetrics()
+        profiler = self._start_profile()
+        self._replay_cached() or self._join_flight()
+        accept_encoding = flask.request.headers.get("Accept-Encoding") if flask.has_request_context() else None
+        documents = self._negotiate_compression(accept_encoding)
+        if profiler is not None:
+            profiler.disable()
+        keep_replies = self._keeps_replies()
+
+        def generator():
+            import concurrent.futures
+
+            producers = self.callables + self.generators
+            executor = None
+            chunks = None
+            completed = False
+            capture = self._new_capture()
+
+            try:
+                for piece in documents:
+                    yield piece if piece is _FLUSH else metrics.sent(piece)
+
+                if self.max_concurrency is not None and len(producers) > 1:
+                    # start all producers at once, their output is buffered
+                    # in the reader queues until it is their turn
+                    executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=min(self.max_concurrency, len(producers)))
+                    producers = [self._start_reader(g, executor) for g in producers]
+
+                replies = []
+
+                for g in producers:
+                    texts = []
+                    replies.append(texts)
+                    metrics.producer_started(self.tokens_received, self.producer_timeouts)
+                    chunks = self._chunks(g() if callable(g) else g)
+                    for chunk in chunks:
+                        if self._emitted:
+                            for piece in self._flush_emitted():
+                                yield metrics.sent(piece)
+                        if chunk is None:
+                            # woken up to write the emitted items
+                            if self.content_encoding is not None:
+                                yield _FLUSH
+                            continue
+                        metrics.chunk()
+                        if self._message_id is None:
+                            # opened with the first chunk, items emitted before it go first
+                            yield metrics.sent(self._open_message())
+                        self._capture(capture, chunk)
+                        if keep_replies:
+                            texts.append(chunk)
+                        yield metrics.sent(self._assistant_delta(self._message_id, chunk))
+                        if self._citations is not None:
+                            piece = self._index_citations(chunk)
+                            if piece is not None:
+                                yield metrics.sent(piece)
+                        if self.content_encoding is not None:
+                            yield _FLUSH
+                    metrics.producer_finished(self.tokens_received, self.producer_timeouts)
+                    if self._message_id is None:
+                        yield metrics.sent(self._open_message())
+                    piece = self._close_message()
+                    if piece:
+                        yield metrics.sent(piece)
+                    for piece in self._flush_emitted():
+                        yield metrics.sent(piece)
+                    if self.content_encoding is not None:
+                        yield _FLUSH
+
+                # emitted after the last chunk
+                for piece in self._flush_emitted():
+                    yield metrics.sent(piece)
+
+                # before the end of the stream, the client may send the next message right after it
+                self._commit_conversation(replies)
+
+                yield metrics.sent(self._stream_end())
+                completed = True
+            except GeneratorExit:
+                # the server closes the response if the client went away or a write failed
+                self.aborted = True
+                raise
+            except Exception as e:
+                self.logger_doc["error"] = repr(e)
+                raise
+            finally:
+                if not completed:
+                    self._stop_producers(producers, chunks)
+                if executor is not None:
+                    executor.shutdown(wait=False)
+                self._write_log(capture)
+                self._run_cleanup()
+
+        stream = generator()
+        if self.content_encoding is not None:
+            stream = self._compress(stream)
+        if profiler is not None:
+            stream = profiler.wrap(stream)
+
+        return self.app.response_class(stream, mimetype=self.mimetype, headers=self.response_headers())
+
+    async def _aiterate(self, producer):
+        """Iterate over a sync or async producer without blocking the event loop"""
+        import inspect
+
+        if callable(producer):
+            producer = producer()
+            if inspect.isawaitable(producer):
+                producer = await producer
+
+        if isinstance(producer, str):
+            yield producer
+        elif hasattr(producer, "__aiter__"):
+            try:
+                async for item in producer:
+                    yield item
+            finally:
+                if hasattr(producer, "aclose"):
+                    await producer.aclose()
+        else:
+            # sync iterators may block (e.g. a sync LLM client), so they are
+            # advanced in the default executor
+            loop = asyncio.get_running_loop()
+            iterator = iter(producer)
+            try:
+                while True:
+                    if self.profiler is not None:
+                        item = await loop.run_in_executor(None, self.profiler.call, next, iterator, _DONE)
+                    else:
+                        item = await loop.run_in_executor(None, next, iterator, _DONE)
+                    if item is _DONE:
+                        break
+                    yield item
+            finally:
+                if hasattr(iterator, "close"):
+                    try:
+                        iterator.close()
+                    except ValueError:
+                        # still running in the executor, it is not advanced any more
+                        pass
+
+    async def _aread_queue(self, q):
+        while True:
+            item = await q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.exception
+            yield item
+
+    def _astart_reader(self, producer, semaphore):
+        """Drain a producer into an asyncio queue in a separate task
+
+        Returns:
+            _AsyncReaderQueue -- The queue receiving the items, stop() cancels the task
+        """
+        q = _AsyncReaderQueue()
+
+        async def reader():
+            async with semaphore:
+                try:
+                    async for item in self._aiterate(producer):
+                        q.put_nowait(item)
+                except Exception as e:
+                    q.put_nowait(_ProducerError(e))
+                q.put_nowait(_DONE)
+
+        q.task = asyncio.ensure_future(reader())
+        return q
+
+    async def _achunks(self, producer):
+        """Async version of _chunks, emit wakes it up with an event
+
+        Arguments:
+            producer {Any} -- The producer, or the asyncio queue of a started reader
+        """
+        policy = self.flush_policy
+        timeout = self.producer_timeout
+
+        if isinstance(producer, asyncio.Queue):
+            items = self._aread_queue(producer)
+        else:
+            items = self._aiterate(producer)
+
+        pending = None
+        woken = None
+
+        try:
+            if policy is None and timeout is None:
+                async for item in items:
+                    self.tokens_received += 1
+                    self.chunks_emitted += 1
+                    yield self._sanitize(item)
+                return
+
+            max_bytes = policy.max_bytes if policy is not None else 0
+            max_delay = policy.max_delay if policy is not None else None
+
+            buffer = []
+            size = 0
+            deadline = None
+            first = True
+            last_item = time.monotonic()
+
+            wake = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            self._wake = lambda: loop.call_soon_threadsafe(wake.set)
+
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(items.__anext__())
+                if woken is None:
+                    woken = asyncio.ensure_future(wake.wait())
+
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if timeout is not None:
+                    stall = max(last_item + timeout - time.monotonic(), 0)
+                    wait = stall if wait is None else min(wait, stall)
+                done, _ = await asyncio.wait({pending, woken}, timeout=wait,
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                if woken in done:
+                    wake.clear()
+                    woken = None
+                    if self._emitted:
+                        yield None
+
+                if pending in done:
+                    try:
+                        item = pending.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        pending = None
+
+                    last_item = time.monotonic()
+                    item = self._sanitize(item)
+                    self.tokens_received += 1
+
+                    if first:
+                        # keep the time to first token
+                        first = False
+                        self.chunks_emitted += 1
+                        yield item
+                    else:
+                        buffer.append(item)
+                        size += len(item)
+                        if deadline is None and max_delay is not None:
+                            deadline = time.monotonic() + max_delay
+                elif not done and timeout is not None and time.monotonic() - last_item >= timeout:
+                    # the producer stalled, it is cancelled in the finally block
+                    self.producer_timeouts += 1
+                    break
+
+                if buffer and (size >= max_bytes or (deadline is not None and time.monotonic() >= deadline)):
+                    self.chunks_emitted += 1
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+                    deadline = None
+
+            if buffer:
+                self.chunks_emitted += 1
+                yield "".join(buffer)
+        finally:
+            self._wake = None
+            if woken is not None:
+                woken.cancel()
+            if pending is not None:
+                # cancels the producer at the await it is waiting at
+                pending.cancel()
+            else:
+                await items.aclose()
+            if isinstance(producer, _AsyncReaderQueue):
+                producer.stop()
+
+    async def _astop_producers(self, producers, chunks=None):
+        """Async version of _stop_producers"""
+        if chunks is not None:
+            await chunks.aclose()
+        for producer in producers:
+            if isinstance(producer, _AsyncReaderQueue):
+                producer.stop()
+            elif isinstance(producer, types.AsyncGeneratorType):
+                try:
+                    await producer.aclose()
+                except RuntimeError:
+                    # it is still running in a cancelled task
+                    pass
+            elif isinstance(producer, types.GeneratorType):
+                try:
+                    producer.close()
+                except ValueError:
+                    pass
+
+    def agenerate_response(self, accept_encoding=None):
+        """Create the streaming response as an async iterator of bytes
+
+        Accepts sync and async callables, generators and async generators.
+        The result can be returned from an ASGI framework, e.g.
+        stream = resp.agenerate_response(request.headers.get("accept-encoding"))
+        StreamingResponse(stream, media_type=resp.mimetype, headers=resp.response_headers())
+
+        If the server cancels the stream or closes the iterator because the client went away,
+        the producers are cancelled and the stream is logged as aborted.
+
+        Arguments:
+            accept_encoding {str} -- The Accept-Encoding header of the request, None sends
+                the stream uncompressed
+
+        Returns:
+            AsyncIterator[bytes] -- The utf-8 encoded response stream
+        """
+        self.metrics = metrics = StreamMetrics()
+        profiler = self._start_profile()
+        self._replay_cached() or self._join_flight()
+        documents = self._negotiate_compression(accept_encoding)
+        if profiler is not None:
+            profiler.disable()
+        keep_replies = self._keeps_replies()
+
+        async def generator():
+            producers = self.callables + self.generators
+            chunks = None
+            completed = False
+            capture = self._new_capture()
+
+            try:
+                for line in documents:
+                    if line is _FLUSH:
+                        yield line
+                    else:
+                        yield metrics.sent(line if isinstance(line, bytes) else line.encode("utf-8"))
+
+                if self.max_concurrency is not None and len(producers) > 1:
+                    semaphore = asyncio.Semaphore(self.max_concurrency)
+                    producers = [self._astart_reader(g, semaphore) for g in producers]
+
+                replies = []
+
+                for g in producers:
+                    texts = []
+                    replies.append(texts)
+                    metrics.producer_started(self.tokens_received, self.producer_timeouts)
+                    chunks = self._achunks(g)
+                    async for chunk in chunks:
+                        if self._emitted:
+                            for piece in self._flush_emitted():
+                                yield metrics.sent(piece if isinstance(piece, bytes) else piece.encode("utf-8"))
+                        if chunk is None:
+                            # woken up to write the emitted items
+                            if self.content_encoding is not None:
+                                yield _FLUSH
+                            continue
+                        metrics.chunk()
+                        if self._message_id is None:
+                            # opened with the first chunk, items emitted before it go first
+                            yield metrics.sent(self._open_message().encode("utf-8"))
+                        self._capture(capture, chunk)
+                        if keep_replies:
+                            texts.append(chunk)
+                        yield metrics.sent(self._assistant_delta(self._message_id, chunk).encode("utf-8"))
+                        if self._citations is not None:
+                            piece = self._index_citations(chunk)
+                            if piece is not None:
+                                yield metrics.sent(piece.encode("utf-8"))
+                        if self.content_encoding is not None:
+                            yield _FLUSH
+                    metrics.producer_finished(self.tokens_received, self.producer_timeouts)
+                    if self._message_id is None:
+                        yield metrics.sent(self._open_message().encode("utf-8"))
+                    piece = self._close_message()
+                    if piece:
+                        yield metrics.sent(piece.encode("utf-8"))
+                    for piece in self._flush_emitted():
+                        yield metrics.sent(piece if isinstance(piece, bytes) else piece.encode("utf-8"))
+                    if self.content_encoding is not None:
+                        yield _FLUSH
 
+                # emitted after the last chunk
+                for piece in self._flush_emitted():
+                    yield metrics.sent(piece if isinstance(piece, bytes) else piece.encode("utf-8"))
 
-        return self.app.response_class(generator(), mimetype='application/json')
+                self._commit_conversation(replies)
 
+                yield metrics.sent(self._stream_end().encode("utf-8"))
+                completed = True
+            except (GeneratorExit, asyncio.CancelledError):
+                self.aborted = True
+                raise
+            except Exception as e:
+                self.logger_doc["error"] = repr(e)
+                raise
+            finally:
+                if not completed:
+                    await self._astop_producers(producers, chunks)
+                self._write_log(capture)
+                self._run_cleanup()
 
+        stream = generator()
+        if self.content_encoding is not None:
+            stream = self._acompress(stream)
+        if profiler is not None:
+            stream = profiler.awrap(stream)
+        return stream
@@ -0,0 +1,155 @@
+import struct
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+
+class CompressionPolicy:
+    """ Negotiated streaming compression of chat responses
+
+    The encoding is picked from the Accept-Encoding header of the request. The stream is
+    sync flushed once per coalesced chunk, so the client can decode the tokens as they arrive.
+    Streams are only gzip compressed: the first min_size bytes are sent as stored deflate
+    blocks, as flushing small chunks costs more bytes than compressing them saves.
+
+    Arguments:
+        min_size {int} -- Responses without callables/generators whose documents are smaller
+            than this are sent uncompressed, streams are compressed after this many bytes
+        encodings {tuple} -- Content codings in order of preference, "br" needs the brotli package
+        gzip_level {int} -- Compression level of gzip, 1-9
+        brotli_quality {int} -- Quality of brotli, 0-11, high values are too slow for streaming
+
+    """
+    def __init__(self, min_size=1024, encodings=("br", "gzip"), gzip_level=6, brotli_quality=5):
+        self.min_size = min_size
+        self.encodings = encodings
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def negotiate(self, accept_encoding, streaming=False):
+        """Pick the content coding for a request
+
+        Arguments:
+            accept_encoding {str} -- The Accept-Encoding header, e.g. "gzip, deflate, br;q=0.9"
+            streaming {bool} -- The response streams callables/generators, only gzip is used
+
+        Returns:
+            str -- The preferred supported coding, None if the response is sent uncompressed
+        """
+        if not accept_encoding:
+            return None
+
+        accepted = {}
+        for part in accept_encoding.split(","):
+            coding, _, params = part.strip().partition(";")
+            q = 1.0
+            for param in params.split(";"):
+                name, _, value = param.strip().partition("=")
+                if name == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            accepted[coding.strip().lower()] = q
+
+        for coding in self.encodings:
+            if coding == "br" and (brotli is None or streaming):
+                continue
+            if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+                return coding
+        return None
+
+
+# gzip member header: deflate, no flags, no mtime, unknown OS
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+class StreamCompressor:
+    """ Compresses a stream piece by piece, flush() makes everything so far decodable
+
+    gzip starts with stored (uncompressed) deflate blocks until min_size bytes went through
+    and continues with compressed blocks. A sync flushed deflate stream can be continued by a
+    new compressor, so the gzip member is written around raw deflate output.
+
+    Arguments:
+        encoding {str} -- "gzip" or "br"
+        policy {CompressionPolicy} -- The compression settings
+        min_size {int} -- gzip only, the bytes that are sent uncompressed
+
+    """
+    def __init__(self, encoding, policy, min_size=0):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=policy.brotli_quality)
+        elif encoding == "gzip":
+            self._level = policy.gzip_level
+            self._min_size = min_size
+            self._stored = min_size > 0
+            self._compressor = self._deflate(0 if self._stored else self._level)
+            self._header = _GZIP_HEADER
+            self._crc = 0
+            self._size = 0
+        else:
+            raise ValueError(f"Unsupported content coding {encoding}")
+        self.encoding = encoding
+
+    @staticmethod
+    def _deflate(level):
+        return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """Compress a piece of the stream, the output may be held back until flush()
+
+        Arguments:
+            data {str|bytes} -- The piece, str is utf-8 encoded
+
+        Returns:
+            bytes -- Compressed output, often empty
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not data:
+            return b""
+        if self.encoding == "br":
+            return self._compressor.process(data)
+
+        out = self._header
+        self._header = b""
+        if self._stored and self._size + len(data) >= self._min_size:
+            # the threshold is reached, continue the deflate stream with compressed blocks
+            if self._size:
+                out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._compressor = self._deflate(self._level)
+            self._stored = False
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        return out + self._compressor.compress(data)
+
+    def flush(self):
+        """Sync flush, the client can decode everything compressed so far
+
+        Returns:
+            bytes -- The held back output
+        """
+        if self.encoding == "br":
+            return self._compressor.flush()
+        if self._size == 0:
+            return b""
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """End the compressed stream
+
+        Returns:
+            bytes -- The rest of the output and the trailer
+        """
+        if self.encoding == "br":
+            return self._compressor.finish()
+        out = self._header + self._compressor.flush(zlib.Z_FINISH)
+        self._header = b""
+        return out + struct.pack("<II", self._crc & 0xffffffff, self._size & 0xffffffff)
@@ -1,3 +1,4 @@
+from .base import Document
 from . misc import *
 from . photo import *
 from . pdf import *
@@ -0,0 +1,78 @@
+import hashlib
+
+from .. import encoding
+
+
+class Document:
+    """ Base class of the documents that can be added to a chatutils.Response
+
+    The dict and JSON bytes of a document are built once and cached. Assigning
+    any attribute (e.g. ref or show) drops the cache, changes inside mutable
+    attributes (like appending a highlight) need an explicit invalidate().
+    The encoding of the content without the ref is kept when only the ref changes.
+    """
+    _cached_dict = None
+    _cached_json = None
+    _cached_content = None
+    _cached_key = None
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == "ref":
+            object.__setattr__(self, "_cached_dict", None)
+            object.__setattr__(self, "_cached_json", None)
+        elif not name.startswith("_"):
+            self.invalidate()
+
+    def invalidate(self):
+        object.__setattr__(self, "_cached_dict", None)
+        object.__setattr__(self, "_cached_json", None)
+        object.__setattr__(self, "_cached_content", None)
+        object.__setattr__(self, "_cached_key", None)
+
+    def _encodable(self):
+        """The object handed to the JSON encoder, may contain dataclasses"""
+        return self.cached_dict()
+
+    def to_dict(self):
+        raise NotImplementedError
+
+    def externalize_assets(self, store):
+        """Replace large inline data URIs by URLs of a chatutils BlobStore"""
+        pass
+
+    def cached_dict(self):
+        """The result of to_dict, built once until the document changes"""
+        if self._cached_dict is None:
+            object.__setattr__(self, "_cached_dict", self.to_dict())
+        return self._cached_dict
+
+    def _content_json(self):
+        """The JSON encoded document without its ref"""
+        if self._cached_content is None:
+            content = {key: value for key, value in self._encodable().items() if key != "ref"}
+            object.__setattr__(self, "_cached_content", encoding.dumpb(content))
+        return self._cached_content
+
+    def content_key(self):
+        """The content hash of the document, sessions.document_key of its dict for documents without id
+
+        Returns:
+            str -- The sha256 of the encoding without the ref, kept when the ref changes
+        """
+        if self._cached_key is None:
+            object.__setattr__(self, "_cached_key", hashlib.sha256(self._content_json()).hexdigest())
+        return self._cached_key
+
+    def to_json_bytes(self):
+        """The JSON encoded document, built once until the document changes"""
+        if self._cached_json is None:
+            # the ref is added to the cached encoding of the content
+            content = self._content_json()
+            ref = b'"ref": ' + encoding.dumpb(self.ref)
+            encoded = content[:-1] + (b", " + ref if content != b"{}" else ref) + b"}"
+            object.__setattr__(self, "_cached_json", encoded)
+        return self._cached_json
+
+    def to_json(self):
+        return self.to_json_bytes().decode("utf-8")
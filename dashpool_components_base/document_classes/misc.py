@@ -1,4 +1,7 @@
-class DashpoolEvent:
+from .base import Document
+
+
+class DashpoolEvent(Document):
     def __init__(self, id, data, ref=None):
         self.id = id
         self.data = data
@@ -13,7 +16,7 @@ class DashpoolEvent:
         }
     
 
-class NodeChangeEvent:
+class NodeChangeEvent(Document):
     def __init__(self, id, data, ref=None):
         self.id = id
         self.data = data
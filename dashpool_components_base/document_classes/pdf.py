@@ -1,12 +1,21 @@
+import array
 import dataclasses
+import hashlib
+import math
+import sys
 
+from .base import Document
 
-@dataclasses.dataclass
+# slots keep the many small geometry objects free of a __dict__
+_slotted = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclasses.dataclass(**_slotted)
 class PdfHighlightContent:
     text: str = None
     image: str = None
 
-@dataclasses.dataclass
+@dataclasses.dataclass(**_slotted)
 class PdfHighlightPositionRect:
     x1: float
     y1: float
@@ -16,18 +25,414 @@ class PdfHighlightPositionRect:
     height: float
     pageNumber: int = None
 
-@dataclasses.dataclass
+
+def _rect_values(rect):
+    return (rect.x1, rect.y1, rect.x2, rect.y2, rect.width, rect.height, rect.pageNumber)
+
+
+class _PackedRect(PdfHighlightPositionRect):
+    """ A read-only rect of PdfHighlightRects, changes are assigned to its index instead:
+    rects[0] = dataclasses.replace(rects[0], pageNumber=3) """
+    __slots__ = ()
+
+    def __init__(self, x1, y1, x2, y2, width, height, pageNumber=None):
+        for name, value in zip(PdfHighlightRects.FIELDS, (x1, y1, x2, y2, width, height, pageNumber)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            f"Cannot set {name} of a packed rect, assign the changed rect to its index in the rects")
+
+    def __eq__(self, other):
+        if not isinstance(other, PdfHighlightPositionRect):
+            return NotImplemented
+        return _rect_values(self) == _rect_values(other)
+
+    def __repr__(self):
+        return "PdfHighlightPositionRect(" + ", ".join(
+            f"{name}={value!r}" for name, value in zip(PdfHighlightRects.FIELDS, _rect_values(self))) + ")"
+
+    def __reduce__(self):
+        # copies are plain rects that can be changed
+        return PdfHighlightPositionRect, _rect_values(self)
+
+
+class _Packed:
+    """ The only item the list storage of PdfHighlightRects holds """
+    __slots__ = ()
+
+
+_PACKED = _Packed()
+
+# bits of the int mask of a rect, pageNumber is always an int
+_INT_BITS = (1, 2, 4, 8, 16, 32)
+# the indices of the int coordinates of each mask
+_INT_INDICES = [tuple(i for i, bit in enumerate(_INT_BITS) if mask & bit) for mask in range(64)]
+
+
+def _int_masks(rows):
+    """The int masks of rows of rect values, checked column by column"""
+    masks = bytearray(len(rows))
+    mixed = []
+    uniform = 0
+    for bit, column in zip(_INT_BITS, zip(*rows)):
+        kinds = set(map(type, column))
+        if kinds == {int}:
+            uniform |= bit
+        elif int in kinds:
+            mixed.append((bit, column))
+    if uniform:
+        masks = bytearray([uniform]) * len(rows)
+    for bit, column in mixed:
+        for i, value in enumerate(column):
+            if type(value) is int:
+                masks[i] |= bit
+    return masks
+
+
+def _int_mask(values):
+    x1, y1, x2, y2, width, height = values
+    return (
+        (type(x1) is int) | (type(y1) is int) << 1 | (type(x2) is int) << 2
+        | (type(y2) is int) << 3 | (type(width) is int) << 4 | (type(height) is int) << 5
+    )
+
+
+class PdfHighlightRects(list):
+    """ The rects of a highlight, packed into one array of doubles
+
+    A list of PdfHighlightPositionRect. The rects are created on access and are read-only,
+    assign a changed rect to its index to change the stored geometry. Integer coordinates
+    stay integers.
+
+    The list storage only holds a placeholder, so json.dumps raises a TypeError for the
+    rects. Use to_dicts() for the list of dicts, the encoding module of chatutils
+    serializes them directly. dataclasses.asdict converts them to a plain list of dicts.
+
+    Arguments:
+        rects {list[PdfHighlightPositionRect]} -- The initial rects
+
+    """
+    __slots__ = ("_data", "_ints")
+
+    FIELDS = ("x1", "y1", "x2", "y2", "width", "height", "pageNumber")
+
+    def __new__(cls, rects=()):
+        rects = list(rects)
+        if rects and isinstance(rects[0], (dict, tuple)):
+            # rebuilt by dataclasses.asdict/astuple from the converted rects, stays a plain list
+            return rects
+        self = super().__new__(cls)
+        list.append(self, _PACKED)
+        self._data = array.array("d")
+        # a bit per coordinate that was an int
+        self._ints = bytearray()
+        self.extend(rects)
+        return self
+
+    def __init__(self, rects=()):
+        # filled by __new__, list.__init__ would replace the placeholder
+        pass
+
+    @classmethod
+    def from_dicts(cls, rects):
+        """Build the rects from their dict form, as used by PDF.from_dict"""
+        nan = math.nan
+        packed = cls()
+        rows = [
+            (
+                rect["x1"], rect["y1"], rect["x2"], rect["y2"], rect["width"], rect["height"],
+                nan if rect["pageNumber"] is None else rect["pageNumber"],
+            )
+            for rect in rects
+        ]
+        packed._data = array.array("d", [value for row in rows for value in row])
+        packed._ints = _int_masks(rows)
+        return packed
+
+    def _pack(self, rect):
+        values = (rect.x1, rect.y1, rect.x2, rect.y2, rect.width, rect.height)
+        return (
+            values + (math.nan if rect.pageNumber is None else rect.pageNumber,),
+            _int_mask(values),
+        )
+
+    def _rect(self, index):
+        values = self._data[index * 7:index * 7 + 7].tolist()
+        for i in _INT_INDICES[self._ints[index]]:
+            values[i] = int(values[i])
+        page = values[6]
+        values[6] = None if page != page else int(page)
+        return _PackedRect(*values)
+
+    def _index(self, index):
+        index = index.__index__()
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("rect index out of range")
+        return index
+
+    def append(self, rect):
+        values, mask = self._pack(rect)
+        self._data.extend(values)
+        self._ints.append(mask)
+
+    def extend(self, rects):
+        if isinstance(rects, PdfHighlightRects):
+            self._data.extend(rects._data)
+            self._ints.extend(rects._ints)
+            return
+        for rect in rects:
+            self.append(rect)
+
+    def insert(self, index, rect):
+        index = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        values, mask = self._pack(rect)
+        self._data[index * 7:index * 7] = array.array("d", values)
+        self._ints.insert(index, mask)
+
+    def pop(self, index=-1):
+        if not len(self):
+            raise IndexError("pop from empty rects")
+        index = self._index(index)
+        rect = self._rect(index)
+        del self[index]
+        return rect
+
+    def remove(self, rect):
+        del self[self.index(rect)]
+
+    def clear(self):
+        del self._data[:]
+        del self._ints[:]
+
+    def index(self, rect, start=0, stop=sys.maxsize):
+        for i in range(*slice(start, stop).indices(len(self))):
+            if self._rect(i) == rect:
+                return i
+        raise ValueError("rect is not in the rects")
+
+    def count(self, rect):
+        return sum(1 for other in self if other == rect)
+
+    def copy(self):
+        copied = PdfHighlightRects()
+        copied.extend(self)
+        return copied
+
+    def reverse(self):
+        self[:] = list(reversed(self))
+
+    def sort(self, *, key=None, reverse=False):
+        self[:] = sorted(self, key=key, reverse=reverse)
+
+    def __len__(self):
+        return len(self._ints)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._rect(i) for i in range(*index.indices(len(self)))]
+        return self._rect(self._index(index))
+
+    def __setitem__(self, index, rect):
+        if isinstance(index, slice):
+            rects = list(self)
+            rects[index] = rect
+            self.clear()
+            self.extend(rects)
+            return
+        index = self._index(index)
+        values, mask = self._pack(rect)
+        self._data[index * 7:index * 7 + 7] = array.array("d", values)
+        self._ints[index] = mask
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            for i in sorted(range(*index.indices(len(self))), reverse=True):
+                del self[i]
+            return
+        index = self._index(index)
+        del self._data[index * 7:index * 7 + 7]
+        del self._ints[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._rect(i)
+
+    def __reversed__(self):
+        for i in reversed(range(len(self))):
+            yield self._rect(i)
+
+    def __contains__(self, rect):
+        return any(other == rect for other in self)
+
+    def __eq__(self, other):
+        # compares the rects, a missing pageNumber is stored as nan
+        if not isinstance(other, list):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __add__(self, other):
+        added = self.copy()
+        added.extend(other)
+        return added
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __mul__(self, count):
+        return PdfHighlightRects(list(self) * count)
+
+    __rmul__ = __mul__
+
+    def __imul__(self, count):
+        self[:] = list(self) * count
+        return self
+
+    def __repr__(self):
+        return f"PdfHighlightRects({list(self)!r})"
+
+    def __reduce__(self):
+        return PdfHighlightRects, (list(self),)
+
+    def to_dicts(self):
+        """The rects as list of dicts, unpacked in one pass over the array"""
+        values = iter(self._values())
+        return [
+            {
+                "x1": x1,
+                "y1": y1,
+                "x2": x2,
+                "y2": y2,
+                "width": width,
+                "height": height,
+                "pageNumber": None if page != page else int(page)
+            }
+            for x1, y1, x2, y2, width, height, page in zip(
+                values, values, values, values, values, values, values)
+        ]
+
+    def _values(self):
+        """The flat list of the values, with the int coordinates as ints"""
+        values = self._data.tolist()
+        ints = self._ints
+        if ints and ints.count(ints[0]) == len(ints):
+            # the same coordinates are ints in all rects, convert them column by column
+            for i in _INT_INDICES[ints[0]]:
+                values[i::7] = map(int, values[i::7])
+            return values
+        for start, mask in zip(range(0, len(values), 7), ints):
+            for i in _INT_INDICES[mask]:
+                values[start + i] = int(values[start + i])
+        return values
+
+    # used by the JSON encoder
+    to_json_value = to_dicts
+
+    def tuples(self):
+        """Iterate over the rects as (x1, y1, x2, y2, width, height, pageNumber) tuples,
+        coordinates are floats and pageNumber is nan if missing"""
+        values = iter(self._data.tolist())
+        return zip(values, values, values, values, values, values, values)
+
+    def merged(self, gap_ratio=0.5):
+        """Coalesce overlapping and adjacent rects of the same page and line
+
+        Rects belong to one line if they overlap vertically by at least half of the lower
+        rect. Within a line, rects are merged if the horizontal gap between them is at
+        most gap_ratio times the line height, which joins the word rects of a line.
+        A coordinate of a merged rect is an int if it is taken from an int coordinate.
+
+        Returns:
+            PdfHighlightRects -- The merged rects, ordered by page, line and x
+        """
+        groups = {}
+        for rect, mask in zip(self.tuples(), self._ints):
+            # the page size is part of the key, rects of different scales are not merged
+            key = (-1 if rect[6] != rect[6] else rect[6], rect[4], rect[5])
+            groups.setdefault(key, []).append(rect + (mask,))
+
+        merged = PdfHighlightRects()
+        for key in sorted(groups):
+            lines = []
+            for x1, y1, x2, y2, width, height, page, mask in sorted(groups[key], key=lambda r: (r[1], r[0])):
+                if lines:
+                    line = lines[-1]
+                    overlap = min(y2, line[1]) - max(y1, line[0])
+                    if overlap >= 0.5 * min(y2 - y1, line[1] - line[0]):
+                        if y1 < line[0]:
+                            line[0], line[6] = y1, mask & 2
+                        if y2 > line[1]:
+                            line[1], line[7] = y2, mask & 8
+                        line[2].append((x1, x2, mask))
+                        continue
+                # the int bits of y1, y2 and of the size
+                lines.append([y1, y2, [(x1, x2, mask)], width, height, page, mask & 2, mask & 8, mask & 48])
+
+            for y1, y2, spans, width, height, page, y1_int, y2_int, size_ints in lines:
+                line_ints = y1_int | y2_int | size_ints
+                gap = gap_ratio * (y2 - y1)
+                spans.sort()
+                start, end, mask = spans[0]
+                ints = mask & 5
+                for x1, x2, span_mask in spans[1:]:
+                    if x1 <= end + gap:
+                        if x2 > end:
+                            end = x2
+                            ints = (ints & 1) | (span_mask & 4)
+                    else:
+                        merged._data.extend((start, y1, end, y2, width, height, page))
+                        merged._ints.append(ints | line_ints)
+                        start, end, ints = x1, x2, span_mask & 5
+                merged._data.extend((start, y1, end, y2, width, height, page))
+                merged._ints.append(ints | line_ints)
+
+        return merged
+
+
+def _rects_to_dicts(rects):
+    if isinstance(rects, PdfHighlightRects):
+        return rects.to_dicts()
+    return [
+        {
+            "x1": rect.x1,
+            "y1": rect.y1,
+            "x2": rect.x2,
+            "y2": rect.y2,
+            "width": rect.width,
+            "height": rect.height,
+            "pageNumber": rect.pageNumber
+        }
+        for rect in rects
+    ]
+
+
+@dataclasses.dataclass(**_slotted)
 class PdfHighlightPosition:
     boundingRect: PdfHighlightPositionRect
     rects: list[PdfHighlightPositionRect]
     pageNumber: int
 
-@dataclasses.dataclass
+    def __post_init__(self):
+        # packed, see PdfHighlightRects
+        if not isinstance(self.rects, PdfHighlightRects):
+            self.rects = PdfHighlightRects(self.rects)
+
+@dataclasses.dataclass(**_slotted)
 class PdfHighlightComment:
     text: str = None
     emoji: str = None
 
-@dataclasses.dataclass
+@dataclasses.dataclass(**_slotted)
 class PdfHighlight:
     content: PdfHighlightContent=None
     position: PdfHighlightPosition=None
@@ -36,10 +441,91 @@ class PdfHighlight:
     file_id: str = None
     file_mode: str = None
 
+    def normalize(self, gap_ratio=0.5):
+        """Merge the overlapping and adjacent rects of the highlight, see PdfHighlightRects.merged"""
+        if self.position is not None:
+            rects = self.position.rects
+            if not isinstance(rects, PdfHighlightRects):
+                rects = PdfHighlightRects(rects)
+            self.position.rects = rects.merged(gap_ratio)
+        return self
+
+
+class PdfPageIndex:
+    """ A spatial index over the rects of highlights, a uniform grid per page
+
+    The rects are expected to share one viewport size (width/height), as the
+    rects of the highlights of one PDF do.
 
+    Arguments:
+        cell_size {float} -- Edge length of the grid cells, in rect coordinates
 
+    """
+    def __init__(self, cell_size=50):
+        self.cell_size = cell_size
+        self._cells = {}
 
-class PDF:
+    def _cell_range(self, x1, y1, x2, y2):
+        size = self.cell_size
+        for cx in range(int(x1 // size), int(x2 // size) + 1):
+            for cy in range(int(y1 // size), int(y2 // size) + 1):
+                yield cx, cy
+
+    def insert(self, key, highlight):
+        """Add the rects of a highlight under a key"""
+        for rect in highlight.position.rects:
+            entry = (key, rect.x1, rect.y1, rect.x2, rect.y2)
+            for cell in self._cell_range(rect.x1, rect.y1, rect.x2, rect.y2):
+                self._cells.setdefault((rect.pageNumber,) + cell, []).append(entry)
+
+    def query(self, pageNumber, x1, y1, x2, y2):
+        """Find the rects overlapping a region of a page
+
+        Returns:
+            list[tuple] -- (key, x1, y1, x2, y2) of the overlapping rects
+        """
+        found = set()
+        for cell in self._cell_range(x1, y1, x2, y2):
+            for entry in self._cells.get((pageNumber,) + cell, ()):
+                if entry[1] < x2 and x1 < entry[3] and entry[2] < y2 and y1 < entry[4]:
+                    found.add(entry)
+        return list(found)
+
+    def hit(self, pageNumber, x, y):
+        """Find the keys of the highlights with a rect containing a point"""
+        size = self.cell_size
+        return {
+            entry[0]
+            for entry in self._cells.get((pageNumber, int(x // size), int(y // size)), ())
+            if entry[1] <= x <= entry[3] and entry[2] <= y <= entry[4]
+        }
+
+    def coverage(self, highlight, key=None):
+        """The share of the area of a highlight that is covered by indexed rects
+
+        Arguments:
+            highlight {PdfHighlight} -- The highlight to check
+            key {Any} -- Only count the rects of this key, None counts all
+
+        Returns:
+            float -- Between 0 and 1, rects of one key are assumed not to overlap each other
+        """
+        total = 0
+        covered = 0
+        for rect in highlight.position.rects:
+            area = (rect.x2 - rect.x1) * (rect.y2 - rect.y1)
+            total += area
+            overlap = 0
+            for entry_key, x1, y1, x2, y2 in self.query(rect.pageNumber, rect.x1, rect.y1, rect.x2, rect.y2):
+                if key is None or entry_key == key:
+                    overlap += (min(x2, rect.x2) - max(x1, rect.x1)) * (min(y2, rect.y2) - max(y1, rect.y1))
+            covered += min(overlap, area)
+        return covered / total if total > 0 else 0
+
+
+
+
+class PDF(Document):
     def __init__(self, url="", highlights=[], name=None, ref=None, size=450):
         self.url = url
         self.highlights = highlights
@@ -53,6 +539,52 @@ class PDF:
             assert isinstance(h, PdfHighlight)
 
 
+    def normalize(self, gap_ratio=0.5, deduplicate=True, min_coverage=0.9):
+        """Merge the rects of all highlights and drop highlights covering the same region
+
+        Arguments:
+            gap_ratio {float} -- See PdfHighlightRects.merged
+            deduplicate {bool} -- Drop a highlight if an earlier one covers it
+            min_coverage {float} -- Share of the area that has to be covered by a single
+                earlier highlight to count as duplicate
+
+        Returns:
+            PDF -- The document itself
+        """
+        highlights = [h.normalize(gap_ratio) for h in self.highlights]
+
+        if deduplicate:
+            index = PdfPageIndex()
+            kept = []
+            for h in highlights:
+                if h.position is None or len(h.position.rects) == 0:
+                    kept.append(h)
+                    continue
+                candidates = {
+                    entry[0]
+                    for rect in h.position.rects
+                    for entry in index.query(rect.pageNumber, rect.x1, rect.y1, rect.x2, rect.y2)
+                }
+                if any(index.coverage(h, key) >= min_coverage for key in candidates):
+                    continue
+                index.insert(len(kept), h)
+                kept.append(h)
+            highlights = kept
+
+        self.highlights = highlights
+        return self
+
+    def externalize_assets(self, store):
+        changed = False
+        for h in self.highlights:
+            if h.content is not None:
+                image = store.externalize(h.content.image)
+                if image != h.content.image:
+                    h.content.image = image
+                    changed = True
+        if changed:
+            self.invalidate()
+
     def highlights_to_dict(self):
         return [
             {
@@ -70,18 +602,7 @@ class PDF:
                         "height": h.position.boundingRect.height,
                         "pageNumber": h.position.boundingRect.pageNumber
                     },
-                    "rects": [
-                        {
-                            "x1": rect.x1,
-                            "y1": rect.y1,
-                            "x2": rect.x2,
-                            "y2": rect.y2,
-                            "width": rect.width,
-                            "height": rect.height,
-                            "pageNumber": rect.pageNumber
-                        }
-                        for rect in h.position.rects
-                    ],
+                    "rects": _rects_to_dicts(h.position.rects),
                     "pageNumber": h.position.pageNumber
                 },
                 "comment": {
@@ -95,6 +616,20 @@ class PDF:
             for h in self.highlights
         ]
 
+    def _encodable(self):
+        # the encoder serializes the highlight dataclasses directly
+        return {
+            "role": "pdf",
+            "ref": self.ref,
+            "show": self.show,
+            "data": {
+                "url": self.url,
+                "size": self.size,
+                "name": self.name,
+                "highlights": self.highlights
+            }
+        }
+
     def to_dict(self):
         return {
             "role": "pdf",
@@ -108,51 +643,80 @@ class PDF:
             }
         }
     @staticmethod
+    def highlight_from_dict(data):
+        """Build a PdfHighlight from its dict form"""
+        return PdfHighlight(
+            content=PdfHighlightContent(
+                text=data["content"]["text"] if "text" in data["content"] else None,
+                image=data["content"]["image"] if "image" in data["content"] else None
+            ),
+            position=PdfHighlightPosition(
+                boundingRect=PdfHighlightPositionRect(
+                    x1=data["position"]["boundingRect"]["x1"],
+                    y1=data["position"]["boundingRect"]["y1"],
+                    x2=data["position"]["boundingRect"]["x2"],
+                    y2=data["position"]["boundingRect"]["y2"],
+                    width=data["position"]["boundingRect"]["width"],
+                    height=data["position"]["boundingRect"]["height"],
+                ),
+                rects=PdfHighlightRects.from_dicts(data["position"]["rects"]),
+                pageNumber=data["position"]["pageNumber"]
+            ),
+            comment=PdfHighlightComment(
+                text=data["comment"]["text"] if "text" in data["comment"] else "",
+                emoji=data["comment"]["emoji"] if "emoji" in data["comment"] else ""
+            ) if "comment" in data else PdfHighlightComment(text="", emoji=""),
+            id=data["id"] if "id" in data else None,
+            file_id=data["file_id"] if "file_id" in data else None,
+            file_mode=data["file_mode"] if "file_mode" in data else None,
+        )
+
+    @staticmethod
     def from_dict(data, ref=None):
         url = data["file_id"] if "file_id" in data else None
         name = data["name"] if "name" in data else url
-        
-        highlights = [
-            PdfHighlight(
-                content=PdfHighlightContent(
-                    text=data["content"]["text"] if "text" in data["content"] else None,
-                    image=data["content"]["image"] if "image" in data["content"] else None
-                ),
-                position=PdfHighlightPosition(
-                    boundingRect=PdfHighlightPositionRect(
-                        x1=data["position"]["boundingRect"]["x1"],
-                        y1=data["position"]["boundingRect"]["y1"],
-                        x2=data["position"]["boundingRect"]["x2"],
-                        y2=data["position"]["boundingRect"]["y2"],
-                        width=data["position"]["boundingRect"]["width"],
-                        height=data["position"]["boundingRect"]["height"],
-                    ),
-                    rects=[
-                        PdfHighlightPositionRect(
-                            x1=rect["x1"],
-                            y1=rect["y1"],
-                            x2=rect["x2"],
-                            y2=rect["y2"],
-                            width=rect["width"],
-                            height=rect["height"],
-                            pageNumber=rect["pageNumber"]
-                        )
-                        for rect in data["position"]["rects"]
-                    ],
-                    pageNumber=data["position"]["pageNumber"]
-                ),
-                comment=PdfHighlightComment(
-                    text=data["comment"]["text"] if "text" in data["comment"] else "",
-                    emoji=data["comment"]["emoji"] if "emoji" in data["comment"] else ""
-                ) if "comment" in data else PdfHighlightComment(text="", emoji=""),
-                id=data["id"] if "id" in data else None,
-                file_id=data["file_id"] if "file_id" in data else None,
-                file_mode=data["file_mode"] if "file_mode" in data else None,
-            )
-        ]
+
         return PDF(
             url=url,
-            highlights=highlights,
+            highlights=[PDF.highlight_from_dict(data)],
             name=name,
             ref=ref
-            )
\ No newline at end of file
+            )
+
+    @staticmethod
+    def from_dicts(data, ref_prefix="pdf"):
+        """Build one PDF per file from a list of highlight dicts, e.g. retrieval hits
+
+        The highlights are grouped by file_id in linear time. The PDFs are ordered by
+        the first hit of their file and the highlights keep the order of the hits.
+
+        Arguments:
+            data {list[dict]} -- The highlight dicts, as accepted by from_dict
+            ref_prefix {str} -- The refs are ref_prefix + a short hash of the file_id, so a file
+                keeps its ref whatever the other hits are. Hits without file_id get no ref
+
+        Returns:
+            list[PDF] -- One PDF per file_id
+        """
+        groups = {}
+        for hit in data:
+            file_id = hit["file_id"] if "file_id" in hit else None
+            if file_id not in groups:
+                groups[file_id] = (hit["name"] if "name" in hit else file_id, [])
+            groups[file_id][1].append(PDF.highlight_from_dict(hit))
+
+        return [
+            PDF(
+                url=file_id,
+                highlights=highlights,
+                name=name,
+                ref=PDF._file_ref(ref_prefix, file_id)
+            )
+            for file_id, (name, highlights) in groups.items()
+        ]
+
+    @staticmethod
+    def _file_ref(ref_prefix, file_id):
+        if file_id is None:
+            return None
+        return ref_prefix + hashlib.sha1(str(file_id).encode("utf-8")).hexdigest()[:10]
@@ -1,4 +1,7 @@
-class Photo:
+from .base import Document
+
+
+class Photo(Document):
     def __init__(self, url, width=None, height=None, ref=None):
         self.url = url
         self.width = width
@@ -7,6 +10,11 @@ class Photo:
         self.show = False
 
 
+    def externalize_assets(self, store):
+        url = store.externalize(self.url)
+        if url != self.url:
+            self.url = url
+
     def to_dict(self):
         return {
             "role": "photo",
@@ -1,4 +1,7 @@
-class Reference:
+from .base import Document
+
+
+class Reference(Document):
     def __init__(self, url="", markdown="", ref=None, img=None, size=450):
         self.url = url
         self.markdown = markdown
@@ -6,6 +9,11 @@ class Reference:
         self.img = img
         self.size = size
 
+    def externalize_assets(self, store):
+        img = store.externalize(self.img)
+        if img != self.img:
+            self.img = img
+
     def to_dict(self):
         return {
             "role": "reference",
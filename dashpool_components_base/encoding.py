@@ -0,0 +1,110 @@
+import dataclasses
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    # e.g. the packed rects of a PDF highlight
+    if hasattr(obj, "to_json_value"):
+        return obj.to_json_value()
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        fields = {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj)}
+        for name, value in fields.items():
+            # the json module encodes list subclasses itself, without calling default
+            if hasattr(value, "to_json_value"):
+                fields[name] = value.to_json_value()
+        return fields
+    # subclasses of builtins, orjson passes them through
+    for base in (dict, list, str, int):
+        if isinstance(obj, base):
+            return base(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class StdlibBackend:
+    """ JSON encoding with the json module of the standard library """
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=_default)
+
+    def dumpb(self, obj):
+        return self.dumps(obj).encode("utf-8")
+
+
+class OrjsonBackend:
+    """ JSON encoding with orjson, serializes dataclasses and datetimes natively
+
+    Subclasses of dict, list, str and int are encoded like the builtin, unless they
+    define to_json_value.
+
+    Inputs orjson rejects but the json module encodes, e.g. lone surrogates in strings or
+    integers beyond 64 bit, are encoded with the standard library.
+    """
+    name = "orjson"
+
+    def __init__(self):
+        self._fallback = StdlibBackend()
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode("utf-8")
+
+    def dumpb(self, obj):
+        try:
+            return orjson.dumps(
+                obj, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_SUBCLASS)
+        except orjson.JSONEncodeError:
+            return self._fallback.dumpb(obj)
+
+
+BACKENDS = {
+    "json": StdlibBackend,
+    "orjson": OrjsonBackend,
+}
+
+_backend = None
+
+
+def set_backend(name=None):
+    """Select the JSON encoder used by chatutils and the document classes
+
+    Arguments:
+        name {str} -- "orjson" or "json", None picks orjson if it is installed
+
+    Returns:
+        str -- The name of the selected backend
+    """
+    global _backend
+
+    if name is None:
+        name = "orjson" if orjson is not None else "json"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend {name}, use one of {list(BACKENDS)}")
+    if name == "orjson" and orjson is None:
+        raise ImportError("orjson is not installed")
+
+    _backend = BACKENDS[name]()
+    return name
+
+
+def get_backend():
+    if _backend is None:
+        set_backend()
+    return _backend
+
+
+def dumps(obj):
+    """Encode obj as a JSON string"""
+    return get_backend().dumps(obj)
+
+
+def dumpb(obj):
+    """Encode obj as utf-8 JSON bytes"""
+    return get_backend().dumpb(obj)
@@ -0,0 +1,215 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# stops the writer thread
+_CLOSE = object()
+
+
+class LogSink:
+    """ A process wide writer that inserts log documents in batches from a background thread
+
+    Documents are queued by submit and written with insert_many, grouped by collection.
+    The TTL index on end_timestamp is created once per collection before its first write.
+
+    Arguments:
+        batch_size {int} -- Maximum number of documents per insert_many
+        flush_interval {float} -- Seconds to wait for more documents before a batch is written
+        max_queue_size {int} -- Documents submitted while the queue is full are dropped
+        expire_after_seconds {int} -- Expiry of the end_timestamp index, None to skip the index
+
+    """
+    def __init__(self, batch_size=100, flush_interval=0.5, max_queue_size=10000, expire_after_seconds=86400 * 5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.expire_after_seconds = expire_after_seconds
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        # counters
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        # latency of the insert_many calls
+        self.write_seconds = 0.0
+        self.last_write_seconds = None
+
+        self._indexed = set()
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        """The counters of the sink
+
+        Returns:
+            dict -- queue_depth, submitted, written, dropped and failed documents, the total
+                and the last duration of the inserts in seconds
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "write_seconds": self.write_seconds,
+            "last_write_seconds": self.last_write_seconds,
+        }
+
+    def _collection_key(self, collection):
+        return getattr(collection, "full_name", None) or id(collection)
+
+    def ensure_indexes(self, collection):
+        """Create the TTL index of a collection, only the first call per collection talks to the database"""
+        key = self._collection_key(collection)
+        if key in self._indexed:
+            return
+        self._indexed.add(key)
+
+        if self.expire_after_seconds is not None:
+            try:
+                collection.create_index("end_timestamp", expireAfterSeconds=self.expire_after_seconds)
+            except Exception:
+                self._indexed.discard(key)
+                logger.exception("Could not create the log index")
+
+    def submit(self, collection, document):
+        """Queue a document for insertion without blocking
+
+        Arguments:
+            collection {MongoCollection} -- The collection to insert into
+            document {dict} -- The log document
+
+        Returns:
+            bool -- False if the document was dropped
+        """
+        if self._closed:
+            with self._condition:
+                self.dropped += 1
+            return False
+
+        self._start()
+
+        with self._condition:
+            try:
+                self.queue.put_nowait((collection, document))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending += 1
+            self.submitted += 1
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until all queued documents are written
+
+        Returns:
+            bool -- False if the timeout expired first
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def close(self, timeout=5):
+        """Write the remaining documents and stop the writer thread
+
+        Arguments:
+            timeout {float} -- Seconds to wait for the writer, in total. If the queue stays full
+                that long, e.g. because the database hangs, the queued documents are given up
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                self.queue.put(_CLOSE, timeout=timeout)
+            except queue.Full:
+                logger.warning("Log sink did not drain in %s seconds, %d documents are not written",
+                               timeout, self._pending)
+                return
+            self._thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def _start(self):
+        if self._thread is None:
+            with self._condition:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="dashpool-log-sink", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            item = self.queue.get()
+            if item is _CLOSE:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch):
+        collections = {}
+        for collection, document in batch:
+            key = self._collection_key(collection)
+            if key not in collections:
+                collections[key] = (collection, [])
+            collections[key][1].append(document)
+
+        for collection, documents in collections.values():
+            start = time.perf_counter()
+            try:
+                self.ensure_indexes(collection)
+                collection.insert_many(documents, ordered=False)
+                failed = 0
+            except Exception:
+                failed = len(documents)
+                logger.exception("Could not write %d log documents", len(documents))
+            seconds = time.perf_counter() - start
+
+            with self._condition:
+                self.write_seconds += seconds
+                self.last_write_seconds = seconds
+                self.written += len(documents) - failed
+                self.failed += failed
+                self._pending -= len(documents)
+                self._condition.notify_all()
+
+
+_default_sink = None
+_default_sink_lock = threading.Lock()
+
+
+def get_log_sink():
+    """The process wide log sink, created on first use and flushed on shutdown
+
+    Returns:
+        LogSink -- The shared sink
+    """
+    global _default_sink
+
+    if _default_sink is None:
+        with _default_sink_lock:
+            if _default_sink is None:
+                _default_sink = LogSink()
+                atexit.register(_default_sink.close)
+    return _default_sink
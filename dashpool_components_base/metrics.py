@@ -0,0 +1,226 @@
+import threading
+import time
+
+
+class StreamMetrics:
+    """ The timings and sizes of one streamed chat response
+
+    Times are measured with time.perf_counter and reported in seconds since the
+    response started streaming.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_byte = None
+        self.bytes = 0
+        self.sanitize_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.producers = []
+
+    def sent(self, piece):
+        """Count a piece of the stream, returns the piece"""
+        if self.first_byte is None and piece:
+            self.first_byte = time.perf_counter()
+        self.bytes += len(piece)
+        return piece
+
+    def producer_started(self, tokens, timeouts):
+        self.producers.append({
+            "start": time.perf_counter(), "first_token": None, "end": None,
+            "tokens": tokens, "timeouts": timeouts
+        })
+
+    def chunk(self):
+        producer = self.producers[-1]
+        if producer["first_token"] is None:
+            producer["first_token"] = time.perf_counter()
+
+    def producer_finished(self, tokens, timeouts):
+        producer = self.producers[-1]
+        producer["end"] = time.perf_counter()
+        producer["tokens"] = tokens - producer["tokens"]
+        producer["timeouts"] = timeouts - producer["timeouts"]
+
+    def to_dict(self, tokens, chunks, status):
+        """The metrics as a document
+
+        Arguments:
+            tokens {int} -- Tokens received from all producers
+            chunks {int} -- Chunks sent to the client
+            status {str} -- "completed", "aborted" or "error"
+
+        Returns:
+            dict -- ttfb, duration, tokens, chunks, bytes, tokens_per_second, sanitize_seconds,
+                serialize_seconds and per producer ttft, wait (until the first token, from the
+                start of the producer), seconds, tokens, tokens_per_second and timed_out
+        """
+        end = time.perf_counter()
+        duration = end - self.start
+
+        producers = []
+        for producer in self.producers:
+            first_token = producer["first_token"]
+            seconds = (producer["end"] or end) - producer["start"]
+            producers.append({
+                "ttft": first_token - self.start if first_token is not None else None,
+                "wait": first_token - producer["start"] if first_token is not None else None,
+                "seconds": seconds,
+                "tokens": producer["tokens"] if producer["end"] is not None else None,
+                "tokens_per_second": producer["tokens"] / seconds
+                if producer["end"] is not None and seconds > 0 else None,
+                "timed_out": producer["timeouts"] > 0 if producer["end"] is not None else False,
+            })
+
+        return {
+            "status": status,
+            "ttfb": self.first_byte - self.start if self.first_byte is not None else None,
+            "duration": duration,
+            "tokens": tokens,
+            "chunks": chunks,
+            "bytes": self.bytes,
+            "tokens_per_second": tokens / duration if duration > 0 else None,
+            "sanitize_seconds": self.sanitize_seconds,
+            "serialize_seconds": self.serialize_seconds,
+            "producers": producers,
+        }
+
+
+class MetricsHook:
+    """ Receives the metrics of every chat response, the default does nothing
+
+    Subclass it and override observe to forward the metrics, e.g. to statsd.
+    """
+    def observe(self, metrics):
+        """Called after a stream ended
+
+        Arguments:
+            metrics {dict} -- StreamMetrics.to_dict with log_enqueue_seconds, the time it
+                took to build the log document and queue it in the log sink, None without
+                logger_collection. The insert itself runs later on the sink thread, its
+                latency is a gauge of the sink (see PrometheusMetrics log_sink)
+        """
+        pass
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class PrometheusMetrics(MetricsHook):
+    """ Aggregates the metrics of the chat responses in the Prometheus text format
+
+    The text of render() can be served by a route of the app, e.g.
+    metrics = PrometheusMetrics(log_sink=get_log_sink())
+    set_metrics_hook(metrics)
+    @app.server.route("/metrics")
+    def prometheus():
+        return flask.Response(metrics.render(), mimetype=CONTENT_TYPE)
+
+    Arguments:
+        prefix {str} -- The prefix of the metric names
+        log_sink {LogSink} -- Exports the counters and the insert latency of the sink as well
+
+    """
+    def __init__(self, prefix="dashpool_chat", log_sink=None):
+        self.prefix = prefix
+        self.log_sink = log_sink
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._counters = {"tokens": 0, "bytes": 0, "sanitize_seconds": 0.0,
+                          "serialize_seconds": 0.0, "log_enqueue_seconds": 0.0, "producer_timeouts": 0}
+        self._histograms = {
+            "ttfb_seconds": _Histogram(LATENCY_BUCKETS),
+            "ttft_seconds": _Histogram(LATENCY_BUCKETS),
+            "duration_seconds": _Histogram(LATENCY_BUCKETS),
+            "tokens_per_second": _Histogram(RATE_BUCKETS),
+        }
+
+    def observe(self, metrics):
+        with self._lock:
+            status = metrics["status"]
+            self._streams[status] = self._streams.get(status, 0) + 1
+            self._counters["tokens"] += metrics["tokens"]
+            self._counters["bytes"] += metrics["bytes"]
+            self._counters["sanitize_seconds"] += metrics["sanitize_seconds"]
+            self._counters["serialize_seconds"] += metrics["serialize_seconds"]
+            self._counters["log_enqueue_seconds"] += metrics.get("log_enqueue_seconds") or 0.0
+            if metrics["ttfb"] is not None:
+                self._histograms["ttfb_seconds"].observe(metrics["ttfb"])
+            self._histograms["duration_seconds"].observe(metrics["duration"])
+            for producer in metrics["producers"]:
+                if producer["ttft"] is not None:
+                    self._histograms["ttft_seconds"].observe(producer["ttft"])
+                if producer["tokens_per_second"] is not None:
+                    self._histograms["tokens_per_second"].observe(producer["tokens_per_second"])
+                if producer["timed_out"]:
+                    self._counters["producer_timeouts"] += 1
+
+    def render(self):
+        """The aggregated metrics
+
+        Returns:
+            str -- The Prometheus text exposition format
+        """
+        prefix = self.prefix
+        lines = []
+
+        with self._lock:
+            lines.append(f"# HELP {prefix}_streams_total Chat responses by how they ended")
+            lines.append(f"# TYPE {prefix}_streams_total counter")
+            for status, count in sorted(self._streams.items()):
+                lines.append(f'{prefix}_streams_total{{status="{status}"}} {count}')
+
+            for name, value in self._counters.items():
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+
+            for name, histogram in self._histograms.items():
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {count}')
+                lines.append(f'{prefix}_{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}_{name}_sum {histogram.sum}")
+                lines.append(f"{prefix}_{name}_count {histogram.count}")
+
+        if self.log_sink is not None:
+            for name, value in self.log_sink.stats().items():
+                if value is None:
+                    continue
+                lines.append(f"# TYPE {prefix}_log_sink_{name} gauge")
+                lines.append(f"{prefix}_log_sink_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# mimetype of PrometheusMetrics.render
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_hook = MetricsHook()
+
+
+def set_metrics_hook(hook):
+    """Set the process wide hook that receives the metrics of all responses
+
+    Arguments:
+        hook {MetricsHook} -- The hook, None restores the no-op default
+    """
+    global _hook
+    _hook = hook if hook is not None else MetricsHook()
+
+
+def get_metrics_hook():
+    return _hook
@@ -0,0 +1,204 @@
+import os
+import random
+import threading
+
+
+class ProfilePolicy:
+    """ Profile a sampled fraction of the chat streams with cProfile
+
+    The profile covers the serialization of the documents and every step of the stream,
+    including the iteration of the generators, sanitize_string, the encoding and the
+    compression. Async streams also profile the other tasks that run while the stream
+    awaits its producers. Writing the log document happens in the log sink thread and
+    is not part of the profile.
+
+    cProfile only sees the thread it is enabled in. The callables/generators that run in
+    reader threads (flush_policy with max_delay, producer_timeout or max_concurrency) and
+    the sync generators that async streams advance in the executor are profiled in those
+    threads and merged into the summary. The producers of a SingleFlight run in its thread
+    for all subscribers and are not profiled, the summary has complete False then, like
+    when a thread could not be profiled because another profiler was active in it.
+
+    Arguments:
+        sample_rate {float} -- Fraction of the streams that are profiled, between 0 and 1
+        top {int} -- Number of functions in the summary
+        sort {str} -- "cumulative" or "tottime", the order of the summary
+        directory {str} -- Also dump the full profiles as <stream id>.prof files for
+            pstats or snakeviz, None only attaches the summary to the log document
+
+    """
+    def __init__(self, sample_rate=0.01, top=25, sort="cumulative", directory=None):
+        if sort not in ("cumulative", "tottime"):
+            raise ValueError(f"Unknown sort order {sort}, use cumulative or tottime")
+        self.sample_rate = sample_rate
+        self.top = top
+        self.sort = sort
+        self.directory = directory
+
+    def sample(self):
+        """Decide if a stream is profiled
+
+        Returns:
+            StreamProfiler -- The profiler of the stream, None if it is not sampled
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        return StreamProfiler(self)
+
+
+class StreamProfiler:
+    """ The profile of one stream, enabled around every step of the stream
+
+    Arguments:
+        policy {ProfilePolicy} -- The settings
+
+    """
+    def __init__(self, policy):
+        import cProfile
+
+        self.policy = policy
+        self.profile = cProfile.Profile()
+        self.finished = False
+        # False if a part of the stream ran in a thread that is not profiled
+        self.complete = True
+
+        # the profiles of the other threads, (profile, running) by thread
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+
+    def enable(self):
+        if self.finished:
+            return
+        try:
+            self.profile.enable()
+        except ValueError:
+            # another profiler is active, e.g. a concurrent stream on Python 3.12+
+            self.finished = True
+            self.profile = None
+
+    def disable(self):
+        if not self.finished:
+            self.profile.disable()
+
+    def call(self, function, *args):
+        """Call function with the profile of the current thread, for the threads of the stream
+
+        Returns:
+            Any -- The result of the function
+        """
+        import cProfile
+
+        with self._lock:
+            entry = None
+            if not self.finished:
+                entry = getattr(self._local, "entry", None)
+                if entry is None:
+                    entry = self._local.entry = [cProfile.Profile(), False]
+                    self._threads.append(entry)
+                try:
+                    entry[0].enable()
+                    entry[1] = True
+                except ValueError:
+                    # another profiler is active in this thread
+                    self.complete = False
+                    entry = None
+
+        if entry is None:
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            entry[0].disable()
+            with self._lock:
+                entry[1] = False
+
+    def wrap(self, stream):
+        """Profile the steps of a stream"""
+        try:
+            while True:
+                self.enable()
+                try:
+                    piece = next(stream)
+                except StopIteration:
+                    return
+                finally:
+                    self.disable()
+                yield piece
+        finally:
+            self.enable()
+            try:
+                stream.close()
+            finally:
+                self.disable()
+
+    async def awrap(self, stream):
+        """Profile the steps of an async stream"""
+        try:
+            while True:
+                self.enable()
+                try:
+                    piece = await stream.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    self.disable()
+                yield piece
+        finally:
+            await stream.aclose()
+
+    def finish(self, name):
+        """Stop profiling and summarize the profile
+
+        Arguments:
+            name {str} -- The name of the profile file
+
+        Returns:
+            dict -- profile: the top functions with calls, own and cumulative seconds, the number
+                of other threads that were profiled and if the profile covers the whole stream,
+                profile_file: the path of the dumped profile if a directory is set
+        """
+        import pstats
+
+        if self.finished:
+            return {}
+        self.profile.disable()
+
+        with self._lock:
+            self.finished = True
+            # threads that still run, e.g. the producers of an aborted stream, are left out
+            profiles = [profile for profile, running in self._threads if not running]
+            if len(profiles) < len(self._threads):
+                self.complete = False
+
+        stats = pstats.Stats(self.profile)
+        for profile in profiles:
+            stats.add(profile)
+        index = 3 if self.policy.sort == "cumulative" else 2
+        top = sorted(stats.stats.items(), key=lambda item: item[1][index], reverse=True)[:self.policy.top]
+
+        result = {
+            "profile": {
+                "total_seconds": stats.total_tt,
+                "threads": len(profiles),
+                "complete": self.complete,
+                "functions": [
+                    {
+                        "function": f"{filename}:{line}({function})",
+                        "calls": calls,
+                        "primitive_calls": primitive_calls,
+                        "own_seconds": own,
+                        "cumulative_seconds": cumulative,
+                    }
+                    for (filename, line, function), (primitive_calls, calls, own, cumulative, _) in top
+                ],
+            }
+        }
+
+        if self.policy.directory is not None:
+            os.makedirs(self.policy.directory, exist_ok=True)
+            path = os.path.join(self.policy.directory, f"{name}.prof")
+            stats.dump_stats(path)
+            result["profile_file"] = path
+
+        return result
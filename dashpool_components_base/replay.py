@@ -0,0 +1,213 @@
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import threading
+import time
+
+from .sessions import SessionStore
+
+# the cache of the handler that is running, set by cache_responses
+_active_cache = contextvars.ContextVar("dashpool_response_cache", default=None)
+# the qualified name of the handler that is running, set by cache_responses and coalesce_requests
+_active_handler = contextvars.ContextVar("dashpool_handler", default=None)
+
+
+def _normalize(value):
+    """Case and whitespace insensitive form of the strings of a JSON value"""
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def inputs_key(inputs, user_data_fields=None, handler=None):
+    """A hash of the normalized query and history (case and whitespace are ignored),
+    the selected fields of the userData and the handler
+
+    Arguments:
+        inputs {dict} -- The inputs of the Response, as returned by get_promtflow_inputs
+        user_data_fields {list} -- The keys of the userData content that are part of the key,
+            None uses the whole userData
+        handler {str} -- The qualified name of the handler, see current_handler
+
+    Returns:
+        str -- The key, None if the inputs have no query
+    """
+    if not isinstance(inputs, dict) or "query" not in inputs:
+        return None
+
+    user_data = inputs.get("userData") or {}
+    if isinstance(user_data, dict):
+        user_data = user_data.get("content", user_data)
+    if user_data_fields is not None and isinstance(user_data, dict):
+        user_data = {field: user_data.get(field) for field in user_data_fields}
+
+    material = json.dumps({
+        "query": _normalize(inputs["query"]),
+        "history": _normalize(inputs.get("history") or []),
+        "userData": user_data,
+        "handler": handler,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """ Replays the recorded stream of a response if the same inputs come again
+
+    The key is a hash of the normalized query and history (case and whitespace are ignored),
+    the selected fields of the userData and the handler decorated with cache_responses, so
+    handlers can share a cache. Only streams that completed without errors
+    and timeouts are recorded. The entries expire ttl seconds after they were recorded.
+
+    Arguments:
+        max_entries {int} -- The least recently used entries are evicted beyond this number
+        ttl {float} -- Seconds an entry is replayed, None keeps entries until they are evicted
+        user_data_fields {list} -- The keys of the userData content that are part of the key,
+            None uses the whole userData
+        store {SessionStore} -- The backend, any object with get, set and delete. Defaults to
+            an in-memory LRU store
+
+    """
+    def __init__(self, max_entries=1000, ttl=3600, user_data_fields=None, store=None):
+        self.ttl = ttl
+        self.user_data_fields = user_data_fields
+        self.store = store if store is not None else SessionStore(max_sessions=max_entries, ttl=ttl)
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, inputs, handler=None):
+        """The cache key of the inputs
+
+        Arguments:
+            inputs {dict} -- The inputs of the Response, as returned by get_promtflow_inputs
+            handler {str} -- The qualified name of the handler, see current_handler
+
+        Returns:
+            str -- The key, None if the inputs can not be cached
+        """
+        return inputs_key(inputs, self.user_data_fields, handler)
+
+    def get(self, key):
+        """Load the recorded stream
+
+        Returns:
+            dict -- {"documents": list[dict], "replies": list[str], "generated_refs": list[str]},
+                None on a miss
+        """
+        entry = self.store.get(key)
+        if entry is not None and self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            self.store.delete(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, documents, replies, generated_refs=()):
+        """Record a stream
+
+        Arguments:
+            key {str} -- The key of the inputs
+            documents {list} -- The documents as dicts, without generated ids
+            replies {list} -- The text of every callable/generator
+            generated_refs {list} -- The refs of the documents that were assigned by the
+                response, a replay in a conversation assigns new ones
+        """
+        self.store.set(key, {
+            "created": time.time(),
+            "documents": documents,
+            "replies": replies,
+            "generated_refs": list(generated_refs),
+        })
+
+
+def handler_name(handler):
+    """The qualified name of a handler, part of the keys of the cache and the single flight"""
+    return f"{handler.__module__}.{handler.__qualname__}"
+
+
+def wrap_handler(handler, var, get_value):
+    """Wrap a sync or async handler, var is set to get_value() and the running handler is
+    recorded while it runs"""
+    name = handler_name(handler)
+
+    if inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def async_wrapper(*args, **kwargs):
+            token = var.set(get_value())
+            handler_token = _active_handler.set(name)
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                _active_handler.reset(handler_token)
+                var.reset(token)
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        token = var.set(get_value())
+        handler_token = _active_handler.set(name)
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            _active_handler.reset(handler_token)
+            var.reset(token)
+    return wrapper
+
+
+def cache_responses(cache=None):
+    """Decorator of a chat handler, the Responses created in the handler use the cache
+
+    @app.server.route("/ai", methods=["POST"])
+    @chatutils.cache_responses(cache)
+    def ai():
+        ...
+
+    Arguments:
+        cache {ResponseCache} -- The cache, defaults to the process wide cache. The entries
+            of different handlers are kept apart
+    """
+    def decorator(handler):
+        return wrap_handler(handler, _active_cache,
+                            lambda: cache if cache is not None else get_response_cache())
+
+    return decorator
+
+
+def current_handler():
+    """The qualified name of the running handler, None outside of cache_responses and
+    coalesce_requests"""
+    return _active_handler.get()
+
+
+def current_cache():
+    """The cache of the running handler, None outside of cache_responses"""
+    return _active_cache.get()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The process wide response cache, created on first use
+
+    Returns:
+        ResponseCache -- The shared cache
+    """
+    global _default_cache
+
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ResponseCache()
+    return _default_cache
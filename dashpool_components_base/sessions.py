@@ -0,0 +1,249 @@
+import collections
+import hashlib
+import threading
+import time
+
+# response header with the version of the conversation after the response
+VERSION_HEADER = "X-Dashpool-Conversation-Version"
+
+
+class SessionStore:
+    """ An in-memory LRU store of conversations that expire when they are not used
+
+    Any object with the methods get, set and delete can replace it, e.g. a wrapper of
+    a shared cache if the app runs in several worker processes.
+
+    Arguments:
+        max_sessions {int} -- The least recently used sessions are evicted beyond this number
+        ttl {float} -- Seconds after the last use until a session expires, None keeps sessions
+
+    """
+    def __init__(self, max_sessions=1000, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, id):
+        """Load a session
+
+        Returns:
+            dict -- The session, None if it is unknown or expired
+        """
+        with self._lock:
+            entry = self._sessions.get(id)
+            if entry is None:
+                return None
+            session, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._sessions[id]
+                return None
+            self._sessions.move_to_end(id)
+            if self.ttl is not None:
+                self._sessions[id] = (session, time.monotonic() + self.ttl)
+            return session
+
+    def set(self, id, session):
+        """Store a session
+
+        Arguments:
+            id {str} -- The conversation id
+            session {dict} -- The session, {"version": int, "content": list, "references": dict,
+                "ref_counter": int}
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._sessions[id] = (session, expires)
+            self._sessions.move_to_end(id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, id):
+        with self._lock:
+            self._sessions.pop(id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class ConversationMismatch(Exception):
+    """ The server does not know the conversation in the version of the request,
+    the client has to resend the full conversation """
+
+    status = 409
+
+    def response(self):
+        """The response asking the Chat component to resend the full conversation"""
+        import flask
+
+        return flask.jsonify({"error": str(self), "resend": True}), self.status
+
+
+class Conversation:
+    """ The content of a chat request, restored from the session store if the client only
+    sent the new messages
+
+    Arguments:
+        content {list} -- The full content list, like the request body of a client without sessions
+        id {str} -- The conversation id, None if the client does not use sessions
+        version {int} -- The version of the conversation before the response
+        store {SessionStore} -- The store of the conversation
+        references {dict} -- The content hashes of the documents the client holds, with their refs
+        ref_counter {int} -- The number of the next ref that is assigned automatically
+
+    """
+    def __init__(self, content, id=None, version=0, store=None, references=None, ref_counter=0):
+        self.content = content
+        self.id = id
+        self.version = version
+        self.store = store
+        self.references = references if references is not None else {}
+        self.ref_counter = ref_counter
+        # the documents of the response, the client holds them once it is committed
+        self._new_references = {}
+
+    @classmethod
+    def from_request(cls, payload, store=None):
+        """Restore the conversation of a request
+
+        The Chat component sends either the content list, or with sessions
+        {"conversation": {"id": str, "version": int, "full": bool}, "content": list}
+        where content holds only the new messages unless full is set. sharedData is only
+        sent if it changed.
+
+        Arguments:
+            payload {list|dict} -- The JSON body of the request
+            store {SessionStore} -- The store, defaults to the process wide store
+
+        Raises:
+            ConversationMismatch -- If the store does not hold the version of the request
+
+        Returns:
+            Conversation -- The conversation
+        """
+        if isinstance(payload, list):
+            return cls(payload)
+
+        conversation = payload["conversation"]
+        id = conversation["id"]
+        version = conversation.get("version") or 0
+        content = payload.get("content", [])
+
+        if store is None:
+            store = get_session_store()
+
+        if conversation.get("full"):
+            return cls(list(content), id, version, store)
+
+        session = store.get(id)
+        if session is None:
+            raise ConversationMismatch(f"Unknown conversation {id}")
+        if session["version"] != version:
+            raise ConversationMismatch(
+                f"Conversation {id} is at version {session['version']}, not {version}")
+
+        merged = list(session["content"])
+        for message in content:
+            if message.get("role") == "sharedData":
+                # replaces the shared data of the session
+                merged = [el for el in merged if el.get("role") != "sharedData"]
+                merged.insert(0, message)
+            else:
+                merged.append(message)
+
+        return cls(merged, id, version, store,
+                   references=dict(session.get("references", {})),
+                   ref_counter=session.get("ref_counter", 0))
+
+    @property
+    def next_version(self):
+        return self.version + 1
+
+    def reference(self, key):
+        """The ref under which the client holds a document
+
+        Arguments:
+            key {str} -- The content hash of the document, see document_key
+
+        Returns:
+            str -- The ref, None if the document was not sent in this conversation
+        """
+        ref = self._new_references.get(key)
+        return ref if ref is not None else self.references.get(key)
+
+    def new_ref(self):
+        """A ref that no document of the conversation uses"""
+        used = set(self.references.values()) | set(self._new_references.values())
+        while True:
+            ref = "doc" + str(self.ref_counter)
+            self.ref_counter += 1
+            if ref not in used:
+                return ref
+
+    def register(self, key, ref):
+        """Remember a document that is sent with the response
+
+        Arguments:
+            key {str} -- The content hash of the document
+            ref {str} -- Its ref, the client keeps the last document sent with a ref
+        """
+        for other in [k for k, r in self._new_references.items() if r == ref]:
+            del self._new_references[other]
+        self._new_references[key] = ref
+
+    def commit(self, messages):
+        """Store the conversation with the messages and the documents of the response
+
+        Arguments:
+            messages {list} -- The assistant messages, as the client stores them
+        """
+        if self.id is None:
+            return
+        self.content = self.content + messages
+        self.version = self.next_version
+
+        replaced = set(self._new_references.values())
+        self.references = {key: ref for key, ref in self.references.items() if ref not in replaced}
+        self.references.update(self._new_references)
+        self._new_references = {}
+
+        self.store.set(self.id, {
+            "version": self.version,
+            "content": self.content,
+            "references": self.references,
+            "ref_counter": self.ref_counter,
+        })
+
+
+def document_key(document):
+    """The content hash of a document, without its ref and id
+
+    Arguments:
+        document {dict} -- The document, as sent to the client
+
+    Returns:
+        str -- The key of the document in the references of a conversation
+    """
+    from . import encoding
+
+    content = {key: value for key, value in document.items() if key not in ("ref", "id")}
+    return hashlib.sha256(encoding.dumpb(content)).hexdigest()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """The process wide session store, created on first use
+
+    Returns:
+        SessionStore -- The shared store
+    """
+    global _default_store
+
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = SessionStore()
+    return _default_store
@@ -0,0 +1,297 @@
+import contextvars
+import copy
+import queue
+import threading
+
+from .replay import inputs_key, wrap_handler
+
+# the single flight of the handler that is running, set by coalesce_requests
+_active_single_flight = contextvars.ContextVar("dashpool_single_flight", default=None)
+
+# markers in the event log of a flight
+_END = object()
+_DONE = object()
+
+
+class _Emitted:
+    """ An item emitted by the producers, every subscriber writes it into its response """
+    __slots__ = ("item",)
+
+    def __init__(self, item):
+        self.item = item
+
+
+class SingleFlight:
+    """ Coalesces concurrent responses with the same inputs onto one run of their producers
+
+    The first response of a key starts its callables/generators in a background thread,
+    responses with the same inputs that arrive while it runs subscribe to it instead of
+    running their own. Every subscriber, the first one included, reads the tokens from its
+    own bounded buffer. Late joiners first receive the tokens produced so far.
+
+    A subscriber that does not keep up with the producer never blocks it: when its buffer
+    is full, it continues from the token log of the flight until it caught up. The producers
+    are stopped when all subscribers went away. Items the producers emit are part of the
+    log, so followers and late joiners receive them like the tokens.
+
+    Only sync callables/generators are coalesced, responses with async producers or with
+    max_concurrency and several producers run their own.
+
+    Arguments:
+        buffer_size {int} -- Number of tokens buffered per subscriber
+        user_data_fields {list} -- The keys of the userData content that are part of the key,
+            None uses the whole userData
+
+    """
+    def __init__(self, buffer_size=256, user_data_fields=None):
+        self.buffer_size = buffer_size
+        self.user_data_fields = user_data_fields
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def key(self, inputs, handler=None):
+        """The key of the inputs and the handler, see replay.inputs_key"""
+        return inputs_key(inputs, self.user_data_fields, handler)
+
+    def join(self, key, producers, start=True):
+        """Subscribe to the running flight of the key, or start one with the producers
+
+        Arguments:
+            key {str} -- The key of the inputs
+            producers {list} -- The sync callables/generators of the response
+            start {bool} -- Start the producers of a new flight, if False the caller starts
+                them with subscription.flight.start() once it is ready for their items
+
+        Returns:
+            tuple[Subscription, bool] -- The subscription and True if the producers were started
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight(self, key, producers)
+                self._flights[key] = flight
+            subscription = flight.subscribe()
+
+        if leader and start:
+            flight.start()
+        return subscription, leader
+
+    def _finished(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def __len__(self):
+        return len(self._flights)
+
+
+class _Flight:
+    """ One run of the producers, the log of its tokens and its subscribers """
+    def __init__(self, single_flight, key, producers):
+        self.single_flight = single_flight
+        self.key = key
+        self.producers = producers
+        # (producer index, token | _END | exception), (None, _Emitted) and finally (None, _DONE)
+        self.events = []
+        self.subscribers = set()
+        self.cancelled = False
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        with self._lock:
+            subscription = Subscription(self, len(self.events), self.single_flight.buffer_size)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscribers.discard(subscription)
+            if not self.subscribers and not self.finished:
+                # nobody is listening, new requests start a new flight
+                self.cancelled = True
+                self.single_flight._finished(self)
+
+    def _publish(self, index, item):
+        with self._lock:
+            self._append(index, item)
+
+    def _append(self, index, item):
+        self.events.append((index, item))
+        for subscription in self.subscribers:
+            if not subscription.lagging:
+                try:
+                    subscription.buffer.put_nowait((index, item))
+                except queue.Full:
+                    subscription.lagging = True
+
+    def emit(self, item):
+        """Publish an item emitted by the producers to all subscribers
+
+        Returns:
+            bool -- False if the flight is finished and the item was not published
+        """
+        with self._lock:
+            if self.finished:
+                return False
+            self._append(None, _Emitted(item))
+        return True
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            for index, producer in enumerate(self.producers):
+                if self.cancelled:
+                    break
+                iterator = producer() if callable(producer) else producer
+                try:
+                    for item in iterator:
+                        if self.cancelled:
+                            break
+                        self._publish(index, item)
+                finally:
+                    if self.cancelled and hasattr(iterator, "close"):
+                        iterator.close()
+                self._publish(index, _END)
+        except Exception as e:
+            self._publish(index, e)
+        finally:
+            # later requests with the same inputs start a new flight
+            self.single_flight._finished(self)
+            with self._lock:
+                self.finished = True
+            self._publish(None, _DONE)
+
+
+class Subscription:
+    """ The view of one response on a flight
+
+    Arguments:
+        flight {_Flight} -- The flight
+        live {int} -- The number of events that were produced before subscribing
+        buffer_size {int} -- The size of the buffer of the live events
+
+    """
+    def __init__(self, flight, live, buffer_size):
+        self.flight = flight
+        # called with a copy of every emitted item, while the producers are read
+        self.on_emit = None
+        # the log position of the next event and the first one that is buffered
+        self.position = 0
+        self.live = live
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.lagging = False
+        self.done = False
+
+    @property
+    def count(self):
+        """The number of producers of the flight"""
+        return len(self.flight.producers)
+
+    def _next_event(self):
+        flight = self.flight
+
+        if self.position < self.live:
+            # the prefix produced before joining
+            event = flight.events[self.position]
+        else:
+            try:
+                event = self.buffer.get_nowait()
+            except queue.Empty:
+                with flight._lock:
+                    if self.lagging and self.position < len(flight.events):
+                        # the buffer overflowed, continue from the log
+                        event = flight.events[self.position]
+                    else:
+                        # caught up, the next events are buffered again
+                        self.lagging = False
+                        event = None
+                if event is None:
+                    event = self.buffer.get()
+
+        self.position += 1
+        return event
+
+    def producer(self, index):
+        """The tokens of one producer of the flight
+
+        Arguments:
+            index {int} -- The index of the producer, they have to be read in order
+
+        Returns:
+            Iterator[str] -- The tokens
+        """
+        while not self.done:
+            event_index, item = self._next_event()
+            if item is _DONE:
+                self.done = True
+                return
+            if item is _END:
+                if event_index == index:
+                    return
+                continue
+            if isinstance(item, _Emitted):
+                if self.on_emit is not None:
+                    # the responses serialize the item and set its ref and id
+                    self.on_emit(copy.deepcopy(item.item))
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop receiving tokens, the producers stop if nobody else is subscribed"""
+        self.flight.unsubscribe(self)
+        self.done = True
+        try:
+            # wake up a reader that waits for the next token
+            self.buffer.put_nowait((None, _DONE))
+        except queue.Full:
+            pass
+
+
+def coalesce_requests(single_flight=None):
+    """Decorator of a chat handler, the Responses created in the handler with the same inputs
+    as a running one share its producers
+
+    @app.server.route("/ai", methods=["POST"])
+    @chatutils.coalesce_requests()
+    def ai():
+        ...
+
+    Arguments:
+        single_flight {SingleFlight} -- The flights, defaults to the process wide instance.
+            Only responses of the same handler are coalesced
+    """
+    def decorator(handler):
+        return wrap_handler(handler, _active_single_flight,
+                            lambda: single_flight if single_flight is not None else get_single_flight())
+
+    return decorator
+
+
+def current_single_flight():
+    """The single flight of the running handler, None outside of coalesce_requests"""
+    return _active_single_flight.get()
+
+
+_default_single_flight = None
+_default_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """The process wide single flight, created on first use
+
+    Returns:
+        SingleFlight -- The shared instance
+    """
+    global _default_single_flight
+
+    if _default_single_flight is None:
+        with _default_single_flight_lock:
+            if _default_single_flight is None:
+                _default_single_flight = SingleFlight()
+    return _default_single_flight
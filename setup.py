@@ -23,6 +23,10 @@ setup(
     long_description= long_description,
     long_description_content_type="text/markdown",        
     install_requires=[],
+    extras_require={
+        'fast': ['orjson'],
+        'brotli': ['brotli'],
+    },
     classifiers=[
         'Framework :: Dash',
     ],
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import { DashpoolEvent, TreeViewNode, setDashpoolEvent } from '../helper';
 import { useDashpoolData } from './DashpoolProvider';
 import {
@@ -77,10 +77,23 @@ type ChatProps = {
      */
     referenceTarget?: string;
 
+    /**
+     * flag if the server keeps the conversation in a session (chatutils.Conversation),
+     * then only the new message is sent with the conversation id and version
+     */
+    conversationSession?: boolean;
+
 
     setProps: (props: Record<string, any>) => void;
 }
 
+function newConversationId(): string {
+    if (typeof crypto !== 'undefined' && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
 async function fireEventsWithDelay(events, setPropsFunction) {
     for (const event of events) {
         await new Promise(resolve => setTimeout(resolve, 100));
@@ -95,6 +108,8 @@ async function fireEventsWithDelay(events, setPropsFunction) {
 
 type MarkdownWrapperProps = {
     content: string;
+    // the [ref] citations of the content as [offset, length, ref], indexed by the server
+    spans?: [number, number, string][];
     referenceMessages: Map<string, any>;
     setProps: (props: Record<string, any>) => void;
     dashpoolEventOnClick?: boolean;
@@ -103,6 +118,7 @@ type MarkdownWrapperProps = {
 
 const MarkdownWrapper: React.FC<MarkdownWrapperProps> = ({
     content,
+    spans,
     referenceMessages,
     setProps,
     dashpoolEventOnClick,
@@ -209,12 +225,41 @@ const MarkdownWrapper: React.FC<MarkdownWrapperProps> = ({
     }
 
 
+    // with the citation index of the server, the refs are replaced once without searching the content
+    let markdown = content;
+    let indexed = false;
+
+    if (spans && spans.length > 0) {
+        indexed = true;
+        const parts: string[] = [];
+        let last = 0;
+
+        spans.forEach(([offset, length, ref]) => {
+            if (offset < last || offset + length > content.length || !referenceMessages.has(ref)) {
+                return;
+            }
+
+            if (!messageLookup[ref]) {
+                currentIndex++;
+                messageMap[`internalRef${currentIndex}`] = referenceMessages.get(ref);
+                messageLookup[ref] = currentIndex;
+            }
+
+            parts.push(content.slice(last, offset), `[internalRef${messageLookup[ref]}]`);
+            last = offset + length;
+        });
+
+        parts.push(content.slice(last));
+        markdown = parts.join('');
+    }
+
+
     const renderContentWithPopover = (content: string) => {
 
 
 
-        // find all the appearances of [???] in the content
-        const referenc_appearances = content.match(/\[(.*?)\]/g);
+        // find all the appearances of [???] in the content, unless the server indexed them
+        const referenc_appearances = indexed ? null : content.match(/\[(.*?)\]/g);
 
         if (referenc_appearances) {
             referenc_appearances.forEach((appearance) => {
@@ -353,7 +398,7 @@ const MarkdownWrapper: React.FC<MarkdownWrapperProps> = ({
         },
     };
 
-    return <Markdown components={renderers} remarkPlugins={[remarkGfm]} urlTransform={(value: string) => value} >{content}</Markdown>;
+    return <Markdown components={renderers} remarkPlugins={[remarkGfm]} urlTransform={(value: string) => value} >{markdown}</Markdown>;
 };
 
 
@@ -364,7 +409,7 @@ const toChatMessage = (message: any, referenceMessages: Map<string, any>, setPro
         return {
             position: 'left',
             type: 'text',
-            text: <MarkdownWrapper content={message.content} referenceMessages={referenceMessages} setProps={setProps} dashpoolEventOnClick={dashpoolEventOnClick} referenceTarget={referenceTarget} />,
+            text: <MarkdownWrapper content={message.content} spans={message.spans} referenceMessages={referenceMessages} setProps={setProps} dashpoolEventOnClick={dashpoolEventOnClick} referenceTarget={referenceTarget} />,
             //text: message.content,
             avatar: "data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIHhtbG5zOnhsaW5rPSJodHRwOi8vd3d3LnczLm9yZy8xOTk5L3hsaW5rIiB2aWV3Qm94PSIwIDAgMjcwIDI3MCIgd2lkdGg9IjI3MCIgaGVpZ2h0PSIyNzAiPgogICAgPHN0eWxlPgogICAgICAgIEBrZXlmcmFtZXMgZGFzaFBvb2xMb2dvX2JveE1vdmUgewogICAgICAgICAgICAwJSB7CiAgICAgICAgICAgICAgICB0cmFuc2Zvcm06IHRyYW5zbGF0ZSgwLCAwKTsKICAgICAgICAgICAgfQoKICAgICAgICAgICAgNTAlIHsKICAgICAgICAgICAgICAgIHRyYW5zZm9ybTogdHJhbnNsYXRlKDAsIC01JSk7CiAgICAgICAgICAgIH0KCiAgICAgICAgICAgIDEwMCUgewogICAgICAgICAgICAgICAgdHJhbnNmb3JtOiB0cmFuc2xhdGUoMCwgMCk7CiAgICAgICAgICAgIH0KICAgICAgICB9CgogICAgICAgIEBrZXlmcmFtZXMgZGFzaFBvb2xMb2dvX2RvdE1vdmUgewogICAgICAgICAgICAwJSB7CiAgICAgICAgICAgICAgICB0cmFuc2Zvcm06IHNjYWxlKDAuMSkgdHJhbnNsYXRlKDEwJSwgMTAlICkgOwogICAgICAgICAgICAgICAgb3BhY2l0eTogMS4wOwogICAgICAgICAgICB9CgogICAgICAgICAgICAyMCUgewogICAgICAgICAgICAgICAgdHJhbnNmb3JtOiBzY2FsZSgxLjEpICB0cmFuc2xhdGUoLTElLCAtMSUgKSA7CiAgICAgICAgICAgIH0KCiAgICAgICAgICAgIDUwJSB7CiAgICAgICAgICAgICAgICB0cmFuc2Zvcm06IHNjYWxlKDEpIHRyYW5zbGF0ZSgwLCAwICk7CiAgICAgICAgICAgICAgICBvcGFjaXR5OiAxOwogICAgICAgICAgICB9CgogICAgICAgICAgICA5MCUgewogICAgICAgICAgICAgICAgc2NhbGUoMS4wMSk6CiAgICAgICAgICAgICAgICBvcGFjaXR5OiAxOwogICAgICAgICAgICB9CgogICAgICAgICAgICAxMDAlIHsKICAgICAgICAgICAgICAgIHRyYW5zZm9ybTogc2NhbGUoMS41KSB0cmFuc2xhdGUoLTIlLCAtMiUgKTsKICAgICAgICAgICAgICAgIG9wYWNpdHk6IDA7CiAgICAgICAgICAgIH0KICAgICAgICB9CiAgICA8L3N0eWxlPgogICAgPHJlY3Qgd2lkdGg9IjEwMCUiIGhlaWdodD0iMTAwJSIgcng9IjEyJSIgZmlsbD0icmdiKDI1NSwxMDIsMCkiIC8+CiAgICA8cmVjdCB4PSI2JSIgeT0iOCUiIHJ4PSI3LjI5IiByeT0iNy4yOSIgaGVpZ2h0PSI4NSUiIHdpZHRoPSI2LjMlIiBzdHlsZT0iZmlsbDpyZ2IoMjA0LDIwNCwyMDQpO3Bvc2l0aW9uOmFic29sdXRlOyIvPgogICAgPHJlY3QgeD0iNiUiIHk9Ijg4JSIgcng9IjcuMjkiIHJ5PSI3LjI5IiBoZWlnaHQ9IjYuMyUiIHdpZHRoPSI4NyUiIHN0eWxlPSJmaWxsOnJnYigyMDQsMjA0LDIwNCk7cG9zaXRpb246YWJzb2x1dGU7Ii8+CiAgICA8cmVjdCB4PSIxOC42JSIgeT0iNDAlIiByeD0iMTQuODUiIHJ5PSIxNC44NSIgaGVpZ2h0PSIyOCUiIHdpZHRoPSIxMiUiIHN0eWxlPSJmaWxsOnJnYigyMDQsMjA0LDIwNCk7cG9zaXRpb246YWJzb2x1dGU7YW5pbWF0aW9uLW5hbWU6ZGFzaFBvb2xMb2dvX2JveE1vdmU7YW5pbWF0aW9uLWl0ZXJhdGlvbi1jb3VudDppbmZpbml0ZTthbmltYXRpb24tdGltaW5nLWZ1bmN0aW9uOmVhc2U7YW5pbWF0aW9uLWZpbGwtbW9kZTpib3RoO2FuaW1hdGlvbi1kdXJhdGlvbjoxczthbmltYXRpb24tZGVsYXk6MHM7Ii8+CiAgICA8cmVjdCB4PSIzNi42JSIgeT0iNDUlIiByeD0iMTQuODUiIHJ5PSIxNC44NSIgaGVpZ2h0PSIyOCUiIHdpZHRoPSIxMiUiIHN0eWxlPSJmaWxsOnJnYigyMDQsMjA0LDIwNCk7cG9zaXRpb246YWJzb2x1dGU7YW5pbWF0aW9uLW5hbWU6ZGFzaFBvb2xMb2dvX2JveE1vdmU7YW5pbWF0aW9uLWl0ZXJhdGlvbi1jb3VudDppbmZpbml0ZTthbmltYXRpb24tdGltaW5nLWZ1bmN0aW9uOmVhc2U7YW5pbWF0aW9uLWZpbGwtbW9kZTpib3RoO2FuaW1hdGlvbi1kdXJhdGlvbjoxczthbmltYXRpb24tZGVsYXk6MC4xczsiLz4KICAgIDxyZWN0IHg9IjU1LjMlIiB5PSIyNSUiIHJ4PSIxNC44NSIgcnk9IjE0Ljg1IiBoZWlnaHQ9IjI4JSIgd2lkdGg9IjEyJSIgc3R5bGU9ImZpbGw6cmdiKDIwNCwyMDQsMjA0KTtwb3NpdGlvbjphYnNvbHV0ZTthbmltYXRpb24tbmFtZTpkYXNoUG9vbExvZ29fYm94TW92ZTthbmltYXRpb24taXRlcmF0aW9uLWNvdW50OmluZmluaXRlO2FuaW1hdGlvbi10aW1pbmctZnVuY3Rpb246ZWFzZTthbmltYXRpb24tZmlsbC1tb2RlOmJvdGg7YW5pbWF0aW9uLWR1cmF0aW9uOjFzO2FuaW1hdGlvbi1kZWxheTowLjJzOyIvPgogICAgPHJlY3QgeD0iNzMuNiUiIHk9IjI3JSIgcng9IjE0Ljg1IiByeT0iMTQuODUiIGhlaWdodD0iMjglIiB3aWR0aD0iMTIlIiBzdHlsZT0iZmlsbDpyZ2IoMjA0LDIwNCwyMDQpO3Bvc2l0aW9uOmFic29sdXRlO2FuaW1hdGlvbi1uYW1lOmRhc2hQb29sTG9nb19ib3hNb3ZlO2FuaW1hdGlvbi1pdGVyYXRpb24tY291bnQ6aW5maW5pdGU7YW5pbWF0aW9uLXRpbWluZy1mdW5jdGlvbjplYXNlO2FuaW1hdGlvbi1maWxsLW1vZGU6Ym90aDthbmltYXRpb24tZHVyYXRpb246MXM7YW5pbWF0aW9uLWRlbGF5OjAuM3M7Ii8+CgogICAgPGcgdHJhbnNmb3JtPSJ0cmFuc2xhdGUoNTIuOTIgMTk0LjQpIj4KICAgICAgICA8cmVjdCByeD0iOS45OSIgcnk9IjkuOTkiIGhlaWdodD0iMTAlIiB3aWR0aD0iOS44JSIgc3R5bGU9ImZpbGw6cmdiKDI1NSwyNTUsMjU1KTtwb3NpdGlvbjphYnNvbHV0ZTthbmltYXRpb24tbmFtZTpkYXNoUG9vbExvZ29fZG90TW92ZTthbmltYXRpb24taXRlcmF0aW9uLWNvdW50OmluZmluaXRlO2FuaW1hdGlvbi10aW1pbmctZnVuY3Rpb246ZWFzZTthbmltYXRpb24tZmlsbC1tb2RlOmJvdGg7YW5pbWF0aW9uLWR1cmF0aW9uOjFzO2FuaW1hdGlvbi1kZWxheTotMC40czsiLz4KICAgIDwvZz4KICAgIDxnIHRyYW5zZm9ybT0idHJhbnNsYXRlKDEwMS41MiA1NS45KSI+CiAgICAgICAgPHJlY3Qgcng9IjkuOTkiIHJ5PSI5Ljk5IiBoZWlnaHQ9IjEwJSIgd2lkdGg9IjkuOCUiIHN0eWxlPSJmaWxsOnJnYigyNTUsMjU1LDI1NSk7cG9zaXRpb246YWJzb2x1dGU7YW5pbWF0aW9uLW5hbWU6ZGFzaFBvb2xMb2dvX2RvdE1vdmU7YW5pbWF0aW9uLWl0ZXJhdGlvbi1jb3VudDppbmZpbml0ZTthbmltYXRpb24tdGltaW5nLWZ1bmN0aW9uOmVhc2U7YW5pbWF0aW9uLWZpbGwtbW9kZTpib3RoO2FuaW1hdGlvbi1kdXJhdGlvbjoxczthbmltYXRpb24tZGVsYXk6LTAuMnM7Ii8+CiAgICA8L2c+CiAgICA8ZyB0cmFuc2Zvcm09InRyYW5zbGF0ZSgyMDEuNjkgMjEuNikiPgogICAgICAgIDxyZWN0IHJ4PSI5Ljk5IiByeT0iOS45OSIgaGVpZ2h0PSIxMCUiIHdpZHRoPSI5LjglIiBzdHlsZT0iZmlsbDpyZ2IoMjU1LDI1NSwyNTUpO3Bvc2l0aW9uOmFic29sdXRlO2FuaW1hdGlvbi1uYW1lOmRhc2hQb29sTG9nb19kb3RNb3ZlO2FuaW1hdGlvbi1pdGVyYXRpb24tY291bnQ6aW5maW5pdGU7YW5pbWF0aW9uLXRpbWluZy1mdW5jdGlvbjplYXNlO2FuaW1hdGlvbi1maWxsLW1vZGU6Ym90aDthbmltYXRpb24tZHVyYXRpb246MXM7YW5pbWF0aW9uLWRlbGF5OjAuMHM7Ii8+CiAgICA8L2c+CiAgICA8ZyB0cmFuc2Zvcm09InRyYW5zbGF0ZSgyMDEuNjkgMTUzLjkpIj4KICAgICAgICA8cmVjdCByeD0iOS45OSIgcnk9IjkuOTkiIGhlaWdodD0iMTAlIiB3aWR0aD0iOS44JSIgc3R5bGU9ImZpbGw6cmdiKDI1NSwyNTUsMjU1KTtwb3NpdGlvbjphYnNvbHV0ZTthbmltYXRpb24tbmFtZTpkYXNoUG9vbExvZ29fZG90TW92ZTthbmltYXRpb24taXRlcmF0aW9uLWNvdW50OmluZmluaXRlO2FuaW1hdGlvbi10aW1pbmctZnVuY3Rpb246ZWFzZTthbmltYXRpb24tZmlsbC1tb2RlOmJvdGg7YW5pbWF0aW9uLWR1cmF0aW9uOjFzO2FuaW1hdGlvbi1kZWxheTowLjJzOyIvPgogICAgPC9nPgo8L3N2Zz4=",
             className: "assistant-message",
@@ -457,6 +502,57 @@ const Chat = (props: ChatProps) => {
 
     const [inputDisabled, setInputDisabled] = useState(false);
 
+    // the conversation session on the server, version is null if the server has to get all messages
+    const conversationId = useRef<string>(newConversationId());
+    const conversationVersion = useRef<number | null>(null);
+    const sentSharedData = useRef<string | null>(null);
+    // the documents of the conversation by ref, the server sends a refPointer for documents it already sent
+    const conversationDocuments = useRef<Map<string, any>>(new Map());
+    // the citation index of the assistant messages by message id
+    const messageSpans = useRef<Map<string, [number, number, string][]>>(new Map());
+
+    // aborts the running request, the server then stops the generators of the response
+    const streamAbort = useRef<AbortController | null>(null);
+
+    const resetConversation = (newId: boolean) => {
+        if (newId) {
+            conversationId.current = newConversationId();
+        }
+        conversationVersion.current = null;
+        sentSharedData.current = null;
+        conversationDocuments.current = new Map();
+        messageSpans.current = new Map();
+    };
+
+    // the request body, with a session only the new message and changed sharedData
+    const requestBody = (full: boolean) => {
+        const sharedDataMessage = { role: 'sharedData', content: sharedData };
+
+        if (!props.conversationSession) {
+            return JSON.stringify([sharedDataMessage, ...currentMessages]);
+        }
+
+        const sharedDataJson = JSON.stringify(sharedData);
+
+        if (full || conversationVersion.current === null) {
+            sentSharedData.current = sharedDataJson;
+            return JSON.stringify({
+                conversation: { id: conversationId.current, version: conversationVersion.current || 0, full: true },
+                content: [sharedDataMessage, ...currentMessages],
+            });
+        }
+
+        const content: any[] = [currentMessages[currentMessages.length - 1]];
+        if (sharedDataJson !== sentSharedData.current) {
+            content.unshift(sharedDataMessage);
+            sentSharedData.current = sharedDataJson;
+        }
+        return JSON.stringify({
+            conversation: { id: conversationId.current, version: conversationVersion.current },
+            content: content,
+        });
+    };
+
     // State to manage user input
     const [userInput, setUserInput] = useState('');
 
@@ -474,6 +570,81 @@ const Chat = (props: ChatProps) => {
 
 
 
+    function handleMessage(message, known_ids, events) {
+
+        if (message.role === "photo" || message.role === "pdf" || message.role === "reference") {
+            if (message.ref) {
+                conversationDocuments.current.set(message.ref, message);
+            }
+        }
+
+        if (message.role === "assistant" && messageSpans.current.has(message.id)) {
+            message = { ...message, spans: messageSpans.current.get(message.id) };
+        }
+
+        if (message.role === "spans") {
+            // the citation index of an assistant message, sent after the message
+            messageSpans.current.set(message.id, message.spans);
+        } else if (message.role === "refPointer") {
+            // a document of an earlier turn, shown again under the ref of this response
+            const held = conversationDocuments.current.get(message.target);
+            if (held) {
+                handleMessage({ ...held, ref: message.ref, id: message.id }, known_ids, events);
+            }
+        } else if (message.role === "assistant" || message.role === "photo" || message.role === "pdf" || message.role === "reference") {
+
+
+            if ("show" in message && message.show === false) {
+
+                //check if a ref is in the message
+                if ("ref" in message) {
+                    //add the message to the referenceMessages
+                    referenceMessages.set(message.ref, message);
+                    setReferenceMessages(referenceMessages);
+                }
+
+
+            } else {
+
+                if (known_ids.includes(message.id)) {
+                    //update the message with the new content
+                    setChatMessages((prevMessages) => [
+                        ...prevMessages.splice(0, prevMessages.length - 1),
+                        toChatMessage(message, referenceMessages, setProps, dashpoolEventOnClick, referenceTarget),
+                    ]);
+
+                } else {
+                    known_ids.push(message.id)
+
+                    //add the message to the output
+                    setChatMessages((prevMessages) => [
+                        ...prevMessages,
+                        toChatMessage(message, referenceMessages, setProps, dashpoolEventOnClick, referenceTarget),
+                    ]);
+
+
+
+                }
+            }
+
+
+
+
+        } else if (message.role === 'dashpoolEvent') {
+
+            if (!known_ids.includes(message.id)) {
+                known_ids.push(message.id)
+                events.push({ dashpoolEvent: message.content })
+            }
+        } else if (message.role === 'nodeChangeEvent') {
+            if (!known_ids.includes(message.id)) {
+                known_ids.push(message.id)
+                events.push({ nodeChangeEvent: message.content })
+            }
+        }
+    }
+
+
     function handleStringResult(new_result, known_ids, events, split = true) {
 
 
@@ -504,57 +675,7 @@ const Chat = (props: ChatProps) => {
 
                     const message = JSON5.parse(jsonObject);
 
-                    if (message.role === "assistant" || message.role === "photo" || message.role === "pdf" || message.role === "reference") {
-
-
-                        if ("show" in message && message.show === false) {
-
-                            //check if a ref is in the message
-                            if ("ref" in message) {
-                                //add the message to the referenceMessages
-                                referenceMessages.set(message.ref, message);
-                                setReferenceMessages(referenceMessages);
-                            }
-
-
-                        } else {
-
-                            if (known_ids.includes(message.id)) {
-                                //update the message with the new content
-                                setChatMessages((prevMessages) => [
-                                    ...prevMessages.splice(0, prevMessages.length - 1),
-                                    toChatMessage(message, referenceMessages, setProps, dashpoolEventOnClick, referenceTarget),
-                                ]);
-
-                            } else {
-                                known_ids.push(message.id)
-
-                                //add the message to the output
-                                setChatMessages((prevMessages) => [
-                                    ...prevMessages,
-                                    toChatMessage(message, referenceMessages, setProps, dashpoolEventOnClick, referenceTarget),
-                                ]);
-
-
-
-                            }
-                        }
-
-
-
-
-                    } else if (message.role === 'dashpoolEvent') {
-
-                        if (!known_ids.includes(message.id)) {
-                            known_ids.push(message.id)
-                            events.push({ dashpoolEvent: message.content })
-                        }
-                    } else if (message.role === 'nodeChangeEvent') {
-                        if (!known_ids.includes(message.id)) {
-                            known_ids.push(message.id)
-                            events.push({ nodeChangeEvent: message.content })
-                        }
-                    }
+                    handleMessage(message, known_ids, events);
 
                 } catch (error) {
                     if (split === false) {
@@ -574,6 +695,25 @@ const Chat = (props: ChatProps) => {
     }
 
 
+    // handle one frame of a ndjson or sse response, returns true for the final frame
+    function handleFrame(frame, known_ids, events, assistantContents: Map<string, string>) {
+
+        if (frame.type === 'delta') {
+            const content = (assistantContents.get(frame.id) || '') + frame.text;
+            assistantContents.set(frame.id, content);
+            handleMessage({ role: 'assistant', id: frame.id, content: content }, known_ids, events);
+        } else if (frame.type === 'document' || frame.type === 'event') {
+            handleMessage(frame.data, known_ids, events);
+        } else if (frame.type === 'spans') {
+            // the citations of the streamed text so far, the message is rendered with them
+            messageSpans.current.set(frame.id, (messageSpans.current.get(frame.id) || []).concat(frame.spans));
+            handleMessage({ role: 'assistant', id: frame.id, content: assistantContents.get(frame.id) || '' }, known_ids, events);
+        }
+
+        return frame.type === 'done';
+    }
+
+
     const handleNewUserMessage = async (newMessage) => {
 
 
@@ -606,6 +746,10 @@ const Chat = (props: ChatProps) => {
         let chunk;
         let known_ids = [];
         let events = [];
+        let framed = false;
+        let nextConversationVersion: string | null = null;
+        const abortController = new AbortController();
+        const assistantContents = new Map<string, string>();
 
         // show a typing indicator
         setChatMessages((prevMessages) => [
@@ -621,17 +765,25 @@ const Chat = (props: ChatProps) => {
 
             setInputDisabled(true);
 
-            const response = await fetch(url, {
+            streamAbort.current = abortController;
+
+            const post = (full: boolean) => fetch(url, {
                 method: 'POST',
+                signal: abortController.signal,
                 headers: {
                     'Content-Type': 'application/json',
+                    'Accept': 'application/x-ndjson, text/event-stream;q=0.9, application/json;q=0.8',
                 },
-                body: JSON.stringify([
-                    { role: 'sharedData', content: sharedData },
-                    ...currentMessages,
-                ]),
+                body: requestBody(full),
             });
 
+            let response = await post(false);
+
+            if (response.status === 409 && props.conversationSession) {
+                // the server does not know this version of the conversation
+                response = await post(true);
+            }
+
             if (!response.ok) {
                 let error_message = 'Network response was not ok';
 
@@ -641,48 +793,97 @@ const Chat = (props: ChatProps) => {
                 throw new Error(error_message);
             }
 
-            const reader = response.body.getReader();
+            nextConversationVersion = response.headers.get('X-Dashpool-Conversation-Version');
 
+            const reader = response.body.getReader();
 
-            let lastHandleStringResultTime = 0;
+            const contentType = response.headers.get('Content-Type') || '';
+            const sse = contentType.includes('text/event-stream');
+            framed = sse || contentType.includes('application/x-ndjson');
 
-            while (!(chunk = await reader.read()).done) {
-                // Handle each chunk of the response
-                const chunkText = new TextDecoder('utf-8').decode(chunk.value);
-                result += chunkText;
+            if (framed) {
+                // every frame is a complete JSON object, so it is parsed exactly once
+                const decoder = new TextDecoder('utf-8');
+                const separator = sse ? '\n\n' : '\n';
+                let pending = '';
+                let done = false;
 
-                const currentTime = Date.now();
-                if (currentTime - lastHandleStringResultTime >= 10) {
-                    lastHandleStringResultTime = currentTime;
+                while (!(chunk = await reader.read()).done) {
+                    pending += decoder.decode(chunk.value, { stream: true });
+                    const frames = pending.split(separator);
+                    pending = frames.pop();
 
-                    if (showTypingIndicator) {
+                    if (showTypingIndicator && frames.length > 0) {
                         setChatMessages((prevMessages) => [
                             ...prevMessages.splice(0, prevMessages.length - 1),
                         ]);
                         showTypingIndicator = false;
                     }
 
-                    try {
-                        // Attempt to find complete JSON objects in the result
-                        handleStringResult(result, known_ids, events);
+                    for (let frame of frames) {
+                        if (sse) {
+                            frame = frame.replace(/^data: /, '');
+                        }
+                        if (frame.trim() === '') {
+                            continue;
+                        }
+                        done = handleFrame(JSON.parse(frame), known_ids, events, assistantContents) || done;
+                    }
 
+                    await fireEventsWithDelay(events, setProps);
+                }
 
-                        await fireEventsWithDelay(events, setProps);
+                if (!done) {
+                    throw new Error('Chat AI response ended unexpectedly');
+                }
+            } else {
 
 
-                    } catch (error) {
-                        console.log("ERROR");
-                        console.log(error);
-                        // Handle JSON parsing errors if necessary
-                    }
+                let lastHandleStringResultTime = 0;
 
+                while (!(chunk = await reader.read()).done) {
+                    // Handle each chunk of the response
+                    const chunkText = new TextDecoder('utf-8').decode(chunk.value);
+                    result += chunkText;
+
+                    const currentTime = Date.now();
+                    if (currentTime - lastHandleStringResultTime >= 10) {
+                        lastHandleStringResultTime = currentTime;
+
+                        if (showTypingIndicator) {
+                            setChatMessages((prevMessages) => [
+                                ...prevMessages.splice(0, prevMessages.length - 1),
+                            ]);
+                            showTypingIndicator = false;
+                        }
+
+                        try {
+                            // Attempt to find complete JSON objects in the result
+                            handleStringResult(result, known_ids, events);
+
+
+                            await fireEventsWithDelay(events, setProps);
 
-                    await fireEventsWithDelay(events, setProps);
-                }
 
+                        } catch (error) {
+                            console.log("ERROR");
+                            console.log(error);
+                            // Handle JSON parsing errors if necessary
+                        }
+
+
+                        await fireEventsWithDelay(events, setProps);
+                    }
+
+                }
+                handleStringResult(result, known_ids, events, false);
             }
-            handleStringResult(result, known_ids, events, false);
         } catch (error) {
+            if (abortController.signal.aborted) {
+                // the chat was cleared while the response was streamed
+                return;
+            }
+
             const errorMessage = `Sorry, an error occurred while processing your request.
 
 
@@ -690,57 +891,72 @@ ${error.message}
           `;
 
             setCombinedMessage({ role: 'assistant', content: errorMessage });
+            resetConversation(false);
+            streamAbort.current = null;
             setInputDisabled(false);
             return;
         }
 
-        try {
-            const j_result = JSON.parse(result);
+        if (framed) {
+            assistantContents.forEach((content) => {
+                currentMessages.push({
+                    role: 'assistant',
+                    content: content
+                })
+            });
+        } else {
+            try {
+                const j_result = JSON.parse(result);
 
-            j_result.forEach((message: any) => {
-                if (message.role === 'assistant') {
+                j_result.forEach((message: any) => {
+                    if (message.role === 'assistant') {
 
-                    currentMessages.push({
-                        role: 'assistant',
-                        content: message.content
-                    })
+                        currentMessages.push({
+                            role: 'assistant',
+                            content: message.content
+                        })
 
-                    if (!known_ids.includes(message.id)) {
-                        //addResponseMessage(message.content, message.id)
-                        setCombinedMessage(message);
-                    }
+                        if (!known_ids.includes(message.id)) {
+                            //addResponseMessage(message.content, message.id)
+                            setCombinedMessage(message);
+                        }
 
-                } else if (message.role === 'dashpoolEvent') {
+                    } else if (message.role === 'dashpoolEvent') {
 
-                    if (!known_ids.includes(message.id)) {
-                        events.push({ dashpoolEvent: message.content })
-                    }
-                } else if (message.role === 'nodeChangeEvent') {
-                    if (!known_ids.includes(message.id)) {
-                        events.push({ nodeChangeEvent: message.content })
+                        if (!known_ids.includes(message.id)) {
+                            events.push({ dashpoolEvent: message.content })
+                        }
+                    } else if (message.role === 'nodeChangeEvent') {
+                        if (!known_ids.includes(message.id)) {
+                            events.push({ nodeChangeEvent: message.content })
+                        }
                     }
+                })
+
+            } catch (error) {
+                known_ids.forEach(() => {
+                    currentMessages.push({
+                        role: 'error',
+                        content: ""
+                    })
                 }
-            })
+                )
 
-        } catch (error) {
-            known_ids.forEach(() => {
                 currentMessages.push({
-                    role: 'error',
-                    content: ""
+                    role: 'assistant',
+                    content: "Dashpool Chat AI ERROR!\nPlease restart chat."
                 })
+                nextConversationVersion = null;
             }
-            )
-
-            currentMessages.push({
-                role: 'assistant',
-                content: "Dashpool Chat AI ERROR!\nPlease restart chat."
-            })
         }
 
+        // the server stored the response, the next request only needs the new message
+        conversationVersion.current = nextConversationVersion !== null ? Number(nextConversationVersion) : null;
+
         setCurrentMessages(currentMessages);
         await fireEventsWithDelay(events, setProps);
 
-
+        streamAbort.current = null;
         setInputDisabled(false);
     };
 
@@ -750,8 +966,20 @@ ${error.message}
 
 
     const handleQuickButton = (value: any) => {
+        if (value == "clearall" && streamAbort.current !== null) {
+            // stop the running response, its generators are closed on the server
+            streamAbort.current.abort();
+            streamAbort.current = null;
+            setInputDisabled(false);
+            resetConversation(true);
+            setCurrentMessages([])
+            setChatMessages([])
+            return;
+        }
+
         if (!inputDisabled) {
             if (value == "clearall") {
+                resetConversation(true);
                 setCurrentMessages([])
                 setChatMessages([])
             }
@@ -782,11 +1010,13 @@ ${error.message}
                     ]),
                 });
 
+                resetConversation(true);
                 setCurrentMessages([])
                 setChatMessages([])
             }
 
             if (value == "removelast") {
+                resetConversation(false);
                 currentMessages.pop();
                 setCurrentMessages(currentMessages);
                 setChatMessages(chatMessages.slice(0, chatMessages.length - 1));
@@ -857,7 +1087,7 @@ ${error.message}
                     {props.showClearButton && (
                         <>
                             <Button onClick={() => handleQuickButton('removelast')} disabled={inputDisabled} className='p-button-sm chat-mini-button'>Clear Message</Button>
-                            <Button onClick={() => handleQuickButton('clearall')} disabled={inputDisabled} className='p-button-sm chat-mini-button'>New Chat</Button>
+                            <Button onClick={() => handleQuickButton('clearall')} className='p-button-sm chat-mini-button'>New Chat</Button>
                         </>
                     )}
                 </div>
@@ -878,6 +1108,7 @@ Chat.defaultProps = {
     showClearButton: false,
     dashpoolEventOnClick: true,
     referenceTarget: undefined,
+    conversationSession: false,
 };
 
 export default Chat;
@@ -0,0 +1,39 @@
+import threading
+
+import pytest
+
+
+class FakeCollection:
+    """ Stands in for a MongoCollection, records the index and insert calls
+
+    Arguments:
+        full_name {str} -- The namespace of the collection, the sink groups batches by it
+        gate {threading.Event} -- If set, insert_many blocks until the event is set
+
+    """
+    def __init__(self, full_name="test.log", gate=None):
+        self.full_name = full_name
+        self.gate = gate
+        self.indexes = []
+        self.batches = []
+        # set once insert_many was entered, e.g. to wait for the writer to block at the gate
+        self.inserting = threading.Event()
+
+    @property
+    def documents(self):
+        return [document for batch in self.batches for document in batch]
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+        return keys
+
+    def insert_many(self, documents, ordered=True):
+        self.inserting.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batches.append(list(documents))
+
+
+@pytest.fixture
+def collection():
+    return FakeCollection()
@@ -0,0 +1,43 @@
+import os
+import time
+
+from dashpool_components.chatutils import CapturePolicy, _OutputCapture
+
+
+def spill(policy, output="x" * 30):
+    capture = _OutputCapture(policy)
+    capture.write(output)
+    capture.close()
+    return capture
+
+
+def test_spill_file_holds_the_complete_output(tmp_path):
+    capture = spill(CapturePolicy(max_size=10, overflow="spill", spill_dir=str(tmp_path)), "0123456789" * 3)
+
+    assert capture.truncated and capture.getvalue() == "0123456789"
+    with open(capture.path, encoding="utf-8") as f:
+        assert f.read() == "0123456789" * 3
+
+
+def test_old_spill_files_are_removed(tmp_path):
+    policy = CapturePolicy(max_size=10, overflow="spill", spill_dir=str(tmp_path), spill_retention=60)
+    old = spill(policy).path
+    recent = spill(policy).path
+    other = tmp_path / "other.txt"
+    other.write_text("not a spill file")
+    for path in (old, str(other)):
+        os.utime(path, (time.time() - 120, time.time() - 120))
+
+    current = spill(policy).path
+
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(p) for p in (recent, current, str(other)))
+
+
+def test_spill_files_are_kept_without_retention(tmp_path):
+    policy = CapturePolicy(max_size=10, overflow="spill", spill_dir=str(tmp_path), spill_retention=None)
+    old = spill(policy).path
+    os.utime(old, (time.time() - 86400 * 30, time.time() - 86400 * 30))
+
+    spill(policy)
+
+    assert len(os.listdir(tmp_path)) == 2
@@ -0,0 +1,108 @@
+import json
+
+import flask
+import pytest
+
+from dashpool_components.chatutils import Response, _CitationIndex
+
+
+def index(chunks):
+    citations = _CitationIndex()
+    spans = []
+    for chunk in chunks:
+        spans.extend(citations.feed(chunk))
+    spans.extend(citations.finish())
+    assert spans == citations.spans
+    return spans
+
+
+def utf16_slice(text, offset, length):
+    encoded = text.encode("utf-16-le", "surrogatepass")
+    return encoded[2 * offset:2 * (offset + length)].decode("utf-16-le", "surrogatepass")
+
+
+TEXT = "See [doc0] and [doc1], not [a link](http://x) or [[doc2]].\n[doc3]"
+
+
+def test_citations_in_one_chunk():
+    assert index([TEXT]) == [[4, 6, "doc0"], [15, 6, "doc1"], [50, 6, "doc2"], [59, 6, "doc3"]]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7])
+def test_citations_across_chunk_boundaries(size):
+    chunks = [TEXT[i:i + size] for i in range(0, len(TEXT), size)]
+
+    assert index(chunks) == index([TEXT])
+
+
+def test_a_citation_at_the_end_of_a_chunk_is_held_back():
+    citations = _CitationIndex()
+
+    assert citations.feed("see [doc0]") == []
+    assert citations.feed("(http://x) and [doc1]") == []
+    assert citations.finish() == [[25, 6, "doc1"]]
+
+
+def test_offsets_count_utf16_code_units():
+    text = "äöü 😀 [doc0] € 😀😀 [doc1]"
+    spans = index([text[:3], text[3:6], text[6:14], text[14:]])
+
+    assert spans == [[7, 6, "doc0"], [21, 6, "doc1"]]
+    assert [utf16_slice(text, offset, length) for offset, length, _ in spans] == ["[doc0]", "[doc1]"]
+
+
+def test_escaped_chunks_are_decoded():
+    sanitize = Response.__new__(Response).sanitize_string
+    text = 'line "one"\n\t[doc0] back\\slash [doc1]'
+
+    # the sanitizer drops the backslash of the invalid escape, as the client sees the text
+    assert index([sanitize(text[:12]), sanitize(text[12:])]) == [[12, 6, "doc0"], [29, 6, "doc1"]]
+
+
+def test_spans_frames_follow_the_delta(monkeypatch):
+    app = flask.Flask(__name__)
+
+    @app.route("/ai", methods=["POST"])
+    def ai():
+        response = Response(app, wire_format="ndjson", compression_policy=False, reference_spans=True)
+        response.add(lambda: iter(["see [do", "c0] and ", "[doc1]"]))
+        return response.generate_response()
+
+    lines = [json.loads(line) for line in app.test_client().post("/ai", json=[]).get_data(as_text=True).splitlines()]
+    frames = [(line["type"], line.get("text", line.get("spans"))) for line in lines]
+
+    assert frames == [
+        ("delta", ""),
+        ("delta", "see [do"),
+        ("delta", "c0] and "),
+        ("spans", [[4, 6, "doc0"]]),
+        ("delta", "[doc1]"),
+        ("spans", [[15, 6, "doc1"]]),
+        ("done", None),
+    ]
+    assert len({line["id"] for line in lines if "id" in line}) == 1
+
+
+def test_stream_has_no_empty_pieces():
+    app = flask.Flask(__name__)
+
+    with app.test_request_context("/ai", method="POST"):
+        response = Response(app, wire_format="ndjson", compression_policy=False, reference_spans=True)
+        response.add(lambda: iter(["no citations"]))
+        pieces = list(response.generate_response().response)
+
+    assert all(pieces)
+
+
+def test_json_array_has_no_spans_by_default():
+    app = flask.Flask(__name__)
+
+    @app.route("/ai", methods=["POST"])
+    def ai():
+        response = Response(app, compression_policy=False)
+        response.add(lambda: iter(["see [doc0]"]))
+        return response.generate_response()
+
+    messages = json.loads(app.test_client().post("/ai", json=[]).get_data(as_text=True))
+
+    assert [message["role"] for message in messages] == ["assistant"]
@@ -0,0 +1,118 @@
+import gzip
+import zlib
+
+import flask
+import pytest
+
+from dashpool_components import compression
+from dashpool_components.chatutils import FlushPolicy, Response
+from dashpool_components.compression import CompressionPolicy, StreamCompressor
+
+
+PIECES = ["Hello", " World", ", ", "ä" * 50, "", "😀 and the rest of the answer " * 20]
+
+
+@pytest.fixture
+def without_brotli(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip, deflate", "gzip"),
+    ("deflate, gzip;q=0.5", "gzip"),
+    ("gzip;q=0", None),
+    ("identity", None),
+    ("*", "gzip"),
+    ("br", None),
+    ("", None),
+    (None, None),
+])
+def test_negotiate_without_brotli(without_brotli, accept_encoding, expected):
+    assert CompressionPolicy().negotiate(accept_encoding) == expected
+
+
+def test_negotiate_prefers_brotli_if_installed(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", object())
+    policy = CompressionPolicy()
+
+    assert policy.negotiate("gzip, br") == "br"
+    assert policy.negotiate("gzip, br;q=0") == "gzip"
+    assert CompressionPolicy(encodings=("gzip", "br")).negotiate("gzip, br") == "gzip"
+
+
+def test_negotiate_streams_only_with_gzip(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", object())
+
+    assert CompressionPolicy().negotiate("gzip, br", streaming=True) == "gzip"
+    assert CompressionPolicy().negotiate("br", streaming=True) is None
+
+
+def test_unsupported_coding_raises():
+    with pytest.raises(ValueError):
+        StreamCompressor("deflate", CompressionPolicy())
+
+
+def stream_round_trip(compressor):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    stream = b""
+    text = ""
+    for piece in PIECES:
+        out = compressor.compress(piece) + compressor.flush()
+        stream += out
+        text += piece
+        # every piece can be decoded as soon as it is flushed
+        assert decompressor.decompress(out).decode("utf-8") == piece
+    stream += compressor.finish()
+
+    assert gzip.decompress(stream).decode("utf-8") == text
+    return stream
+
+
+def test_gzip_stream_round_trip():
+    stream_round_trip(StreamCompressor("gzip", CompressionPolicy()))
+
+
+@pytest.mark.parametrize("min_size", [6, 64, 10000])
+def test_gzip_stream_starts_with_stored_blocks(min_size):
+    stream = stream_round_trip(StreamCompressor("gzip", CompressionPolicy(), min_size=min_size))
+
+    # gzip header, then the first deflate block, BTYPE 00 is a stored block
+    assert stream[:10] == compression._GZIP_HEADER
+    assert stream[10] & 0b110 == 0
+
+
+def test_gzip_compress_holds_back_output_until_flush():
+    compressor = StreamCompressor("gzip", CompressionPolicy())
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    held = compressor.compress("a short piece")
+    assert decompressor.decompress(held) == b""
+    assert decompressor.decompress(compressor.flush()) == b"a short piece"
+
+
+def test_gzip_empty_stream():
+    compressor = StreamCompressor("gzip", CompressionPolicy(), min_size=100)
+
+    assert compressor.flush() == b""
+    assert gzip.decompress(compressor.finish()) == b""
+
+
+def stream(response):
+    app = flask.Flask(__name__)
+    app.add_url_rule("/chat", "chat", lambda: response.generate_response())
+    return app.test_client().get("/chat", headers={"Accept-Encoding": "gzip"})
+
+
+def test_response_compresses_only_with_a_policy():
+    def build(**kwargs):
+        response = Response(flask.Flask(__name__), **kwargs)
+        response.add(lambda: iter(["Hello", " World"]))
+        return response
+
+    plain = stream(build(flush_policy=FlushPolicy(max_delay=None)))
+    assert "Content-Encoding" not in plain.headers
+    assert "Hello World" in plain.get_data(as_text=True)
+
+    compressed = stream(build(compression_policy=CompressionPolicy()))
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Hello World" in gzip.decompress(compressed.get_data()).decode("utf-8")
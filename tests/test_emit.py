@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+import time
+
+import flask
+import pytest
+
+from dashpool_components.chatutils import FlushPolicy, Response, SingleFlight, coalesce_requests
+from dashpool_components.document_classes import DashpoolEvent, Reference
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def app():
+    return flask.Flask(__name__)
+
+
+def build(app, wire_format, **kwargs):
+    response = Response(app, wire_format=wire_format, compression_policy=False, **kwargs)
+
+    def generator():
+        yield "Hello"
+        response.emit(Reference(url="hidden", markdown="hidden"))
+        response.emit(DashpoolEvent("event", {"x": 1}))
+        yield " there,"
+        response.emit({"role": "reference", "ref": "shown", "content": "shown"})
+        yield " world"
+
+    response.add(generator())
+    return response
+
+
+def collect(app, response):
+    app.add_url_rule("/ai", "ai", response.generate_response, methods=["POST"])
+    return app.test_client().post("/ai", json=[]).get_data(as_text=True)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"flush_policy": FlushPolicy(max_delay=None)}])
+def test_json_writes_emitted_items_after_the_message(app, kwargs):
+    elements = json.loads(collect(app, build(app, "json", **kwargs)))
+
+    assert [element["role"] for element in elements] == ["assistant", "reference", "dashpoolEvent", "reference"]
+    assert elements[0]["content"] == "Hello there, world"
+
+
+def test_json_writes_emitted_items_after_the_message_async(app):
+    async def stream():
+        return [piece async for piece in build(app, "json").agenerate_response()]
+
+    elements = json.loads(b"".join(asyncio.run(stream())))
+
+    assert [element["role"] for element in elements] == ["assistant", "reference", "dashpoolEvent", "reference"]
+    assert elements[0]["content"] == "Hello there, world"
+
+
+def test_ndjson_continues_the_message_only_after_visible_items(app):
+    frames = [json.loads(line) for line in collect(app, build(app, "ndjson")).splitlines()]
+
+    messages = {}
+    for frame in frames:
+        if frame["type"] == "delta":
+            messages.setdefault(frame["id"], []).append(frame["text"])
+    assert ["".join(texts) for texts in messages.values()] == ["Hello there,", " world"]
+    assert [frame["type"] for frame in frames if frame["type"] in ("document", "event")] == ["document", "event", "document"]
+
+
+def test_followers_of_a_single_flight_receive_the_emitted_items(app):
+    single_flight = SingleFlight()
+    joined = threading.Event()
+
+    @app.route("/ai", methods=["POST"])
+    @coalesce_requests(single_flight)
+    def ai():
+        response = Response(app, inputs={"query": "q"}, wire_format="ndjson", compression_policy=False)
+
+        def generator():
+            joined.wait(5)
+            yield "See "
+            response.emit({"role": "reference", "ref": "doc7", "content": "source"})
+            yield "[doc7]"
+
+        response.add(generator())
+        return response.generate_response()
+
+    streams = {}
+
+    def request(name):
+        body = app.test_client().post("/ai", json=[]).get_data(as_text=True)
+        streams[name] = [json.loads(line) for line in body.splitlines()]
+
+    threads = [threading.Thread(target=request, args=(name,)) for name in ("leader", "follower")]
+    threads[0].start()
+    wait_for(lambda: len(single_flight) == 1)
+    threads[1].start()
+    flight = next(iter(single_flight._flights.values()))
+    wait_for(lambda: len(flight.subscribers) == 2)
+    joined.set()
+    for thread in threads:
+        thread.join(5)
+
+    ids = set()
+    for frames in streams.values():
+        documents = [frame["data"] for frame in frames if frame["type"] == "document"]
+        assert [(d["ref"], d["content"]) for d in documents] == [("doc7", "source")]
+        assert "".join(frame["text"] for frame in frames if frame["type"] == "delta") == "See [doc7]"
+        ids.add(documents[0]["id"])
+    assert len(ids) == 2
@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+from dashpool_components.logsink import LogSink
+
+from conftest import FakeCollection
+
+
+@pytest.fixture
+def sink():
+    sink = LogSink(batch_size=3, flush_interval=0.5, max_queue_size=10)
+    yield sink
+    sink.close()
+
+
+def test_documents_are_written_in_batches(sink, collection):
+    for i in range(7):
+        assert sink.submit(collection, {"i": i})
+    assert sink.flush(timeout=5)
+
+    assert [len(batch) for batch in collection.batches] == [3, 3, 1]
+    assert [document["i"] for document in collection.documents] == list(range(7))
+    assert sink.stats()["written"] == 7
+    assert sink.last_write_seconds is not None
+
+
+def test_batches_are_grouped_by_collection(sink):
+    first = FakeCollection("test.first")
+    second = FakeCollection("test.second")
+    for i in range(3):
+        sink.submit(first, {"i": i})
+        sink.submit(second, {"i": i})
+    assert sink.flush(timeout=5)
+
+    assert len(first.documents) == 3
+    assert len(second.documents) == 3
+
+
+def test_index_is_created_once_per_collection(sink, collection):
+    other = FakeCollection("test.other")
+    for i in range(4):
+        sink.submit(collection, {"i": i})
+        assert sink.flush(timeout=5)
+    sink.submit(other, {"i": 0})
+    assert sink.flush(timeout=5)
+
+    assert len(collection.batches) == 4
+    assert collection.indexes == [("end_timestamp", {"expireAfterSeconds": sink.expire_after_seconds})]
+    assert len(other.indexes) == 1
+
+
+def test_no_index_without_expiry(collection):
+    sink = LogSink(expire_after_seconds=None, flush_interval=0.01)
+    sink.submit(collection, {"i": 0})
+    assert sink.flush(timeout=5)
+    sink.close()
+
+    assert collection.indexes == []
+    assert len(collection.documents) == 1
+
+
+def test_documents_are_dropped_when_the_queue_is_full():
+    gate = threading.Event()
+    collection = FakeCollection(gate=gate)
+    sink = LogSink(batch_size=1, flush_interval=0.01, max_queue_size=2)
+
+    # the writer takes the first document and blocks in insert_many
+    assert sink.submit(collection, {"i": 0})
+    assert collection.inserting.wait(5)
+    assert sink.submit(collection, {"i": 1})
+    assert sink.submit(collection, {"i": 2})
+    assert not sink.submit(collection, {"i": 3})
+    assert sink.stats()["dropped"] == 1
+    assert sink.queue_depth == 2
+
+    gate.set()
+    assert sink.flush(timeout=5)
+    sink.close()
+
+    assert [document["i"] for document in collection.documents] == [0, 1, 2]
+    assert sink.stats()["submitted"] == 3
+    assert sink.stats()["written"] == 3
+
+
+def test_flush_times_out_while_the_writer_is_blocked():
+    gate = threading.Event()
+    collection = FakeCollection(gate=gate)
+    sink = LogSink(flush_interval=0.01)
+
+    sink.submit(collection, {"i": 0})
+    assert collection.inserting.wait(5)
+    assert not sink.flush(timeout=0.05)
+
+    gate.set()
+    assert sink.flush(timeout=5)
+    sink.close()
+
+
+def test_close_writes_the_queued_documents(collection):
+    sink = LogSink(batch_size=100, flush_interval=10)
+    for i in range(5):
+        sink.submit(collection, {"i": i})
+    sink.close()
+
+    assert len(collection.documents) == 5
+    assert not sink._thread.is_alive()
+
+    # documents submitted after close are dropped
+    assert not sink.submit(collection, {"i": 5})
+    assert sink.stats()["dropped"] == 1
+    sink.close()
+
+
+def test_close_gives_up_when_the_queue_stays_full():
+    gate = threading.Event()
+    collection = FakeCollection(gate=gate)
+    sink = LogSink(batch_size=1, flush_interval=0.01, max_queue_size=1)
+
+    sink.submit(collection, {"i": 0})
+    assert collection.inserting.wait(5)
+    assert sink.submit(collection, {"i": 1})
+
+    start = time.monotonic()
+    sink.close(timeout=0.1)
+    assert time.monotonic() - start < 2
+
+    gate.set()
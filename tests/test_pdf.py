@@ -0,0 +1,138 @@
+import copy
+import dataclasses
+import json
+
+import pytest
+
+from dashpool_components import encoding
+from dashpool_components.document_classes.pdf import (
+    PDF,
+    PdfHighlight,
+    PdfHighlightContent,
+    PdfHighlightPosition,
+    PdfHighlightPositionRect,
+    PdfHighlightRects,
+)
+
+
+def rect(x1, y1, x2, y2, page=1):
+    return PdfHighlightPositionRect(x1, y1, x2, y2, 600, 800, page)
+
+
+def coordinates(rects):
+    return [(r.x1, r.y1, r.x2, r.y2, r.pageNumber) for r in rects]
+
+
+def highlight(*rects):
+    return PdfHighlight(
+        content=PdfHighlightContent(text="text"),
+        position=PdfHighlightPosition(boundingRect=rects[0], rects=list(rects), pageNumber=rects[0].pageNumber),
+    )
+
+
+def test_merged_joins_the_words_of_a_line():
+    rects = PdfHighlightRects([rect(10, 100, 40, 112), rect(44, 101, 80, 112), rect(83, 100, 120, 113)])
+
+    assert coordinates(rects.merged()) == [(10, 100, 120, 113, 1)]
+
+
+def test_merged_keeps_lines_pages_and_wide_gaps_apart():
+    rects = PdfHighlightRects([
+        rect(10, 100, 40, 112),
+        rect(200, 100, 240, 112),
+        rect(10, 120, 40, 132),
+        rect(10, 100, 40, 112, page=2),
+    ])
+
+    assert coordinates(rects.merged()) == [
+        (10, 100, 40, 112, 1),
+        (200, 100, 240, 112, 1),
+        (10, 120, 40, 132, 1),
+        (10, 100, 40, 112, 2),
+    ]
+
+
+def test_merged_keeps_rects_without_page():
+    rects = PdfHighlightRects([rect(10, 100, 40, 112, page=None), rect(42, 100, 60, 112, page=None)])
+
+    assert coordinates(rects.merged()) == [(10, 100, 60, 112, None)]
+
+
+def test_normalize_drops_covered_highlights():
+    first = highlight(rect(10, 100, 40, 112), rect(42, 100, 120, 112))
+    covered = highlight(rect(12, 100, 110, 112))
+    other = highlight(rect(10, 300, 120, 312))
+    pdf = PDF(url="file", highlights=[first, covered, other], ref="pdf0")
+
+    assert pdf.normalize() is pdf
+    assert pdf.highlights == [first, other]
+    assert coordinates(first.position.rects) == [(10, 100, 120, 112, 1)]
+
+
+def test_normalize_without_deduplicate_keeps_all_highlights():
+    highlights = [highlight(rect(10, 100, 120, 112)), highlight(rect(10, 100, 120, 112))]
+    pdf = PDF(url="file", highlights=highlights, ref="pdf0")
+
+    pdf.normalize(deduplicate=False)
+
+    assert len(pdf.highlights) == 2
+
+
+def test_rects_are_read_only_and_assigned_by_index():
+    position = highlight(rect(10, 100, 40, 112)).position
+
+    with pytest.raises(AttributeError):
+        position.rects[0].pageNumber = 3
+    position.rects[0] = dataclasses.replace(position.rects[0], pageNumber=3)
+    position.rects.append(rect(50, 100, 60, 112))
+    del position.rects[1]
+
+    assert coordinates(position.rects) == [(10, 100, 40, 112, 3)]
+    assert position.rects == [rect(10, 100, 40, 112, page=3)]
+    # copies can be changed
+    copied = copy.deepcopy(position.rects[0])
+    copied.x1 = 0
+    assert copied.x1 == 0
+
+
+def test_asdict_of_a_position_is_json_serializable():
+    position = highlight(rect(10, 100, 40, 112), rect(42.5, 100, 120, 112, page=None)).position
+
+    data = json.loads(json.dumps(dataclasses.asdict(position)))
+
+    assert data["rects"] == [
+        {"x1": 10, "y1": 100, "x2": 40, "y2": 112, "width": 600, "height": 800, "pageNumber": 1},
+        {"x1": 42.5, "y1": 100, "x2": 120, "y2": 112, "width": 600, "height": 800, "pageNumber": None},
+    ]
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_integer_coordinates_stay_integers(backend):
+    if backend == "orjson" and encoding.orjson is None:
+        pytest.skip("orjson is not installed")
+    data = {
+        "file_id": "file",
+        "content": {"text": "text"},
+        "position": {
+            "boundingRect": {"x1": 10, "y1": 100, "x2": 120, "y2": 112, "width": 600, "height": 800},
+            "rects": [
+                {"x1": 10, "y1": 100, "x2": 40, "y2": 112, "width": 600, "height": 800, "pageNumber": 1},
+                {"x1": 44.5, "y1": 100, "x2": 120, "y2": 112, "width": 600, "height": 800, "pageNumber": 1},
+            ],
+            "pageNumber": 1,
+        },
+    }
+    pdf = PDF.from_dict(data, ref="pdf0")
+
+    encoding.set_backend(backend)
+    try:
+        encoded = encoding.dumps(pdf.to_dict()["data"]["highlights"][0]["position"]["rects"])
+        highlights = json.loads(pdf.to_json_bytes())["data"]["highlights"]
+    finally:
+        encoding.set_backend()
+
+    assert '"x1": 10,' in encoded or '"x1":10,' in encoded
+    assert highlights[0]["position"]["rects"] == data["position"]["rects"]
+    merged = pdf.normalize().highlights[0].position.rects.to_dicts()
+    assert merged == [{"x1": 10, "y1": 100, "x2": 120, "y2": 112, "width": 600, "height": 800, "pageNumber": 1}]
+    assert [type(merged[0][name]) for name in ("x1", "x2", "width")] == [int, int, int]
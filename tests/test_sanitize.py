@@ -0,0 +1,34 @@
+import os
+import random
+import sys
+
+import pytest
+
+from dashpool_components import chatutils
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+from bench_sanitize import CORPUS, legacy_sanitize_string  # noqa: E402
+
+
+def random_corpus(count, seed=1):
+    alphabet = ["\\", "\\\\", "u", "n", "t", "/", '"', "0", "7", "a", "d", "é", "😀", "\n", " "]
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        for _ in range(count)
+    ]
+
+
+@pytest.fixture
+def sanitize():
+    return chatutils.Response.__new__(chatutils.Response).sanitize_string
+
+
+@pytest.mark.parametrize("token", CORPUS)
+def test_matches_the_legacy_implementation(sanitize, token):
+    assert sanitize(token) == legacy_sanitize_string(token)
+
+
+def test_matches_the_legacy_implementation_on_random_tokens(sanitize):
+    for token in random_corpus(20000):
+        assert sanitize(token) == legacy_sanitize_string(token), token
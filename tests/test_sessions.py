@@ -0,0 +1,185 @@
+import json
+
+import flask
+import pytest
+
+from dashpool_components.chatutils import Response
+from dashpool_components.document_classes import DashpoolEvent, Reference
+from dashpool_components.sessions import VERSION_HEADER, Conversation, ConversationMismatch, SessionStore
+
+
+@pytest.fixture
+def store():
+    return SessionStore()
+
+
+@pytest.fixture
+def app(store):
+    app = flask.Flask(__name__)
+
+    @app.route("/ai", methods=["POST"])
+    def ai():
+        try:
+            conversation = Conversation.from_request(flask.request.json, store)
+        except ConversationMismatch as e:
+            return e.response()
+        response = Response(app, conversation=conversation, compression_policy=False, wire_format="ndjson")
+        response.add(lambda: iter(["Hello", " again"]))
+        return response.generate_response()
+
+    return app
+
+
+def request(id, version, content, full=False):
+    return {"conversation": {"id": id, "version": version, "full": full}, "content": content}
+
+
+def test_plain_list_bodies_are_not_stored(store):
+    content = [{"role": "user", "content": "q"}]
+    conversation = Conversation.from_request(content, store)
+
+    assert conversation.content == content and conversation.id is None
+    conversation.commit([{"role": "assistant", "content": "a"}])
+    assert len(store) == 0
+
+
+def test_new_messages_are_merged_into_the_session(store):
+    shared = {"role": "sharedData", "content": "old"}
+    store.set("c1", {"version": 2, "content": [shared, {"role": "user", "content": "q1"}]})
+
+    conversation = Conversation.from_request(request("c1", 2, [
+        {"role": "sharedData", "content": "new"},
+        {"role": "user", "content": "q2"},
+    ]), store)
+
+    assert conversation.content == [
+        {"role": "sharedData", "content": "new"},
+        {"role": "user", "content": "q1"},
+        {"role": "user", "content": "q2"},
+    ]
+    conversation.commit([{"role": "assistant", "content": "a2"}])
+    assert store.get("c1")["version"] == 3
+    assert store.get("c1")["content"][-1] == {"role": "assistant", "content": "a2"}
+
+
+@pytest.mark.parametrize("version", [0, 1, 3])
+def test_unknown_or_outdated_versions_raise(store, version):
+    store.set("c1", {"version": 2, "content": []})
+
+    with pytest.raises(ConversationMismatch):
+        Conversation.from_request(request("c1", version, []), store)
+    with pytest.raises(ConversationMismatch):
+        Conversation.from_request(request("other", 2, []), store)
+
+
+def test_mismatch_responds_409_and_a_full_resend_recovers(app, store):
+    client = app.test_client()
+    question = [{"role": "user", "content": "q"}]
+
+    mismatch = client.post("/ai", json=request("c1", 4, question))
+    assert mismatch.status_code == 409
+    assert mismatch.get_json()["resend"] is True
+
+    full = client.post("/ai", json=request("c1", 4, question, full=True))
+    assert full.status_code == 200
+    full.get_data()
+    assert full.headers[VERSION_HEADER] == "5"
+    assert store.get("c1")["version"] == 5
+    assert store.get("c1")["content"][-1]["content"] == "Hello again"
+
+    follow_up = client.post("/ai", json=request("c1", 5, [{"role": "user", "content": "q2"}]))
+    follow_up.get_data()
+    assert follow_up.status_code == 200
+    assert store.get("c1")["version"] == 6
+    assert [message["content"] for message in store.get("c1")["content"]] == ["q", "Hello again", "q2", "Hello again"]
+
+
+def documents(response):
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return [line["data"] for line in lines if line["type"] in ("document", "event")]
+
+
+def test_documents_are_sent_once_and_then_pointed_to(store):
+    app = flask.Flask(__name__)
+    turns = []
+
+    @app.route("/ai", methods=["POST"])
+    def ai():
+        response = Response(
+            app, conversation=Conversation.from_request(flask.request.json, store),
+            compression_policy=False, wire_format="ndjson")
+        response.add(Reference(url="A", markdown="doc A"))
+        if turns:
+            response.add(Reference(url="B", markdown="doc B"))
+        response.add({"role": "reference", "ref": None, "content": "dict"})
+        response.add(DashpoolEvent("event", {"x": 1}))
+        response.add(lambda: iter(["answer"]))
+        turns.append(1)
+        return response.generate_response()
+
+    client = app.test_client()
+    question = [{"role": "user", "content": "q"}]
+
+    first = documents(client.post("/ai", json=request("c1", 0, question, full=True)))
+    assert [(d["role"], d["ref"]) for d in first[:2]] == [("reference", "doc0"), ("reference", "doc1")]
+    assert first[2]["role"] == "dashpoolEvent"
+
+    second = documents(client.post("/ai", json=request("c1", 1, question)))
+    pointers = [d for d in second if d["role"] == "refPointer"]
+    assert [(d["ref"], d["target"]) for d in pointers] == [("doc0", "doc0"), ("doc1", "doc1")]
+    assert all(d["id"] for d in pointers)
+    sent = [d for d in second if d["role"] == "reference"]
+    assert [(d["ref"], d["data"]["markdown"]) for d in sent] == [("doc2", "doc B")]
+    # events are always sent in full
+    assert [d["role"] for d in second].count("dashpoolEvent") == 1
+
+    session = store.get("c1")
+    assert sorted(session["references"].values()) == ["doc0", "doc1", "doc2"]
+
+
+def test_a_full_resend_resets_the_references(store):
+    store.set("c1", {"version": 1, "content": [], "references": {"key": "doc0"}, "ref_counter": 1})
+
+    conversation = Conversation.from_request(request("c1", 1, [], full=True), store)
+
+    assert conversation.references == {} and conversation.new_ref() == "doc0"
+
+
+def test_uncommitted_references_are_not_stored(store):
+    store.set("c1", {"version": 1, "content": [], "references": {"a": "doc0"}, "ref_counter": 1})
+    conversation = Conversation.from_request(request("c1", 1, []), store)
+
+    conversation.register("b", conversation.new_ref())
+    assert conversation.reference("b") == "doc1"
+    assert store.get("c1")["references"] == {"a": "doc0"}
+
+    conversation.register("c", "doc0")
+    conversation.commit([])
+    assert store.get("c1")["references"] == {"b": "doc1", "c": "doc0"}
+
+
+def test_store_evicts_least_recently_used_sessions():
+    store = SessionStore(max_sessions=2)
+    for id in ("a", "b"):
+        store.set(id, {"version": 1, "content": []})
+    store.get("a")
+    store.set("c", {"version": 1, "content": []})
+
+    assert store.get("b") is None
+    assert store.get("a") is not None and store.get("c") is not None
+
+
+def test_store_expires_unused_sessions(monkeypatch):
+    from dashpool_components import sessions
+
+    now = [100.0]
+    monkeypatch.setattr(sessions.time, "monotonic", lambda: now[0])
+    store = SessionStore(ttl=10)
+    store.set("a", {"version": 1, "content": []})
+
+    now[0] = 109
+    assert store.get("a") is not None
+    now[0] = 118
+    assert store.get("a") is not None
+    now[0] = 129
+    assert store.get("a") is None
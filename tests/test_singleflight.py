@@ -0,0 +1,101 @@
+import threading
+import time
+
+from dashpool_components.singleflight import SingleFlight
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_lagging_follower_catches_up():
+    release = threading.Event()
+    more = threading.Event()
+
+    def producer():
+        release.wait(5)
+        for i in range(6):
+            yield str(i)
+        more.wait(5)
+        for i in range(6, 9):
+            yield str(i)
+
+    single_flight = SingleFlight(buffer_size=2)
+    leader, started = single_flight.join("key", [producer])
+    follower, follower_started = single_flight.join("key", [producer])
+    assert started and not follower_started
+
+    # the tokens overflow the buffer of the follower, which does not read yet
+    release.set()
+    wait_for(lambda: len(follower.flight.events) >= 6)
+    assert follower.lagging
+
+    tokens = follower.producer(0)
+    assert [next(tokens) for _ in range(6)] == [str(i) for i in range(6)]
+
+    # caught up with the log, the next tokens are produced while it waits
+    threading.Timer(0.05, more.set).start()
+    assert list(tokens) == [str(i) for i in range(6, 9)]
+
+    assert list(leader.producer(0)) == [str(i) for i in range(9)]
+    assert len(single_flight) == 0
+
+
+def test_late_joiner_receives_the_produced_tokens():
+    more = threading.Event()
+
+    def producer():
+        yield "a"
+        yield "b"
+        more.wait(5)
+        yield "c"
+
+    single_flight = SingleFlight()
+    leader, _ = single_flight.join("key", [producer])
+    wait_for(lambda: len(leader.flight.events) >= 2)
+
+    follower, started = single_flight.join("key", [producer])
+    assert not started
+    more.set()
+
+    assert list(follower.producer(0)) == ["a", "b", "c"]
+    assert list(leader.producer(0)) == ["a", "b", "c"]
+
+
+def test_emitted_items_reach_every_subscriber():
+    more = threading.Event()
+    flights = []
+
+    def producer():
+        yield "a"
+        flights[0].emit({"role": "reference", "ref": "doc0"})
+        yield "b"
+        more.wait(5)
+        yield "c"
+
+    single_flight = SingleFlight()
+    leader, started = single_flight.join("key", [producer], start=False)
+    assert started and not leader.flight.events
+    flights.append(leader.flight)
+    follower, _ = single_flight.join("key", [producer])
+
+    received = {}
+    for subscription in (leader, follower):
+        subscription.on_emit = received.setdefault(subscription, []).append
+    leader.flight.start()
+    wait_for(lambda: len(leader.flight.events) >= 3)
+
+    # joins after the item was emitted, receives it from the log
+    late, _ = single_flight.join("key", [producer])
+    late.on_emit = received.setdefault(late, []).append
+    more.set()
+
+    for subscription in (leader, follower, late):
+        assert list(subscription.producer(0)) == ["a", "b", "c"]
+        assert received[subscription] == [{"role": "reference", "ref": "doc0"}]
+    # every response gets its own copy to set the ref and id on
+    assert received[leader][0] is not received[follower][0]
+    assert not flights[0].emit({"role": "reference"})
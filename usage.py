@@ -5,6 +5,7 @@ from dash import html, dcc, Input, Output
 from dash.exceptions import PreventUpdate
 from flask import jsonify, Response, request, abort, redirect, url_for
 import json
+import os
 import time
 import uuid
 
@@ -536,6 +537,11 @@ def layout():
 
 app = dash.Dash(__name__)
 
+# serve large inline images of chat documents from a cacheable url, the directory
+# is shared by all worker processes, so any of them can serve the asset of another
+asset_store = dashpool_components.chatutils.BlobStore(directory=os.path.join(os.path.dirname(__file__), ".dashpool_assets"))
+dashpool_components.chatutils.register_asset_route(app, asset_store)
+
 app.layout = layout
 
 